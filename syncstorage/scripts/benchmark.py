@@ -0,0 +1,345 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark the SyncStorage WSGI app in-process.
+
+This script drives the SyncStorage application directly through its WSGI
+interface, replaying the same mix of traffic as the loadtest/stress.py
+load test but without needing a tokenserver, a live server or any network
+access.  It can run against several databases in turn, e.g. the default
+SQLite database and a local MySQL or PostgreSQL server, and writes the
+throughput and latency percentiles of each endpoint out as JSON so that
+the results can be compared between commits.
+
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import string
+import logging
+import optparse
+import tempfile
+import timeit
+
+import hawkauthlib
+from webob import Request
+from pyramid.interfaces import IAuthenticationPolicy
+
+from six.moves import range
+
+import syncstorage
+import syncstorage.scripts
+from syncstorage.storage import get_all_storages
+
+
+logger = logging.getLogger("syncstorage.scripts.benchmark")  # pylint: disable=C0103
+
+
+# The same traffic mix as loadtest/stress.py.  See there for details.
+BATCH_MAX_COUNT = 100
+client_get_probability = 10 / 100.
+client_post_probability = 20 / 100.
+clients_distribution = [80, 15, 4, 1]
+collections = ["bookmarks", "forms", "passwords", "history", "prefs"]
+metaglobal_count_distribution = [40, 60, 0, 0, 0]
+get_count_distribution = [71, 15, 7, 4, 3]
+post_count_distribution = [67, 18, 9, 4, 2]
+delete_count_distribution = [99, 1, 0, 0, 0]
+deleteall_probability = 1 / 100.
+
+# The percentiles of request latency to report for each endpoint.
+PERCENTILES = (50, 95, 99)
+
+PAYLOAD_CHARS = string.ascii_letters + string.digits
+
+
+def get_default_sqluri():
+    """Get the sqluri of a fresh on-disk SQLite database."""
+    fd, path = tempfile.mkstemp(prefix="syncstorage-bench-", suffix=".db")
+    os.close(fd)
+    os.unlink(path)
+    return "sqlite:///" + path
+
+
+def make_app_settings(sqluri, **overrides):
+    """Build the app settings for benchmarking against the given database."""
+    settings = {
+        "storage.backend": "syncstorage.storage.sql.SQLStorage",
+        "storage.sqluri": sqluri,
+        "storage.standard_collections": True,
+        "storage.quota_size": 5242880,
+        "storage.create_tables": True,
+        "storage.batch_upload_enabled": True,
+        "hawkauth.secret": "benchmarking secret",
+    }
+    settings.update(overrides)
+    return settings
+
+
+def get_percentile(sorted_values, percentile):
+    """Get the given percentile of a sorted list, by the nearest rank."""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percentile / 100. * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize_latencies(latencies, elapsed):
+    """Summarize a list of latencies, taken over the given elapsed time."""
+    latencies = sorted(latencies)
+    summary = {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "max": latencies[-1] if latencies else None,
+    }
+    for percentile in PERCENTILES:
+        summary["p%d" % (percentile,)] = get_percentile(latencies, percentile)
+    return summary
+
+
+def make_bsos(rand, count):
+    """Make a list of BSO data with the same sizes as stress.py uploads."""
+    bsos = []
+    for _ in range(count):
+        bsoid = "".join(rand.choice(PAYLOAD_CHARS) for _ in range(16))
+        # min=300, mean=450, max=7000, the same as in stress.py.
+        size = min(int(rand.paretovariate(3) * 300), 7000)
+        bsos.append({"id": bsoid, "payload": PAYLOAD_CHARS[0] * size})
+    return bsos
+
+
+class StorageSession(object):
+    """Replays the stress.py mix of requests for a single user.
+
+    Each call to run() makes the same sequence of requests that the
+    loadtest would make in a single test run, recording the latency of
+    each request against the name of its endpoint.
+    """
+
+    def __init__(self, app, userid, auth_token, auth_secret, rand, timings):
+        self.app = app
+        self.userid = userid
+        self.auth_token = auth_token
+        self.auth_secret = auth_secret
+        self.rand = rand
+        self.timings = timings
+        self.root = "/1.5/%d" % (userid,)
+
+    def request(self, endpoint, method, path, data=None, expect=(200,)):
+        req = Request.blank(self.root + path, method=method)
+        req.headers["Content-Type"] = "application/json"
+        req.headers["X-Confirm-Delete"] = "1"
+        if data is not None:
+            req.body = json.dumps(data).encode("utf8")
+        hawkauthlib.sign_request(req, self.auth_token, self.auth_secret)
+        start = timeit.default_timer()
+        resp = req.get_response(self.app)
+        self.timings.setdefault(endpoint, []).append(
+            timeit.default_timer() - start)
+        if resp.status_int not in expect:
+            msg = "%s %s returned %s: %s"
+            msg %= (method, path, resp.status, resp.body[:200])
+            raise AssertionError(msg)
+        return resp
+
+    def pick_weighted_count(self, weights):
+        i = self.rand.randint(1, sum(weights))
+        count = 0
+        base = 0
+        for weight in weights:
+            base += weight
+            if i <= base:
+                break
+            count += 1
+        return count
+
+    def run(self):
+        rand = self.rand
+        self.request("GET info/collections", "GET", "/info/collections",
+                     expect=(200, 404))
+
+        for _ in range(self.pick_weighted_count(
+                metaglobal_count_distribution)):
+            resp = self.request("GET storage/meta/global", "GET",
+                                "/storage/meta/global", expect=(200, 404))
+            if resp.status_int == 404:
+                bso = {"id": "global", "payload": "metaglobal payload"}
+                self.request("PUT storage/meta/global", "PUT",
+                             "/storage/meta/global", bso)
+
+        if rand.random() <= client_get_probability:
+            newer = int(time.time() - rand.randint(3600, 360000))
+            self.request("GET storage/clients", "GET",
+                         "/storage/clients?full=1&newer=%d" % (newer,),
+                         expect=(200, 404))
+
+        if rand.random() <= client_post_probability:
+            clientid = str(self.pick_weighted_count(clients_distribution))
+            bso = {"id": "client" + clientid, "payload": clientid * 300}
+            self.request("POST storage/clients", "POST",
+                         "/storage/clients", [bso])
+
+        num_requests = self.pick_weighted_count(get_count_distribution)
+        for col in rand.sample(collections, num_requests):
+            newer = int(time.time() - rand.randint(3600, 360000))
+            self.request("GET storage/<collection>", "GET",
+                         "/storage/%s?full=1&newer=%d" % (col, newer),
+                         expect=(200, 404))
+
+        # Roughly half of the POSTs are made as transactional batches.
+        num_requests = self.pick_weighted_count(post_count_distribution)
+        transact = rand.randint(0, 1)
+        if transact:
+            cols = [rand.choice(collections)] * num_requests
+        else:
+            cols = rand.sample(collections, num_requests)
+        batchid = None
+        for x, col in enumerate(cols):
+            count = min(rand.randint(20, BATCH_MAX_COUNT + 80),
+                        BATCH_MAX_COUNT)
+            path = "/storage/" + col
+            bsos = make_bsos(rand, count)
+            if not transact:
+                self.request("POST storage/<collection>", "POST", path, bsos)
+            elif x == num_requests - 1 and batchid is not None:
+                path += "?commit=true&batch=%s" % (batchid,)
+                self.request("POST storage/<collection>?commit", "POST",
+                             path, bsos)
+            else:
+                if batchid is None:
+                    path += "?batch=true"
+                else:
+                    path += "?batch=%s" % (batchid,)
+                resp = self.request("POST storage/<collection>?batch",
+                                    "POST", path, bsos, expect=(202,))
+                batchid = json.loads(resp.body)["batch"]
+
+        num_requests = self.pick_weighted_count(delete_count_distribution)
+        if num_requests:
+            for col in rand.sample(collections, num_requests):
+                self.request("DELETE storage/<collection>", "DELETE",
+                             "/storage/" + col, expect=(200, 204))
+        elif rand.random() <= deleteall_probability:
+            self.request("DELETE storage", "DELETE", "/storage")
+
+
+def run_benchmark(sqluri, num_sessions=1000, num_users=100, seed=None,
+                  **settings):
+    """Run the benchmark against a single database.
+
+    This creates an instance of the SyncStorage app that talks to the
+    given database, replays the given number of loadtest sessions against
+    it spread across the given number of users, and returns a dict with
+    overall and per-endpoint statistics.  All data written by the
+    benchmark is deleted again before returning.
+    """
+    logger.info("Benchmarking against %s", sqluri)
+    rand = random.Random(seed)
+    config = syncstorage.get_configurator({},
+                                          **make_app_settings(sqluri,
+                                                              **settings))
+    app = config.make_wsgi_app()
+    auth_policy = config.registry.getUtility(IAuthenticationPolicy)
+    credentials = {}
+    req = Request.blank("http://localhost/")
+    for userid in range(1, num_users + 1):
+        credentials[userid] = auth_policy.encode_hawk_id(req, userid)
+    timings = {}
+    try:
+        start = timeit.default_timer()
+        for _ in range(num_sessions):
+            userid = rand.randint(1, num_users)
+            auth_token, auth_secret = credentials[userid]
+            StorageSession(app, userid, auth_token, auth_secret,
+                           rand, timings).run()
+        elapsed = timeit.default_timer() - start
+    finally:
+        for _, storage in get_all_storages(config):
+            for userid in credentials:
+                storage.delete_storage(userid)
+            while hasattr(storage, "storage"):
+                storage = storage.storage
+            storage.dbconnector.engine.dispose()
+    all_timings = [t for ts in timings.values() for t in ts]
+    result = summarize_latencies(all_timings, elapsed)
+    result["sqluri"] = _strip_password(sqluri)
+    result["sessions"] = num_sessions
+    result["users"] = num_users
+    result["elapsed"] = elapsed
+    result["endpoints"] = {}
+    for endpoint, latencies in timings.items():
+        summary = summarize_latencies(latencies, elapsed)
+        result["endpoints"][endpoint] = summary
+    return result
+
+
+def _strip_password(sqluri):
+    """Remove any password from a sqluri, so it's safe to report."""
+    scheme, sep, rest = sqluri.partition("://")
+    userinfo, at, host = rest.rpartition("@")
+    if not at or ":" not in userinfo:
+        return sqluri
+    return scheme + sep + userinfo.split(":", 1)[0] + ":***@" + host
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments, runs the benchmark against
+    each requested database and writes the results out as JSON.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", action="append", dest="sqluris",
+                      help="Database to benchmark against; may be repeated."
+                           " Defaults to a temporary SQLite file.")
+    parser.add_option("", "--sessions", type="int", default=1000,
+                      help="Number of loadtest sessions to replay")
+    parser.add_option("", "--users", type="int", default=100,
+                      help="Number of distinct users to spread them across")
+    parser.add_option("", "--seed", type="int", default=0,
+                      help="Seed for the random traffic mix")
+    parser.add_option("", "--output",
+                      help="File to write the JSON results to")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    results = {"seed": opts.seed, "backends": []}
+    for sqluri in opts.sqluris or [None]:
+        temp_sqlite_file = None
+        if sqluri is None:
+            sqluri = get_default_sqluri()
+            temp_sqlite_file = sqluri[len("sqlite:///"):]
+        try:
+            results["backends"].append(run_benchmark(
+                sqluri, opts.sessions, opts.users, opts.seed))
+        finally:
+            if temp_sqlite_file and os.path.exists(temp_sqlite_file):
+                os.unlink(temp_sqlite_file)
+
+    output = json.dumps(results, indent=2, sort_keys=True,
+                        separators=(",", ": "))
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
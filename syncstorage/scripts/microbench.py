@@ -0,0 +1,305 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to microbenchmark the per-record hot paths of SyncStorage.
+
+Where benchmark.py measures whole requests, this script times the small
+functions that every record passes through on its way in or out of the
+server: BSO parsing and validation, response rendering, query building,
+row conversion, pagination offsets and memcache (de)serialization.  Each
+benchmark works on realistically-sized records and batches, needs no
+external services, and reports the time per call and per record as JSON
+so that regressions can be spotted by comparing runs between commits.
+
+"""
+
+import sys
+import json
+import random
+import logging
+import optparse
+import timeit
+
+from pyramid.request import Request
+from cornice.errors import Errors
+
+import syncstorage
+import syncstorage.scripts
+from syncstorage.bso import BSO
+from syncstorage.util import get_timestamp
+from syncstorage.scripts.benchmark import (BATCH_MAX_COUNT,
+                                           make_app_settings,
+                                           make_bsos,
+                                           get_percentile)
+from syncstorage.storage.sql import SQLStorage, ts2bigint
+from syncstorage.views.renderers import JsonRenderer, NewlinesRenderer
+from syncstorage.views.validators import parse_multiple_bsos
+
+
+logger = logging.getLogger("syncstorage.scripts.microbench")  # pylint: disable=C0103
+
+
+# Registry of all available benchmarks, in the order they were defined.
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Decorator to register a benchmark under the given name.
+
+    The decorated function is called once to do any setup, and must return
+    a tuple (func, num_records) giving a zero-argument function to be timed
+    and the number of records that it processes on each call.
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return decorator
+
+
+def _make_bso_datas(rand, count=BATCH_MAX_COUNT):
+    """Make a list of BSO data as it would be sent in a client upload."""
+    bsos = make_bsos(rand, count)
+    for bso in bsos:
+        bso["sortindex"] = rand.randint(0, 1000)
+        bso["ttl"] = 3600
+    return bsos
+
+
+def _make_stored_bsos(rand, count=BATCH_MAX_COUNT):
+    """Make a list of BSOs as they would be read back from storage."""
+    now = get_timestamp()
+    bsos = []
+    for i, data in enumerate(make_bsos(rand, count)):
+        data["sortindex"] = rand.randint(0, 1000)
+        # Uploads land in batches, so timestamps are shared between items.
+        data["modified"] = get_timestamp(now - (i // 10))
+        bsos.append(BSO(data))
+    return bsos
+
+
+@benchmark("bso_init_validate")
+def bench_bso_init_validate(rand):
+    bso_datas = _make_bso_datas(rand)
+
+    def func():
+        for data in bso_datas:
+            BSO(data).validate()
+
+    return func, len(bso_datas)
+
+
+@benchmark("parse_multiple_bsos")
+def bench_parse_multiple_bsos(rand):
+    bso_datas = _make_bso_datas(rand)
+    config = syncstorage.get_configurator(
+        {}, **make_app_settings("sqlite:///:memory:"))
+    body = json.dumps(bso_datas)
+
+    def func():
+        request = Request.blank("/1.5/42/storage/bookmarks", method="POST")
+        request.registry = config.registry
+        request.content_type = "application/json"
+        request.body = body
+        request.matchdict = {"userid": "42", "collection": "bookmarks"}
+        request.validated = {}
+        request.errors = Errors(request)
+        parse_multiple_bsos(request)
+        assert not request.errors
+
+    return func, len(bso_datas)
+
+
+@benchmark("json_renderer")
+def bench_json_renderer(rand):
+    bsos = _make_stored_bsos(rand)
+    renderer = JsonRenderer(None)
+    return (lambda: renderer.render_value(bsos)), len(bsos)
+
+
+@benchmark("newlines_renderer")
+def bench_newlines_renderer(rand):
+    bsos = _make_stored_bsos(rand)
+    renderer = NewlinesRenderer(None)
+    return (lambda: renderer.render_value(bsos)), len(bsos)
+
+
+@benchmark("get_query_find_items")
+def bench_get_query_find_items(rand):
+    storage = SQLStorage("sqlite:///:memory:", standard_collections=True)
+    dbconnector = storage.dbconnector
+    params = {
+        "userid": rand.randint(1, 1000000),
+        "collectionid": 7,
+        "newer": ts2bigint(get_timestamp() - 3600),
+        "ttl": int(get_timestamp()),
+        "limit": 101,
+        "sort": "newest",
+    }
+
+    def func():
+        dbconnector.get_query("FIND_ITEMS", params)
+
+    return func, 1
+
+
+@benchmark("get_query_string")
+def bench_get_query_string(rand):
+    storage = SQLStorage("sqlite:///:memory:", standard_collections=True)
+    dbconnector = storage.dbconnector
+    params = {"userid": rand.randint(1, 1000000)}
+
+    def func():
+        dbconnector.get_query("ITEM_DETAILS", params)
+
+    return func, 1
+
+
+@benchmark("row_to_bso")
+def bench_row_to_bso(rand):
+    storage = SQLStorage("sqlite:///:memory:", standard_collections=True)
+    timestamp = int(get_timestamp())
+    rows = []
+    for bso in _make_stored_bsos(rand):
+        rows.append({
+            "userid": 42,
+            "collection": 7,
+            "id": bso["id"],
+            "sortindex": bso["sortindex"],
+            "modified": ts2bigint(bso["modified"]),
+            "payload": bso["payload"],
+            "payload_size": len(bso["payload"]),
+            "ttl": timestamp + 3600,
+        })
+
+    def func():
+        for row in rows:
+            storage._row_to_bso(row, timestamp)
+
+    return func, len(rows)
+
+
+@benchmark("encode_decode_offset")
+def bench_encode_decode_offset(rand):
+    storage = SQLStorage("sqlite:///:memory:", standard_collections=True)
+    items = _make_stored_bsos(rand)
+
+    def func():
+        params = {"sort": "newest", "offset": 0}
+        offset = storage.encode_next_offset(params, items)
+        storage.decode_offset(params, offset)
+
+    return func, 1
+
+
+@benchmark("memcached_encode_decode")
+def bench_memcached_encode_decode(rand):
+    # Imported here since it needs the optional umemcache module.
+    from syncstorage.storage.memcached import MemcachedClient
+    client = MemcachedClient()
+    bsos = _make_stored_bsos(rand)
+    data = {
+        "modified": bsos[0]["modified"],
+        "items": dict((bso["id"], bso) for bso in bsos),
+    }
+
+    def func():
+        value, flags = client._encode_value(data)
+        client._decode_value(value, flags)
+
+    return func, len(bsos)
+
+
+def run_microbenchmark(setup, seed=0, rounds=5, min_round_time=0.05):
+    """Time a single benchmark, returning a dict of statistics.
+
+    The benchmark is run in several rounds, each one calling it repeatedly
+    for at least min_round_time seconds, and the statistics are taken over
+    the average time per call in each round.
+    """
+    func, num_records = setup(random.Random(seed))
+    # Find how many calls are needed to fill a round.
+    number = 1
+    while True:
+        elapsed = timeit.Timer(func).timeit(number)
+        if elapsed >= min_round_time:
+            break
+        number *= 2
+    timings = sorted(t / number
+                     for t in timeit.Timer(func).repeat(rounds, number))
+    return {
+        "records": num_records,
+        "rounds": rounds,
+        "calls_per_round": number,
+        "min": timings[0],
+        "p50": get_percentile(timings, 50),
+        "mean": sum(timings) / len(timings),
+        "per_record": get_percentile(timings, 50) / num_records,
+    }
+
+
+def run_microbenchmarks(names=None, **kwds):
+    """Run the named benchmarks, or all of them, returning their results.
+
+    Benchmarks that cannot run because an optional dependency is missing
+    are skipped, with their result set to None.
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        logger.info("Running %s", name)
+        try:
+            results[name] = run_microbenchmark(setup, **kwds)
+        except ImportError as e:
+            logger.warning("Skipping %s: %s", name, e)
+            results[name] = None
+    return results
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments, runs the requested
+    benchmarks and writes the results out as JSON.
+    """
+    usage = "usage: %prog [options] [benchmark_name...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--rounds", type="int", default=5,
+                      help="Number of rounds to time each benchmark for")
+    parser.add_option("", "--min-round-time", type="float", default=0.05,
+                      help="Minimum time in seconds to spend on each round")
+    parser.add_option("", "--seed", type="int", default=0,
+                      help="Seed for the random test data")
+    parser.add_option("", "--output",
+                      help="File to write the JSON results to")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    known_names = set(name for name, _ in BENCHMARKS)
+    for name in args:
+        if name not in known_names:
+            parser.error("unknown benchmark: %s" % (name,))
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    results = {
+        "seed": opts.seed,
+        "benchmarks": run_microbenchmarks(args, seed=opts.seed,
+                                          rounds=opts.rounds,
+                                          min_round_time=opts.min_round_time)
+    }
+    output = json.dumps(results, indent=2, sort_keys=True,
+                        separators=(",", ": "))
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
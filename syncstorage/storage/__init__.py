@@ -9,7 +9,10 @@ Abstract interface definition for storage backends.
 
 import sys
 import abc
+import time
 import logging
+import threading
+import contextlib
 
 from mozsvc.plugin import resolve_name
 
@@ -56,6 +59,40 @@ class InvalidBatch(StorageError, ValueError):
     pass
 
 
+# A thread-local to track the deadline for the current storage operations.
+_deadline_data = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(timeout):
+    """Context manager setting a time limit on storage operations.
+
+    Storage operations performed by the current thread within this context
+    should not take longer than the given number of seconds in total.  It's
+    up to each backend to enforce this, where possible, by using get_deadline()
+    to find out how much time is left.  If the context is nested then the
+    earlier of the two deadlines will apply.
+    """
+    old_deadline = get_deadline()
+    new_deadline = time.time() + timeout
+    if old_deadline is not None:
+        new_deadline = min(old_deadline, new_deadline)
+    _deadline_data.deadline = new_deadline
+    try:
+        yield
+    finally:
+        _deadline_data.deadline = old_deadline
+
+
+def get_deadline():
+    """Get the deadline for storage operations in the current thread.
+
+    This returns the absolute time by which any active storage operations
+    should be completed, or None if there is no deadline.
+    """
+    return getattr(_deadline_data, "deadline", None)
+
+
 class SyncStorage(object):
     """Abstract Base Class for storage backends.
 
@@ -389,6 +426,23 @@ class SyncStorage(object):
             batchid: big integer batch identifier for this batch
         """
 
+    def get_batch_totals(self, userid, collection, batchid):
+        """Returns the total size of the items appended to a batch so far.
+
+        This is used to enforce limits on the total size of a batch that
+        don't depend on the client reporting it honestly.  Backends that
+        don't keep track of it may return None.
+
+        Args:
+            userid: integer identifying the user in the storage.
+            collection: name of the collection.
+            batchid: big integer batch identifier for this batch
+
+        Returns:
+            A tuple (num_records, num_bytes) if the batch is open, and None
+            otherwise.
+        """
+
     #
     # Items APIs
     #
@@ -506,7 +560,11 @@ class SyncStorage(object):
 
 
 def get_all_storages(config):
-    """Iterator over all (hostname, storage) pairs for a config."""
+    """Iterator over all (hostname, storage) pairs for a config.
+
+    This works equally well when given a request object, since it only
+    needs access to the registry.
+    """
     for key in config.registry:
         if key == "syncstorage:storage:default":
             yield ("default", config.registry[key])
@@ -13,6 +13,16 @@ The following memcached keys are used:
 
     * userid:metadata         metadata about the storage and collections
     * userid:c:<collection>   cached data for a particular collection
+    * userid:c:<collection>:batchids               ids of the open batches
+                                                   in a cache-only collection
+    * userid:c:<collection>:batch:<batchid>        number of appends made to
+                                                   a batch in a cache-only
+                                                   collection
+    * userid:c:<collection>:batch:<batchid>:<seq>  items of the seq'th append
+                                                   to that batch
+    * userid:c:<collection>:batch:<batchid>:records
+    * userid:c:<collection>:batch:<batchid>:bytes  running totals of the
+                                                   items in that batch
 
 A key prefix can also be defined to avoid clobbering unrelated data in a
 shared memcached setup.  It defaults to the empty string.
@@ -32,15 +42,22 @@ It has the following structure:
 
 For each collection to be stored in memcache, the corresponding key contains
 a JSON mapping from item ids to BSO objects along with a record of the last-
-modified timestamp for that collection:
+modified timestamp for that collection, and an index of the items that have
+a ttl sorted by their expiry time:
 
     {
       "modified":   <last-modified timestamp for the collection>,
       "items": {
         <item id>:  <BSO object for that item>,
-      }
+      },
+      "expiry": [
+        [<ttl>, <item id>],
+      ]
     }
 
+The index lets writes purge expired items by popping them off the front,
+and lets reads skip checking each item for expiry when none have expired.
+
 To avoid the cached data getting out of sync with the underlying storage, we
 explicitly mark the cache as dirty before performing any write operations.
 In the unlikely event of a mid-operation crash, we'll notice the dirty cache
@@ -49,10 +66,12 @@ data from memcache.
 """
 
 import time
+import bisect
 import threading
 import contextlib
 
-from syncstorage.util import get_timestamp, json_loads, json_dumps
+from syncstorage.util import (get_timestamp, json_loads, json_dumps,
+                              profile_phase)
 from syncstorage.storage import (SyncStorage,
                                  StorageError,
                                  ConflictError,
@@ -81,6 +100,16 @@ def _key(*names):
     return ":".join(map(str, names))
 
 
+def _unindex_expiry(expiry, ttl, id):
+    """Remove an item from a sorted index of expiry times, if present."""
+    if ttl is None:
+        return
+    entry = [ttl, id]
+    i = bisect.bisect_left(expiry, entry)
+    if i < len(expiry) and expiry[i] == entry:
+        del expiry[i]
+
+
 def bso_sort_key_index(bso):
     return (bso["sortindex"], bso["id"])
 
@@ -101,6 +130,25 @@ class MemcachedClient(MemcachedClient):
     def _decode_value(self, value, flags):  # pylint: disable=W0613
         return json_loads(value)
 
+    def incr(self, key, delta=1):
+        """Increment the integer stored under the given key.
+
+        Returns the new value, or None if the key is not present.
+        """
+        key = self._encode_key(key)
+        with self._connect() as mc:
+            res = mc.incr(key, delta)
+        # umemcache passes the server's response straight through.
+        if res is None or res == "NOT_FOUND":
+            return None
+        return int(res)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        with profile_phase("memcache"):
+            with super(MemcachedClient, self)._connect() as mc:
+                yield mc
+
 
 class MemcachedStorage(SyncStorage):
     """Memcached caching wrapper for SyncStorage backends.
@@ -192,6 +240,8 @@ class MemcachedStorage(SyncStorage):
 
     def lock_for_read(self, userid, collection):
         """Acquire a shared read lock on the named collection."""
+        if self._is_known_absent(userid, collection):
+            return self._lock_absent_collection(userid, collection)
         if self.cache_lock or collection in self.cache_only_collections:
             return self._lock_in_memcache(userid, collection)
         else:
@@ -204,6 +254,48 @@ class MemcachedStorage(SyncStorage):
         else:
             return self.storage.lock_for_write(userid, collection)
 
+    def _is_known_absent(self, userid, collection):
+        """Check whether the cached metadata says a collection doesn't exist.
+
+        The metadata lists every collection in the underlying store, and is
+        updated by every write that goes through this class, so a collection
+        that's missing from it can be reported as not found without asking
+        the store.  Nothing is known if the metadata isn't cached.
+        """
+        if collection in self.cached_collections:
+            return False
+        if collection in self.cache_only_collections:
+            return False
+        data = self.cache.get(_key(userid, "metadata"))
+        if data is None:
+            return False
+        return collection not in data["collections"]
+
+    @contextlib.contextmanager
+    def _lock_absent_collection(self, userid, collection):
+        """Helper method to "lock" a collection that doesn't exist.
+
+        There's nothing to read, so no lock is taken in the underlying store.
+        Reads of the collection made while this is held will not find it.
+        """
+        try:
+            absent_collections = self._tldata.absent_collections
+        except AttributeError:
+            absent_collections = self._tldata.absent_collections = set()
+        if (userid, collection) in absent_collections:
+            yield None
+            return
+        absent_collections.add((userid, collection))
+        try:
+            yield None
+        finally:
+            absent_collections.remove((userid, collection))
+
+    def _is_locked_absent(self, userid, collection):
+        """Check whether a collection was found absent when read-locked."""
+        absent_collections = getattr(self._tldata, "absent_collections", ())
+        return (userid, collection) in absent_collections
+
     @contextlib.contextmanager
     def _lock_in_memcache(self, userid, collection):
         """Helper method to take a memcache-level lock on a collection."""
@@ -219,8 +311,9 @@ class MemcachedStorage(SyncStorage):
         ttl = self.cache_lock_ttl
         now = time.time()
         key = _key(userid, "lock", collection)
-        if not self.cache.add(key, True, time=ttl):
-            raise ConflictError
+        with profile_phase("lock"):
+            if not self.cache.add(key, True, time=ttl):
+                raise ConflictError
         locked_collections.add((userid, collection))
         try:
             yield None
@@ -374,6 +467,11 @@ class MemcachedStorage(SyncStorage):
         ts = colmgr.append_items_to_batch(userid, batchid, items)
         return ts
 
+    def get_batch_totals(self, userid, collection, batchid):
+        """Returns the number of records and bytes appended to a batch."""
+        colmgr = self._get_collection_manager(collection)
+        return colmgr.get_batch_totals(userid, batchid)
+
     def apply_batch(self, userid, collection, batchid):
         """Applies the batch"""
         colmgr = self._get_collection_manager(collection)
@@ -431,6 +529,22 @@ class MemcachedStorage(SyncStorage):
         # Therefore, the only thing we can do here is pass on the call.
         return self.storage.purge_expired_items(grace_period, max_per_loop)
 
+    def get_pool_status(self):
+        """Get information about the underlying storage's connection pool."""
+        try:
+            get_pool_status = self.storage.get_pool_status
+        except AttributeError:
+            return None
+        return get_pool_status()
+
+    def get_query_stats(self):
+        """Get the underlying storage's per-query statistics."""
+        try:
+            get_query_stats = self.storage.get_query_stats
+        except AttributeError:
+            return None
+        return get_query_stats()
+
     #
     #  Private APIs for managing the cached metadata
     #
@@ -610,10 +724,14 @@ class UncachedManager(object):
         return storage.get_collection_timestamp(userid, self.collection)
 
     def get_items(self, userid, **kwds):
+        if self.owner._is_locked_absent(userid, self.collection):
+            raise CollectionNotFoundError
         storage = self.owner.storage
         return storage.get_items(userid, self.collection, **kwds)
 
     def get_item_ids(self, userid, **kwds):
+        if self.owner._is_locked_absent(userid, self.collection):
+            raise CollectionNotFoundError
         storage = self.owner.storage
         return storage.get_item_ids(userid, self.collection, **kwds)
 
@@ -630,10 +748,14 @@ class UncachedManager(object):
         return storage.delete_items(userid, self.collection, items)
 
     def get_item_timestamp(self, userid, item):
+        if self.owner._is_locked_absent(userid, self.collection):
+            raise ItemNotFoundError
         storage = self.owner.storage
         return storage.get_item_timestamp(userid, self.collection, item)
 
     def get_item(self, userid, item):
+        if self.owner._is_locked_absent(userid, self.collection):
+            raise ItemNotFoundError
         storage = self.owner.storage
         return storage.get_item(userid, self.collection, item)
 
@@ -658,6 +780,10 @@ class UncachedManager(object):
         return storage.append_items_to_batch(userid, self.collection, batchid,
                                              items)
 
+    def get_batch_totals(self, userid, batchid):
+        storage = self.owner.storage
+        return storage.get_batch_totals(userid, self.collection, batchid)
+
     def apply_batch(self, userid, batchid):
         storage = self.owner.storage
         return storage.apply_batch(userid, self.collection, batchid)
@@ -735,9 +861,10 @@ class _CachedManagerBase(object):
         the cached data.
         """
         if not data:
-            data = {"modified": modified, "items": {}}
+            data = {"modified": modified, "items": {}, "expiry": []}
         elif data["modified"] >= modified:
             raise ConflictError
+        expiry = self._get_expiry_index(data)
         num_created = 0
         for item in items:
             # Cache only the fields we need.
@@ -754,6 +881,13 @@ class _CachedManagerBase(object):
                     bso["ttl"] = None
                 else:
                     bso["ttl"] = int(modified) + item["ttl"]
+            # Keep the expiry index in sync with any change of ttl.
+            if "ttl" in bso:
+                old_bso = data["items"].get(bso["id"])
+                if old_bso is not None:
+                    _unindex_expiry(expiry, old_bso.get("ttl"), bso["id"])
+                if bso["ttl"] is not None:
+                    bisect.insort(expiry, [bso["ttl"], bso["id"]])
             # Update it in-place, or create if it doesn't exist.
             try:
                 data["items"][bso["id"]].update(bso)
@@ -768,14 +902,11 @@ class _CachedManagerBase(object):
         # Purge any items that have expired.
         # We can't do this as part of the purge_expired_items()
         # because we don't have a way to enumerate all user ids.
-        expired_ids = set()
         expiry_time = int(time.time()) - TTL_EXPIRY_GRACE_PERIOD
-        for id, bso in data["items"].items():
-            ttl = bso.get("ttl")
-            if ttl is not None and ttl < expiry_time:
-                expired_ids.add(id)
-        for id in expired_ids:
+        num_expired = bisect.bisect_left(expiry, [expiry_time])
+        for _, id in expiry[:num_expired]:
             del data["items"][id]
+        del expiry[:num_expired]
         key = self.get_key(userid)
         if not self.cache.cas(key, data, casid):
             raise ConflictError
@@ -795,9 +926,12 @@ class _CachedManagerBase(object):
             raise CollectionNotFoundError
         if data["modified"] >= modified:
             raise ConflictError
+        expiry = self._get_expiry_index(data)
         num_deleted = 0
         for id in items:
-            if data["items"].pop(id, None) is not None:
+            bso = data["items"].pop(id, None)
+            if bso is not None:
+                _unindex_expiry(expiry, bso.get("ttl"), id)
                 num_deleted += 1
         if num_deleted > 0:
             data["modified"] = modified
@@ -842,7 +976,8 @@ class _CachedManagerBase(object):
         if older is not None:
             bsos = (bso for bso in bsos if bso["modified"] < older)
         # Filter out any that have expired.
-        bsos = self._filter_expired_items(bsos)
+        if self._has_expired_items(data):
+            bsos = self._filter_expired_items(bsos)
         # Sort the resulting list.
         # We always sort so that offset/limit work correctly.
         # Using the id as a secondary key produces a unique ordering.
@@ -874,6 +1009,27 @@ class _CachedManagerBase(object):
             "next_offset": next_offset
         }
 
+    def _get_expiry_index(self, data):
+        """Get the index of item expiry times in the cached data.
+
+        Data cached before the index was introduced doesn't have one,
+        so it is built on demand and saved along with the next write.
+        """
+        try:
+            return data["expiry"]
+        except KeyError:
+            data["expiry"] = expiry = sorted(
+                [bso["ttl"], id] for id, bso in data["items"].iteritems()
+                if bso.get("ttl") is not None
+            )
+            return expiry
+
+    def _has_expired_items(self, data):
+        expiry = data.get("expiry")
+        if expiry is None:
+            return True
+        return bool(expiry) and expiry[0][0] <= int(time.time())
+
     def _filter_expired_items(self, bsos):
         now = int(time.time())
         for bso in bsos:
@@ -904,13 +1060,22 @@ class CacheOnlyManager(_CachedManagerBase):
     internally and uses CAS to avoid conflicting writes.
     """
 
-    def get_batches_key(self, userid):
-        return _key(userid, "c", self.collection, "batches")
-
     def iter_cache_keys(self, userid):
         for key in super(CacheOnlyManager, self).iter_cache_keys(userid):
             yield key
-        yield self.get_batches_key(userid)
+        # Read everything we need before yielding, since the caller may
+        # be deleting the keys as it goes.
+        key = self.get_batch_ids_key(userid)
+        batch_keys = []
+        for batch in self.cache.get(key) or ():
+            num_appends = self.cache.get(self.get_batch_key(userid, batch))
+            batch_keys.append(self.get_batch_key(userid, batch))
+            for name in ["records", "bytes"] + \
+                    list(range(1, (num_appends or 0) + 1)):
+                batch_keys.append(self.get_batch_key(userid, batch, name))
+        yield key
+        for key in batch_keys:
+            yield key
 
     def get_cached_data(self, userid):
         return self.cache.gets(self.get_key(userid))
@@ -950,81 +1115,145 @@ class CacheOnlyManager(_CachedManagerBase):
             raise ItemNotFoundError
         return modified
 
-    def get_cached_batches(self, userid, ts=None):  # pylint: disable=C0103
+    def get_batch_key(self, userid, batchid, seq=None):
+        if seq is None:
+            return _key(userid, "c", self.collection, "batch", batchid)
+        return _key(userid, "c", self.collection, "batch", batchid, seq)
+
+    def get_batch_ids_key(self, userid):
+        return _key(userid, "c", self.collection, "batchids")
+
+    def _update_batch_ids(self, userid, add=None, remove=None):
+        """Add or remove a batch in the list of the user's open batches.
+
+        The list lets delete_storage() find the batches to clear out.
+        Expired batches are dropped from it along the way.  Returns False
+        if the list was changed concurrently by someone else.
+        """
+        key = self.get_batch_ids_key(userid)
+        batchids, casid = self.cache.gets(key)
+        ts = get_timestamp()
+        batchids = [batch for batch in batchids or ()
+                    if str(batch) != str(remove) and
+                    not self._is_expired_batch(batch, ts)]
+        if add is not None:
+            batchids.append(add)
+        return self.cache.cas(key, batchids, casid, time=BATCH_LIFETIME)
+
+    def _is_expired_batch(self, batch, ts=None):
+        # The batchid is the creation time in milliseconds.
         if ts is None:
             ts = get_timestamp()
-        ts = int(ts)
-        bdata, bcasid = self.cache.gets(self.get_batches_key(userid))
-        # Remove any expired batches, but let the
-        # calling code write it back out to memcache.
-        if bdata:
-            for batchid, batch in bdata.items():
-                if batch["created"] + BATCH_LIFETIME < ts:
-                    del bdata[batchid]
-        return bdata, bcasid
+        return int(batch) // 1000 + BATCH_LIFETIME < ts
 
     def create_batch(self, userid):
         ts = get_timestamp()
-        bdata, bcasid = self.get_cached_batches(userid, ts)
         batchid = int(ts * 1000)
-        if not bdata:
-            bdata = {}
-        if batchid in bdata:
+        if not self._update_batch_ids(userid, add=batchid):
             raise ConflictError
-        bdata[batchid] = {
-            "created": int(ts),
-            "items": []
-        }
-        key = self.get_batches_key(userid)
-        if not self.cache.cas(key, bdata, bcasid):
+        # The header counts the appends made to the batch so far.
+        key = self.get_batch_key(userid, batchid)
+        if not self.cache.add(key, 0, time=BATCH_LIFETIME):
             raise ConflictError
+        for name in ("records", "bytes"):
+            key = self.get_batch_key(userid, batchid, name)
+            self.cache.set(key, 0, time=BATCH_LIFETIME)
         return batchid
 
     def valid_batch(self, userid, batch):
-        ts = get_timestamp()
-        batchid = str(batch)
-        bdata, bcasid = self.get_cached_batches(userid, ts)
-        if not bdata:
+        if self._is_expired_batch(batch):
             return False
-        return (batchid in bdata)
+        return self.cache.get(self.get_batch_key(userid, batch)) is not None
 
     def append_items_to_batch(self, userid, batch, items):
         modified = get_timestamp()
-        batchid = str(batch)
-        bdata, bcasid = self.get_cached_batches(userid, modified)
         # Invalid, closed, or expired batch
-        if not bdata or batchid not in bdata:
+        if self._is_expired_batch(batch, modified):
             raise InvalidBatch(batch)
-
-        bdata[batchid]["items"].extend(items)
-        key = self.get_batches_key(userid)
-        if not self.cache.cas(key, bdata, bcasid):
+        # Claim the next sequence number, then write the items under it.
+        # Nothing already in the batch needs to be read or rewritten.
+        seq = self.cache.incr(self.get_batch_key(userid, batch))
+        if seq is None:
+            raise InvalidBatch(batch)
+        key = self.get_batch_key(userid, batch, seq)
+        added = False
+        try:
+            added = self.cache.add(key, items, time=BATCH_LIFETIME)
+        finally:
+            # Don't leave the slot holding anything but these items, so that
+            # a failed append adds nothing to the batch.  If this fails too,
+            # the slot is skipped when the batch is applied.
+            if not added:
+                self.cache.set(key, [], time=BATCH_LIFETIME)
+        if not added:
             raise ConflictError
+        num_bytes = sum(len(item.get("payload", "")) for item in items)
+        self.cache.incr(self.get_batch_key(userid, batch, "records"),
+                        len(items))
+        self.cache.incr(self.get_batch_key(userid, batch, "bytes"),
+                        num_bytes)
         return modified
 
+    def _get_batch_items(self, userid, batch):
+        """Get all the items appended to a batch, in order of appending.
+
+        Returns None if the batch is invalid, closed or expired.  An append
+        that claimed a sequence number but never wrote its items, because it
+        failed or is still in progress, is skipped.  Raises InvalidBatch if
+        any append that did succeed has gone missing, e.g. because memcached
+        evicted it, rather than applying what's left.
+        """
+        if self._is_expired_batch(batch):
+            return None
+        # Appends are counted in the totals only after writing their items,
+        # so every append counted here is found below unless it was lost.
+        records_key = self.get_batch_key(userid, batch, "records")
+        num_records = self.cache.get(records_key)
+        num_appends = self.cache.get(self.get_batch_key(userid, batch))
+        if num_appends is None:
+            return None
+        keys = [self.get_batch_key(userid, batch, seq)
+                for seq in range(1, num_appends + 1)]
+        appends = self.cache.get_multi(keys) if keys else {}
+        items = []
+        for key in keys:
+            items.extend(appends.get(key, ()))
+        if num_records is None or len(items) < num_records:
+            raise InvalidBatch(batch)
+        return items
+
+    def get_batch_totals(self, userid, batch):
+        keys = [self.get_batch_key(userid, batch, name)
+                for name in ("records", "bytes")]
+        totals = self.cache.get_multi(keys)
+        if len(totals) != len(keys):
+            return None
+        return tuple(totals[key] for key in keys)
+
     def apply_batch(self, userid, batch):
         modified = get_timestamp()
-        batchid = str(batch)
-        bdata, bcasid = self.get_cached_batches(userid, modified)
+        items = self._get_batch_items(userid, batch)
         # Invalid, closed, or expired batch
-        if not bdata or batchid not in bdata:
+        if items is None:
             raise InvalidBatch(batch)
 
         data, casid = self.get_cached_data(userid)
-        self._set_items(userid, bdata[batchid]["items"], modified, data, casid)
+        self._set_items(userid, items, modified, data, casid)
         return modified
 
     def close_batch(self, userid, batch):
-        batchid = str(batch)
-        bdata, bcasid = self.get_cached_batches(userid)
-        key = self.get_batches_key(userid)
-
-        try:
-            del bdata[batchid]
-        except KeyError:
+        key = self.get_batch_key(userid, batch)
+        num_appends = self.cache.get(key)
+        if num_appends is None:
             return
-        if not self.cache.cas(key, bdata, bcasid):
-            raise ConflictError
+        self.cache.delete(key)
+        # The items would expire along with the batch anyway,
+        # but there's no point keeping them around until then.
+        for name in ["records", "bytes"] + list(range(1, num_appends + 1)):
+            self.cache.delete(self.get_batch_key(userid, batch, name))
+        # A closed batch left in the list is harmless, since its keys are
+        # gone, so losing a race to update the list doesn't matter.
+        self._update_batch_ids(userid, remove=batch)
 
 
 class CachedManager(_CachedManagerBase):
@@ -1063,6 +1292,7 @@ class CachedManager(_CachedManagerBase):
                         if bso.get("ttl") is not None:
                             bso["ttl"] = ttl_base + bso["ttl"]
                         data["items"][bso["id"]] = bso
+                    self._get_expiry_index(data)
                 self.cache.add(key, data)
                 data, casid = self.cache.gets(key)
             except CollectionNotFoundError:
@@ -1134,6 +1364,9 @@ class CachedManager(_CachedManagerBase):
         return self.storage.append_items_to_batch(userid, self.collection,
                                                   batchid, items)
 
+    def get_batch_totals(self, userid, batchid):
+        return self.storage.get_batch_totals(userid, self.collection, batchid)
+
     def apply_batch(self, userid, batchid):
         # Applying the batch will render our cached data inaccurate.
         # Just leave it emptied, and lazily re-populate on next fetch.
@@ -0,0 +1,617 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+In-memory storage backend for SyncStorage.
+
+This backend keeps all data in plain python data structures in the memory
+of the current process.  Nothing is persisted, and nothing is shared with
+other processes.  It is useful for running tests, as a baseline when
+benchmarking, and for deployments whose data can be thrown away on restart.
+
+Each collection keeps its items in a dict keyed by id, along with two
+sorted indexes of the items:
+
+    * by_modified:  (modified, id) pairs, with modified as an integer
+                    number of milliseconds
+    * by_sortindex: (has_sortindex, sortindex, id) triples
+
+Queries sorted by timestamp use bisection on the first index to jump
+straight to the requested range, and queries sorted by sortindex just walk
+the second, so no query ever needs to sort the whole collection.  Offset
+tokens are encoded in the same way as for the SQLStorage backend.
+
+Locking is done with a reentrant lock per user, held for the duration of
+each operation.  lock_for_read() and lock_for_write() both hold it for the
+duration of the with-statement, which gives the required isolation at the
+cost of serializing all access to a single user's data.
+"""
+
+import bisect
+import threading
+import contextlib
+
+import six
+from six.moves import range
+
+from syncstorage.bso import BSO
+from syncstorage.util import get_timestamp
+from syncstorage.storage import (SyncStorage,
+                                 ConflictError,
+                                 CollectionNotFoundError,
+                                 ItemNotFoundError,
+                                 InvalidOffsetError,
+                                 InvalidBatch,
+                                 BATCH_LIFETIME)
+
+
+def ts2bigint(timestamp):
+    return int(timestamp * 1000)
+
+
+def _sortindex_key(item):
+    # Items without a sortindex come last in the descending sort order.
+    return (item["sortindex"] is not None, item["sortindex"], item["id"])
+
+
+class _Collection(object):
+    """The items in a single collection, with their sort indexes."""
+
+    def __init__(self, modified):
+        self.modified = modified
+        self.items = {}
+        self.by_modified = []
+        self.by_sortindex = []
+
+    def get(self, id, ttl):
+        """Get an item by id, or None if it doesn't exist or has expired."""
+        item = self.items.get(id)
+        if item is None or _is_expired(item, ttl):
+            return None
+        return item
+
+    def set(self, data, modified):
+        """Create or update an item, returning True if it was created."""
+        id = data["id"]
+        # Like the SQL backend, this updates an existing item in place even
+        # if it has expired, so that a ttl-only update can revive it.
+        item = self.items.get(id)
+        if item is None:
+            item = {
+                "id": id,
+                "modified": modified,
+                "payload": "",
+                "sortindex": None,
+                "ttl": None,
+            }
+            created = True
+        else:
+            self._unindex(item)
+            created = False
+        if "sortindex" in data:
+            item["sortindex"] = data["sortindex"]
+        if "payload" in data:
+            item["payload"] = data["payload"]
+            item["modified"] = modified
+        # The ttl is given as an offset; make it an absolute time.
+        if "ttl" in data:
+            if data["ttl"] is None:
+                item["ttl"] = None
+            else:
+                item["ttl"] = int(modified) + data["ttl"]
+        self.items[id] = item
+        self._index(item)
+        return created
+
+    def put(self, item):
+        """Store an item as-is, replacing any existing item with that id."""
+        self.delete(item["id"])
+        self.items[item["id"]] = item
+        self._index(item)
+
+    def delete(self, id):
+        """Delete an item, returning it if it existed."""
+        item = self.items.pop(id, None)
+        if item is not None:
+            self._unindex(item)
+        return item
+
+    def _index(self, item):
+        entry = (ts2bigint(item["modified"]), item["id"])
+        bisect.insort(self.by_modified, entry)
+        bisect.insort(self.by_sortindex, _sortindex_key(item))
+
+    def _unindex(self, item):
+        entry = (ts2bigint(item["modified"]), item["id"])
+        del self.by_modified[bisect.bisect_left(self.by_modified, entry)]
+        entry = _sortindex_key(item)
+        del self.by_sortindex[bisect.bisect_left(self.by_sortindex, entry)]
+
+
+class _Batch(object):
+    """The items appended to a pending batch upload."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.items = []
+        self.num_bytes = 0
+
+
+class _UserData(object):
+    """All the data for a single user, and the lock that protects it."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.collections = {}
+        self.batches = {}
+
+
+def _is_expired(item, ttl):
+    return item["ttl"] is not None and item["ttl"] <= ttl
+
+
+class MemoryStorage(SyncStorage):
+    """SyncStorage backend that keeps everything in memory.
+
+    This class takes no configuration; any settings passed to it, e.g.
+    those intended for the views, are ignored.
+    """
+
+    def __init__(self, **kwds):  # pylint: disable=W0613
+        self._users = {}
+        self._users_lock = threading.Lock()
+        # Keep a threadlocal to track the timestamp of the current operation.
+        # This is fixed for the duration of any lock_for_read/lock_for_write.
+        self._tldata = threading.local()
+
+    def _get_user(self, userid):
+        with self._users_lock:
+            try:
+                return self._users[userid]
+            except KeyError:
+                user = self._users[userid] = self._new_user_data(userid)
+                return user
+
+    def _new_user_data(self, userid):
+        return _UserData()
+
+    @contextlib.contextmanager
+    def _locked(self, userid):
+        """Hold the lock on a user's data, fixing the current timestamp.
+
+        The timestamp is taken once the lock has been acquired, and is then
+        available as self._tldata.timestamp until the outermost lock taken
+        by this thread is released.
+        """
+        user = self._get_user(userid)
+        with user.lock:
+            depth = getattr(self._tldata, "depth", 0)
+            if depth == 0:
+                self._tldata.timestamp = get_timestamp()
+            self._tldata.depth = depth + 1
+            try:
+                yield user
+            finally:
+                self._tldata.depth = depth
+
+    #
+    # APIs for collection-level locking.
+    #
+
+    @contextlib.contextmanager
+    def lock_for_read(self, userid, collection):
+        """Acquire a shared read lock on the named collection."""
+        with self._locked(userid):
+            yield None
+
+    @contextlib.contextmanager
+    def lock_for_write(self, userid, collection):
+        """Acquire an exclusive write lock on the named collection."""
+        with self._locked(userid) as user:
+            col = user.collections.get(collection)
+            # Forbid the write if it would not properly incr the timestamp.
+            if col is not None and col.modified >= self._tldata.timestamp:
+                raise ConflictError
+            # There are no transactions to roll back, so remember how big
+            # each pending batch is and undo any appends if the write fails.
+            sizes = dict((batchid, (len(b.items), b.num_bytes))
+                         for batchid, b in six.iteritems(user.batches))
+            try:
+                yield None
+            except Exception:
+                for batchid, (num_items, num_bytes) in six.iteritems(sizes):
+                    batch = user.batches.get(batchid)
+                    if batch is not None:
+                        del batch.items[num_items:]
+                        batch.num_bytes = num_bytes
+                raise
+
+    #
+    # APIs to operate on the entire storage.
+    #
+
+    def get_storage_timestamp(self, userid):
+        """Returns the last-modified timestamp for the entire storage."""
+        with self._locked(userid) as user:
+            return self._get_storage_timestamp(user)
+
+    def _get_storage_timestamp(self, user):
+        timestamps = [col.modified for col in user.collections.itervalues()]
+        return max(timestamps) if timestamps else get_timestamp(0)
+
+    def get_collection_timestamps(self, userid):
+        """Returns the collection timestamps for a user."""
+        with self._locked(userid) as user:
+            return dict((name, col.modified)
+                        for name, col in user.collections.iteritems())
+
+    def get_collection_counts(self, userid):
+        """Returns the collection counts."""
+        with self._locked(userid) as user:
+            ttl = int(self._tldata.timestamp)
+            counts = {}
+            for name, col in user.collections.iteritems():
+                count = sum(1 for item in col.items.itervalues()
+                            if not _is_expired(item, ttl))
+                if count:
+                    counts[name] = count
+            return counts
+
+    def get_collection_sizes(self, userid):
+        """Returns the total size for each collection."""
+        with self._locked(userid) as user:
+            ttl = int(self._tldata.timestamp)
+            sizes = {}
+            for name, col in user.collections.iteritems():
+                items = [item for item in col.items.itervalues()
+                         if not _is_expired(item, ttl)]
+                if items:
+                    sizes[name] = sum(len(item["payload"]) for item in items)
+            return sizes
+
+    def get_total_size(self, userid, recalculate=False):
+        """Returns the total size a user's stored data."""
+        return sum(self.get_collection_sizes(userid).itervalues())
+
+    def delete_storage(self, userid):
+        """Removes all data for the user."""
+        with self._locked(userid) as user:
+            user.collections.clear()
+            user.batches.clear()
+
+    #
+    # APIs to operate on an individual collection
+    #
+
+    def get_collection_timestamp(self, userid, collection):
+        """Returns the last-modified timestamp for the named collection."""
+        with self._locked(userid) as user:
+            return self._get_collection(user, collection).modified
+
+    def _get_collection(self, user, collection):
+        try:
+            return user.collections[collection]
+        except KeyError:
+            raise CollectionNotFoundError
+
+    def _touch_collection(self, user, collection):
+        """Update the last-modified timestamp of the named collection."""
+        ts = self._tldata.timestamp
+        try:
+            col = user.collections[collection]
+        except KeyError:
+            col = user.collections[collection] = _Collection(ts)
+        col.modified = ts
+        return col
+
+    def get_items(self, userid, collection, **params):
+        """Returns items from a collection."""
+        with self._locked(userid) as user:
+            return self._find_items(user, collection, **params)
+
+    def get_item_ids(self, userid, collection, **params):
+        """Returns item ids from a collection."""
+        with self._locked(userid) as user:
+            res = self._find_items(user, collection, **params)
+            res["items"] = [item["id"] for item in res["items"]]
+            return res
+
+    def _find_items(self, user, collection, ids=None, newer=None, older=None,
+                    limit=None, offset=None, sort=None, ttl=None):
+        """Find items matching the given search parameters."""
+        col = self._get_collection(user, collection)
+        timestamp = int(self._tldata.timestamp)
+        if ttl is None:
+            ttl = timestamp
+        params = {"sort": sort}
+        if newer is not None:
+            params["newer"] = ts2bigint(newer)
+        if older is not None:
+            params["older"] = ts2bigint(older)
+        if offset is not None:
+            self.decode_offset(params, offset)
+        # Only a few ids may be requested, so index just those items.
+        if ids is not None:
+            items = (col.items[id] for id in set(ids) if id in col.items)
+            if sort == "index":
+                index = sorted(_sortindex_key(item) for item in items)
+            else:
+                index = sorted((ts2bigint(item["modified"]), item["id"])
+                               for item in items)
+        elif sort == "index":
+            index = col.by_sortindex
+        else:
+            index = col.by_modified
+        # Find the range of the index to scan, and the direction to scan it.
+        lo, hi = 0, len(index)
+        if sort != "index":
+            if "newer" in params:
+                lo = bisect.bisect_left(index, (params["newer"] + 1,))
+            if "newer_eq" in params:
+                lo = max(lo, bisect.bisect_left(index, (params["newer_eq"],)))
+            if "older" in params:
+                hi = bisect.bisect_left(index, (params["older"],))
+            if "older_eq" in params:
+                hi = min(hi, bisect.bisect_left(index,
+                                                (params["older_eq"] + 1,)))
+        if sort == "oldest":
+            positions = range(lo, hi)
+        else:
+            positions = range(hi - 1, lo - 1, -1)
+        # Scan the index, skipping over any offset and fetching one more
+        # item than necessary to tell whether there are any more to fetch.
+        num_to_skip = params.get("offset", 0)
+        items = []
+        for pos in positions:
+            item = col.items[index[pos][-1]]
+            if _is_expired(item, ttl):
+                continue
+            if sort == "index":
+                modified = ts2bigint(item["modified"])
+                if modified <= params.get("newer", modified - 1):
+                    continue
+                if modified >= params.get("older", modified + 1):
+                    continue
+            if num_to_skip > 0:
+                num_to_skip -= 1
+                continue
+            items.append(self._item_to_bso(item, timestamp))
+            if limit is not None and len(items) > limit:
+                break
+        # Check if we read past the limit, set next_offset if so.
+        next_offset = None
+        if limit is not None and len(items) > limit:
+            items = items[:-1]
+            next_offset = self.encode_next_offset(params, items)
+        return {
+            "items": items,
+            "next_offset": next_offset,
+        }
+
+    def _item_to_bso(self, item, timestamp):
+        """Convert a stored item into a BSO object."""
+        bso = BSO(item)
+        # Convert the ttl back into an offset from the current time.
+        if "ttl" in bso:
+            bso["ttl"] -= timestamp
+        return bso
+
+    def encode_next_offset(self, params, items):
+        """Encode an "offset token" for resuming query at the given item.
+
+        This uses the same format as SQLStorage.encode_next_offset(), so see
+        there for the details.
+        """
+        sort = params.get("sort", None)
+        # Use a simple numeric offset for sortindex ordering.
+        if sort == "index":
+            return str(params.get("offset", 0) + len(items))
+        # Find an appropriate upper bound for faster timestamp ordering.
+        bound = items[-1]["modified"]
+        bound_as_bigint = ts2bigint(bound)
+        # Count how many previous items have that same timestamp, and hence
+        # will need to be skipped over.
+        offset = 1
+        i = len(items) - 2
+        while i >= 0 and items[i]["modified"] == bound:
+            offset += 1
+            i -= 1
+        # If all items in this batch have the same timestamp, we may also need
+        # to skip some items from the previous batch.
+        if i < 0:
+            if sort == "oldest":
+                prev_bound = params.get("newer_eq", None)
+            else:
+                prev_bound = params.get("older_eq", None)
+            if prev_bound == bound_as_bigint:
+                offset += params["offset"]
+        # Encode them as a simple pair of integers.
+        return "%d:%d" % (bound_as_bigint, offset)
+
+    def decode_offset(self, params, offset):
+        """Decode an "offset token" into appropriate query parameters.
+
+        This uses the same format as SQLStorage.decode_offset(), so see
+        there for the details.
+        """
+        sort = params.get("sort", None)
+        try:
+            if sort == "index":
+                # When sorting by sortindex, it's just a numeric offset.
+                params["offset"] = int(offset)
+            else:
+                # When sorting by timestamp, it's a (bound, offset) pair.
+                bound, offset = map(int, offset.split(":", 1))
+                # Queries with "newer" should always produce bound > newer
+                if bound < params.get("newer", bound):
+                    raise InvalidOffsetError(offset)
+                # Queries with "older" should always produce bound < older
+                if bound > params.get("older", bound):
+                    raise InvalidOffsetError(offset)
+                # The bound determines the starting point of the sort order.
+                params["offset"] = offset
+                if sort == "oldest":
+                    params["newer_eq"] = int(bound)
+                else:
+                    params["older_eq"] = int(bound)
+        except ValueError:
+            raise InvalidOffsetError(offset)
+
+    def set_items(self, userid, collection, items):
+        """Creates or updates multiple items in a collection."""
+        with self._locked(userid) as user:
+            col = self._touch_collection(user, collection)
+            for data in items:
+                col.set(data, col.modified)
+            return col.modified
+
+    def delete_collection(self, userid, collection):
+        """Deletes an entire collection."""
+        with self._locked(userid) as user:
+            self._get_collection(user, collection)
+            del user.collections[collection]
+            return self._get_storage_timestamp(user)
+
+    def delete_items(self, userid, collection, items):
+        """Deletes multiple items from a collection."""
+        with self._locked(userid) as user:
+            self._get_collection(user, collection)
+            col = self._touch_collection(user, collection)
+            for id in items:
+                col.delete(id)
+            return col.modified
+
+    def create_batch(self, userid, collection):
+        """Creates a batch for multi-POST batch uploads."""
+        with self._locked(userid) as user:
+            # Like SQLStorage, mix the lowest digit of the userid into
+            # the millisecond timestamp.
+            batchid = ts2bigint(self._tldata.timestamp) + (userid % 10)
+            if batchid in user.batches:
+                raise ConflictError
+            user.batches[batchid] = _Batch(collection)
+            return batchid
+
+    def valid_batch(self, userid, collection, batchid):
+        """Checks to see if the batch ID is valid and still open."""
+        with self._locked(userid) as user:
+            if self._get_batch(user, collection, batchid) is None:
+                return False
+            return batchid
+
+    def _get_batch(self, user, collection, batchid):
+        """Get an open batch, or None if it doesn't exist or has expired."""
+        # Recall that the batchid is a millisecond timestamp.
+        if (batchid / 1000 + BATCH_LIFETIME) < self._tldata.timestamp:
+            return None
+        batch = user.batches.get(batchid)
+        if batch is None or batch.collection != collection:
+            return None
+        return batch
+
+    def append_items_to_batch(self, userid, collection, batchid, items):
+        """Appends items to the pending batch."""
+        with self._locked(userid) as user:
+            batch = self._get_batch(user, collection, batchid)
+            if batch is None:
+                raise InvalidBatch(batchid)
+            batch.items.extend(dict(data) for data in items)
+            batch.num_bytes += sum(len(data.get("payload", ""))
+                                   for data in items)
+            return self._tldata.timestamp
+
+    def get_batch_totals(self, userid, collection, batchid):
+        """Returns the number of records and bytes appended to a batch."""
+        with self._locked(userid) as user:
+            batch = self._get_batch(user, collection, batchid)
+            if batch is None:
+                return None
+            return (len(batch.items), batch.num_bytes)
+
+    def apply_batch(self, userid, collection, batchid):
+        """Applies the pending batch."""
+        with self._locked(userid) as user:
+            batch = self._get_batch(user, collection, batchid)
+            if batch is None:
+                raise InvalidBatch(batchid)
+            return self.set_items(userid, collection, batch.items)
+
+    def close_batch(self, userid, collection, batchid):
+        """Close a specific batch."""
+        with self._locked(userid) as user:
+            user.batches.pop(batchid, None)
+
+    #
+    # Items APIs
+    #
+
+    def get_item_timestamp(self, userid, collection, item):
+        """Returns the last-modified timestamp for the named item."""
+        return self.get_item(userid, collection, item)["modified"]
+
+    def get_item(self, userid, collection, item):
+        """Returns one item from a collection."""
+        with self._locked(userid) as user:
+            col = self._get_collection(user, collection)
+            timestamp = int(self._tldata.timestamp)
+            found = col.get(item, timestamp)
+            if found is None:
+                raise ItemNotFoundError
+            return self._item_to_bso(found, timestamp)
+
+    def set_item(self, userid, collection, item, data):
+        """Creates or updates a single item in a collection."""
+        with self._locked(userid) as user:
+            col = self._touch_collection(user, collection)
+            data = dict(data)
+            data["id"] = item
+            return {
+                "created": col.set(data, col.modified),
+                "modified": col.modified,
+            }
+
+    def delete_item(self, userid, collection, item):
+        """Deletes a single item from a collection."""
+        with self._locked(userid) as user:
+            col = self._get_collection(user, collection)
+            if col.get(item, int(self._tldata.timestamp)) is None:
+                raise ItemNotFoundError
+            col = self._touch_collection(user, collection)
+            col.delete(item)
+            return col.modified
+
+    #
+    # Administrative/maintenance methods.
+    #
+
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000):
+        """Purges items with an expired TTL from memory."""
+        with self._users_lock:
+            userids = list(self._users)
+        num_purged = 0
+        for userid in userids:
+            with self._locked(userid) as user:
+                num_purged += self._purge_user_data(user, grace_period)
+        return {
+            "num_purged": num_purged,
+            "is_complete": True,
+        }
+
+    def _purge_user_data(self, user, grace_period):
+        """Purge expired items and batches of a locked user.
+
+        This returns the number of items that were purged.
+        """
+        num_purged = 0
+        ttl = int(self._tldata.timestamp) - grace_period
+        for col in user.collections.itervalues():
+            expired = [item["id"] for item in col.items.itervalues()
+                       if _is_expired(item, ttl)]
+            for id in expired:
+                col.delete(id)
+            num_purged += len(expired)
+        for batchid in list(user.batches):
+            expiry = batchid / 1000 + BATCH_LIFETIME + grace_period
+            if expiry < self._tldata.timestamp:
+                del user.batches[batchid]
+        return num_purged
@@ -0,0 +1,600 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Embedded storage backend for SyncStorage, using append-only segment files.
+
+This backend is meant for small single-node deployments.  It keeps the
+same in-memory indexes as the MemoryStorage backend, but persists every
+change to a log of append-only "segment" files in a directory per user:
+
+    <path>/<userid>/00000001.seg
+    <path>/<userid>/00000002.seg
+    ...
+
+Since each user has their own lock and their own files, writers for
+different users never wait on each other.  Item payloads are not kept in
+memory; the index refers to where they are stored in a segment file, and
+they are read straight out of a memory-mapping of that file when needed.
+The mappings are closed when the user's lock is released, so the number
+of open files is bounded by the number of users being served at once
+rather than growing with the number of users whose data is loaded.
+
+All the changes made while holding a user's lock are written out as a
+single record when the lock is released.  If it is released with an error,
+or the record can't be written, the changes are discarded and the user's
+data is loaded again from their segments.  Each record looks like this:
+
+    * a header of three unsigned 32-bit ints giving the length of the
+      metadata, the length of the payload data and a crc32 of both
+    * the metadata, a JSON list of operations to apply to the user's data
+    * the payload data, all the payloads of the operations concatenated
+
+A user's data is loaded by replaying all the records of their segments, in
+order.  If the server crashes while writing a record then it will be left
+incomplete, or fail its checksum, and it will be truncated from the file
+when the data is next loaded.  The previous records are unaffected.
+
+A new segment is started whenever the current one grows bigger than
+the "segment_size" setting.  Old records are only reclaimed when running
+purge_expired_items(), which writes a snapshot of all the live data into a
+fresh segment and then deletes the older segments.  The snapshot starts by
+resetting all the data, so a crash before the old segments are deleted
+does no harm.
+"""
+
+import os
+import sys
+import mmap
+import zlib
+import errno
+import shutil
+import struct
+import logging
+import contextlib
+
+import six
+
+from syncstorage.util import json_dumps, json_loads
+from syncstorage.storage.memory import (MemoryStorage,
+                                        _Batch,
+                                        _Collection,
+                                        _UserData)
+
+
+logger = logging.getLogger("syncstorage.storage.segment")
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+_HEADER = struct.Struct("!III")
+
+_SEGMENT_SUFFIX = ".seg"
+
+
+class _Segment(object):
+    """A single segment file, which is mapped into memory for reading."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.size = os.path.getsize(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.size = 0
+        # Set if a failed append may have left bytes that couldn't be
+        # removed, after which nothing more can be written to the file.
+        self.retired = False
+        self._mmap = None
+
+    def read(self, offset, size):
+        """Read bytes from the file, remapping it if it has grown."""
+        if self._mmap is None or len(self._mmap) < offset + size:
+            self.close()
+            with open(self.filename, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset:offset + size]
+
+    def append(self, data, fsync):
+        """Append bytes to the file, returning the offset they were written.
+
+        If the write fails then any part of it that made it into the file
+        is truncated away, so the next record isn't written after a torn
+        one.  If even that fails then the segment is retired.
+        """
+        offset = self.size
+        try:
+            with open(self.filename, "ab") as f:
+                f.write(data)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+        except Exception:
+            exc_info = sys.exc_info()
+            try:
+                self.truncate(offset)
+            except EnvironmentError:
+                logger.exception("Could not truncate %s", self.filename)
+                self.retired = True
+            six.reraise(*exc_info)
+        self.size += len(data)
+        return offset
+
+    def truncate(self, size):
+        """Truncate the file, discarding any bytes after the given size."""
+        self.close()
+        with open(self.filename, "r+b") as f:
+            f.truncate(size)
+        self.size = size
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class _Payload(object):
+    """A reference to a payload stored in a segment file.
+
+    Its len() is that of the payload string, so it can be counted towards
+    the collection sizes without reading it.
+    """
+
+    __slots__ = ("segment", "offset", "size", "length")
+
+    def __init__(self, segment, offset, size, length):
+        self.segment = segment
+        self.offset = offset
+        self.size = size
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read_bytes(self):
+        return self.segment.read(self.offset, self.size)
+
+    def read(self):
+        return self.read_bytes().decode("utf8")
+
+
+class _SegmentUserData(_UserData):
+    """All the data for a single user, along with their segment files."""
+
+    def __init__(self, userid):
+        super(_SegmentUserData, self).__init__()
+        self.userid = userid
+        # The segments are only found when the user is first locked.
+        self.segments = None
+        # Operations waiting to be written out when the lock is released.
+        self.pending = []
+        # Whether the data in memory has been changed under the lock.
+        self.dirty = False
+
+
+def _encode_record(ops):
+    """Encode a list of operations into a record for a segment file.
+
+    This returns the bytes of the record along with a list of the items
+    whose payloads it contains, and the position of those payloads within
+    the record, so that they can be pointed at it once written.
+    """
+    chunks = []
+    payloads = []
+    # Track the position of each payload in the payload data.
+    position = [0]
+
+    def encode_item(item):
+        data = dict(item)
+        if "payload" in data:
+            payload = data.pop("payload")
+            if isinstance(payload, _Payload):
+                raw = payload.read_bytes()
+            elif isinstance(payload, six.text_type):
+                raw = payload.encode("utf8")
+            else:
+                raw = payload
+            data["payload"] = [position[0], len(raw), len(payload)]
+            payloads.append((item, position[0], len(raw), len(payload)))
+            chunks.append(raw)
+            position[0] += len(raw)
+        return data
+
+    meta = []
+    for op in ops:
+        if "items" in op:
+            op = dict(op)
+            op["items"] = [encode_item(item) for item in op["items"]]
+        meta.append(op)
+    meta = json_dumps(meta)
+    if isinstance(meta, six.text_type):
+        meta = meta.encode("utf8")
+    body = meta + b"".join(chunks)
+    crc = zlib.crc32(body) & 0xffffffff
+    header = _HEADER.pack(len(meta), len(body) - len(meta), crc)
+    # Make the payload positions relative to the start of the record.
+    base = _HEADER.size + len(meta)
+    payloads = [(item, base + pos, size, length)
+                for (item, pos, size, length) in payloads]
+    return header + body, payloads
+
+
+def _decode_item(data, segment, base):
+    """Decode an item from a record, referring to its stored payload."""
+    item = dict(data)
+    if "payload" in item:
+        pos, size, length = item["payload"]
+        item["payload"] = _Payload(segment, base + pos, size, length)
+    return item
+
+
+def _apply_op(user, op, segment, base):
+    """Apply an operation read from a segment to a user's data."""
+    kind = op["op"]
+    if kind == "reset":
+        user.collections.clear()
+        user.batches.clear()
+    elif kind == "set":
+        col = user.collections.get(op["collection"])
+        if col is None:
+            col = _Collection(op["modified"])
+            user.collections[op["collection"]] = col
+        col.modified = op["modified"]
+        for data in op["items"]:
+            col.put(_decode_item(data, segment, base))
+    elif kind == "delete":
+        col = user.collections.get(op["collection"])
+        if col is not None:
+            col.modified = op["modified"]
+            for id in op["ids"]:
+                col.delete(id)
+    elif kind == "drop":
+        user.collections.pop(op["collection"], None)
+    elif kind == "batch":
+        user.batches[op["batch"]] = _Batch(op["collection"])
+    elif kind == "append":
+        batch = user.batches.get(op["batch"])
+        if batch is not None:
+            for data in op["items"]:
+                item = _decode_item(data, segment, base)
+                batch.items.append(item)
+                batch.num_bytes += len(item.get("payload", ""))
+    elif kind == "close":
+        user.batches.pop(op["batch"], None)
+    else:
+        raise ValueError("unknown segment operation: %r" % (kind,))
+
+
+class SegmentStorage(MemoryStorage):
+    """SyncStorage backend that stores data in append-only segment files.
+
+    The required setting "path" gives the directory in which to store the
+    data.  Other settings are:
+
+        * segment_size:  the size in bytes at which to start a new segment
+        * fsync:  whether to fsync each record as it is written; this
+                  defaults to True, and without it a record may be lost
+                  in a power failure, though never partially applied.
+
+    """
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE, fsync=True,
+                 **kwds):
+        super(SegmentStorage, self).__init__(**kwds)
+        self.path = path
+        self.segment_size = int(segment_size)
+        self.fsync = fsync
+
+    def _new_user_data(self, userid):
+        return _SegmentUserData(userid)
+
+    def _get_user_dir(self, userid):
+        return os.path.join(self.path, str(userid))
+
+    @contextlib.contextmanager
+    def _locked(self, userid):
+        """Hold the lock on a user's data, loading it if necessary.
+
+        Any changes made while the outermost lock is held are written out
+        as a single record when it is released.  If it is released with an
+        error, or the record can't be written, then the changes that were
+        made in memory are thrown away by loading the data again from disk.
+        Either way, any segments that were mapped for reading are unmapped.
+        """
+        with super(SegmentStorage, self)._locked(userid) as user:
+            if self._tldata.depth > 1:
+                yield user
+                return
+            try:
+                if user.segments is None:
+                    self._load_user_data(user)
+                try:
+                    yield user
+                    self._write_pending(user)
+                except Exception:
+                    if user.dirty or user.pending:
+                        self._reload_user_data(user)
+                    raise
+            finally:
+                for segment in user.segments or ():
+                    segment.close()
+
+    @contextlib.contextmanager
+    def _changing(self, userid):
+        """Hold the lock on a user's data in order to change it."""
+        with self._locked(userid) as user:
+            user.dirty = True
+            yield user
+
+    def _reload_user_data(self, user):
+        """Throw away a user's data in memory and load it again from disk."""
+        del user.pending[:]
+        retired = set()
+        for segment in user.segments:
+            segment.close()
+            if segment.retired:
+                retired.add(segment.filename)
+        # If loading fails, it's tried again when the user is next locked.
+        user.segments = None
+        self._load_user_data(user)
+        for segment in user.segments:
+            segment.retired = segment.filename in retired
+
+    def _load_user_data(self, user):
+        """Load a user's data by replaying their segments in order."""
+        user.collections.clear()
+        user.batches.clear()
+        user.dirty = False
+        dirname = self._get_user_dir(user.userid)
+        try:
+            names = os.listdir(dirname)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+        segments = []
+        for name in sorted(names):
+            if name.endswith(_SEGMENT_SUFFIX):
+                segment = _Segment(os.path.join(dirname, name))
+                self._replay_segment(user, segment)
+                segments.append(segment)
+        user.segments = segments
+
+    def _replay_segment(self, user, segment):
+        """Apply all the records in a segment to a user's data.
+
+        Replay stops at the first incomplete or corrupted record, which can
+        only be left by a crash while writing, and it is truncated away.
+        """
+        offset = 0
+        while offset + _HEADER.size <= segment.size:
+            header = segment.read(offset, _HEADER.size)
+            meta_size, data_size, crc = _HEADER.unpack(header)
+            body_size = meta_size + data_size
+            if offset + _HEADER.size + body_size > segment.size:
+                break
+            body = segment.read(offset + _HEADER.size, body_size)
+            if zlib.crc32(body) & 0xffffffff != crc:
+                break
+            base = offset + _HEADER.size + meta_size
+            for op in json_loads(body[:meta_size].decode("utf8")):
+                _apply_op(user, op, segment, base)
+            offset += _HEADER.size + body_size
+        if offset < segment.size:
+            logger.warning("Truncating %d bytes of incomplete data from %s",
+                           segment.size - offset, segment.filename)
+            segment.truncate(offset)
+
+    def _write_pending(self, user):
+        """Write out the pending operations of a user as a single record."""
+        if not user.pending:
+            return
+        record, payloads = _encode_record(user.pending)
+        segment = None
+        if user.segments and not user.segments[-1].retired and \
+                user.segments[-1].size < self.segment_size:
+            segment = user.segments[-1]
+        else:
+            segment = self._new_segment(user)
+        offset = segment.append(record, self.fsync)
+        del user.pending[:]
+        user.dirty = False
+        # The payloads can now be dropped from memory.
+        for item, pos, size, length in payloads:
+            item["payload"] = _Payload(segment, offset + pos, size, length)
+
+    def _new_segment(self, user):
+        """Start a new segment file for a user."""
+        dirname = self._get_user_dir(user.userid)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if user.segments:
+            last_name = os.path.basename(user.segments[-1].filename)
+            seqno = int(last_name[:-len(_SEGMENT_SUFFIX)]) + 1
+        else:
+            seqno = 1
+        name = "%08d%s" % (seqno, _SEGMENT_SUFFIX)
+        segment = _Segment(os.path.join(dirname, name))
+        user.segments.append(segment)
+        return segment
+
+    def _compact(self, user):
+        """Rewrite all the live data of a user into a single new segment."""
+        ops = [{"op": "reset"}]
+        for name, col in six.iteritems(user.collections):
+            ops.append({
+                "op": "set",
+                "collection": name,
+                "modified": col.modified,
+                "items": list(col.items.itervalues()),
+            })
+        for batchid, batch in six.iteritems(user.batches):
+            ops.append({
+                "op": "batch",
+                "batch": batchid,
+                "collection": batch.collection,
+            })
+            ops.append({
+                "op": "append",
+                "batch": batchid,
+                "items": batch.items,
+            })
+        old_segments = list(user.segments)
+        if len(ops) == 1:
+            # There's nothing left, so just remove all the files.
+            user.segments = []
+            self._remove_segments(user, old_segments)
+            return
+        user.pending = ops
+        self._new_segment(user)
+        self._write_pending(user)
+        user.segments = user.segments[-1:]
+        self._remove_segments(user, old_segments)
+
+    def _remove_segments(self, user, segments):
+        for segment in segments:
+            segment.close()
+            os.unlink(segment.filename)
+        if not user.segments:
+            shutil.rmtree(self._get_user_dir(user.userid), ignore_errors=True)
+
+    def _item_to_bso(self, item, timestamp):
+        """Convert a stored item into a BSO object, reading its payload."""
+        if isinstance(item["payload"], _Payload):
+            item = dict(item, payload=item["payload"].read())
+        return super(SegmentStorage, self)._item_to_bso(item, timestamp)
+
+    #
+    # Each change to the data is recorded as an operation to be written
+    # out when the lock is released.  Operations on items refer to the
+    # item objects themselves, so they record their final state.
+    #
+
+    def delete_storage(self, userid):
+        """Removes all data for the user."""
+        with self._changing(userid) as user:
+            super(SegmentStorage, self).delete_storage(userid)
+            del user.pending[:]
+            old_segments = user.segments
+            user.segments = []
+            self._remove_segments(user, old_segments)
+
+    def set_items(self, userid, collection, items):
+        """Creates or updates multiple items in a collection."""
+        with self._changing(userid) as user:
+            res = super(SegmentStorage, self).set_items(userid, collection,
+                                                        items)
+            self._log_set(user, collection, [data["id"] for data in items])
+            return res
+
+    def set_item(self, userid, collection, item, data):
+        """Creates or updates a single item in a collection."""
+        with self._changing(userid) as user:
+            res = super(SegmentStorage, self).set_item(userid, collection,
+                                                       item, data)
+            self._log_set(user, collection, [item])
+            return res
+
+    def _log_set(self, user, collection, ids):
+        col = user.collections[collection]
+        user.pending.append({
+            "op": "set",
+            "collection": collection,
+            "modified": col.modified,
+            "items": [col.items[id] for id in ids],
+        })
+
+    def delete_collection(self, userid, collection):
+        """Deletes an entire collection."""
+        with self._changing(userid) as user:
+            res = super(SegmentStorage, self).delete_collection(userid,
+                                                                collection)
+            user.pending.append({"op": "drop", "collection": collection})
+            return res
+
+    def delete_items(self, userid, collection, items):
+        """Deletes multiple items from a collection."""
+        with self._changing(userid) as user:
+            res = super(SegmentStorage, self).delete_items(userid,
+                                                           collection, items)
+            self._log_delete(user, collection, items)
+            return res
+
+    def delete_item(self, userid, collection, item):
+        """Deletes a single item from a collection."""
+        with self._changing(userid) as user:
+            res = super(SegmentStorage, self).delete_item(userid,
+                                                          collection, item)
+            self._log_delete(user, collection, [item])
+            return res
+
+    def _log_delete(self, user, collection, ids):
+        user.pending.append({
+            "op": "delete",
+            "collection": collection,
+            "modified": user.collections[collection].modified,
+            "ids": list(ids),
+        })
+
+    def create_batch(self, userid, collection):
+        """Creates a batch for multi-POST batch uploads."""
+        with self._changing(userid) as user:
+            batchid = super(SegmentStorage, self).create_batch(userid,
+                                                               collection)
+            user.pending.append({
+                "op": "batch",
+                "batch": batchid,
+                "collection": collection,
+            })
+            return batchid
+
+    def append_items_to_batch(self, userid, collection, batchid, items):
+        """Appends items to the pending batch."""
+        with self._changing(userid) as user:
+            batch = self._get_batch(user, collection, batchid)
+            num_items = len(batch.items) if batch is not None else 0
+            res = super(SegmentStorage, self).append_items_to_batch(
+                userid, collection, batchid, items)
+            user.pending.append({
+                "op": "append",
+                "batch": batchid,
+                "items": batch.items[num_items:],
+            })
+            return res
+
+    def close_batch(self, userid, collection, batchid):
+        """Close a specific batch."""
+        with self._changing(userid) as user:
+            super(SegmentStorage, self).close_batch(userid, collection,
+                                                    batchid)
+            user.pending.append({"op": "close", "batch": batchid})
+
+    #
+    # Administrative/maintenance methods.
+    #
+
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000):
+        """Purges expired items, and compacts the segment files.
+
+        Each user whose data changed, or who has more than one segment, has
+        their data rewritten into a single new segment.
+        """
+        userids = set()
+        with self._users_lock:
+            userids.update(self._users)
+        if os.path.isdir(self.path):
+            userids.update(int(name) for name in os.listdir(self.path)
+                           if name.isdigit())
+        num_purged = 0
+        for userid in sorted(userids):
+            with self._changing(userid) as user:
+                num_batches = len(user.batches)
+                purged = self._purge_user_data(user, grace_period)
+                num_purged += purged
+                if purged or num_batches != len(user.batches) or \
+                   len(user.segments) > 1:
+                    self._compact(user)
+        return {
+            "num_purged": num_purged,
+            "is_complete": True,
+        }
@@ -17,21 +17,25 @@ sharding of the BSO items into multiple tables named "bso0" through "bsoN".
 This behaviour is off by default; pass shard=True to enable it.
 """
 
+import sys
+import time
 import logging
 import functools
 import threading
 import contextlib
+import timeit
 from collections import defaultdict
 
 from sqlalchemy.exc import IntegrityError
 
 from syncstorage.bso import BSO
-from syncstorage.util import get_timestamp
+from syncstorage.util import get_timestamp, profile_phase, LRUCache
 from syncstorage.storage import (SyncStorage,
                                  ConflictError,
                                  CollectionNotFoundError,
                                  ItemNotFoundError,
                                  InvalidOffsetError,
+                                 InvalidBatch,
                                  BATCH_LIFETIME)
 
 from syncstorage.storage.sql.dbconnect import (DBConnector, MAX_TTL,
@@ -39,6 +43,7 @@ from syncstorage.storage.sql.dbconnect import (DBConnector, MAX_TTL,
 
 from mozsvc.metrics import metrics_timer
 
+import six
 from six.moves import range
 
 logger = logging.getLogger("syncstorage.storage.sql")  # pylint: disable=C0103
@@ -55,6 +60,22 @@ FIRST_CUSTOM_COLLECTION_ID = 100
 
 MAX_COLLECTIONS_CACHE_SIZE = 1000
 
+# Number of recently-seen open batches to remember, so that each POST to
+# a batch doesn't have to look it up in the db again.
+DEFAULT_BATCH_CACHE_SIZE = 10000
+
+# Number of (userid, collection) pairs to remember as not existing, when
+# the absent_collections_ttl option is enabled.
+DEFAULT_ABSENT_COLLECTIONS_CACHE_SIZE = 10000
+
+# Placeholder for a collection tombstone that has not been looked up yet.
+UNKNOWN_TOMBSTONE = object()
+
+# Longer lists of ids are split into chunks of this size, to keep the
+# queries that use them to a reasonable length.  It should be a power of two
+# so that the chunks fill up their padded lists of ids exactly.
+MAX_IDS_PER_QUERY = 128
+
 
 def ts2bigint(timestamp):
     return int(timestamp * 1000)
@@ -64,6 +85,12 @@ def bigint2ts(bigint):
     return get_timestamp(bigint / 1000.0)
 
 
+def chunked(items, size=MAX_IDS_PER_QUERY):
+    """Split a list of items into a sequence of lists of the given size."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def convert_db_errors(func):
     """Method decorator to convert db errors into app-level errors.
 
@@ -118,13 +145,79 @@ class SQLStorage(SyncStorage):
         * create_tables:         create the database tables if they don't
                                  exist at startup
         * shard/shardsize:       enable sharding of the BSO table
+        * group_commit_window:   merge write transactions that start within
+                                 this many seconds into a single db commit;
+                                 this needs savepoints and NOWAIT locks, so
+                                 MySQL 8.0 or PostgreSQL 9.5 and later
+        * async_deletes:         tombstone deleted collections and purge
+                                 their items later, in purge_expired_items
+        * async_delete_worker:   also purge them from a background thread
+                                 in this process; enable it in one process
+                                 only, so that workers don't all compete
+        * batch_commit_chunk_size:  apply committed batches this many items
+                                    at a time, rather than all at once
+        * batch_cache_size:      number of open batches to remember between
+                                 requests; zero disables the cache
+        * absent_collections_ttl:  remember collections found not to exist
+                                   for this many seconds, and answer reads
+                                   of them without querying the db
+        * preload_collections:   load all collection names into memory at
+                                 startup, rather than as they are first used
+        * track_batch_totals:    keep running totals of each batch in the
+                                 total_records and total_bytes columns of
+                                 batch_uploads, so that the total size
+                                 limits of a batch are enforced without
+                                 trusting what the client reports
 
     """
 
-    def __init__(self, sqluri, standard_collections=False, **dbkwds):
+    def __init__(self, sqluri, standard_collections=False,
+                 group_commit_window=None, group_commit_max_size=20,
+                 async_delete_worker=False, batch_commit_chunk_size=None,
+                 batch_cache_size=None, absent_collections_ttl=None,
+                 preload_collections=False,
+                 track_batch_totals=False, **dbkwds):
 
         self.sqluri = sqluri
         self.dbconnector = DBConnector(sqluri, **dbkwds)
+        self.async_deletes = self.dbconnector.async_deletes
+        if self.async_deletes and async_delete_worker:
+            self.tombstone_reaper = TombstoneReaper(self)
+        else:
+            self.tombstone_reaper = None
+        # Databases created before the totals columns were added to
+        # batch_uploads must have them added before enabling this.
+        self.track_batch_totals = track_batch_totals
+        if batch_commit_chunk_size:
+            self.batch_commit_chunk_size = int(batch_commit_chunk_size)
+        else:
+            self.batch_commit_chunk_size = None
+        if batch_cache_size is None:
+            batch_cache_size = DEFAULT_BATCH_CACHE_SIZE
+        self.batch_cache = LRUCache(int(batch_cache_size))
+        # Writes made by other processes can't invalidate this cache,
+        # so it is only enabled if some staleness can be tolerated.
+        if absent_collections_ttl:
+            self.absent_collections_ttl = float(absent_collections_ttl)
+            self.absent_collections = \
+                LRUCache(DEFAULT_ABSENT_COLLECTIONS_CACHE_SIZE)
+        else:
+            self.absent_collections_ttl = None
+            self.absent_collections = None
+        self._can_upsert_collection = \
+            self.dbconnector.get_query("UPSERT_COLLECTION", {}) is not None
+
+        if group_commit_window:
+            # Each member of a group needs a savepoint of its own, so that
+            # it can fail without failing the other members.
+            if self.dbconnector.get_query("SAVEPOINT_GROUP_MEMBER",
+                                          {}) is None:
+                msg = "group commit is not supported by the %s driver"
+                raise ValueError(msg % (self.dbconnector.driver,))
+            self.group_committer = GroupCommitter(float(group_commit_window),
+                                                  int(group_commit_max_size))
+        else:
+            self.group_committer = None
 
         # There doesn't seem to be a reliable cross-database way to set the
         # initial value of an autoincrement column.
@@ -149,11 +242,28 @@ class SQLStorage(SyncStorage):
         # A thread-local to track active sessions.
         self._tldata = threading.local()
 
-    def _get_or_create_session(self):
-        """Get an existing session if one exists, or start a new one if not."""
+        # Under gunicorn with preload_app, this happens before forking
+        # and so all the workers start out with a warm cache.
+        if preload_collections:
+            self._load_all_collection_names()
+            # Close the connection it used, or every forked worker would
+            # inherit it in their pool and share the same socket.  That's
+            # not possible for an in-memory sqlite db, which would be lost.
+            if self.dbconnector.engine.url.database not in (None, "",
+                                                            ":memory:"):
+                self.dbconnector.engine.dispose()
+
+    def _get_or_create_session(self, for_write=False):
+        """Get an existing session if one exists, or start a new one if not.
+
+        New sessions that are started in order to write will share their
+        commit with other writers if group commit is enabled.
+        """
         try:
             return self._tldata.session
         except AttributeError:
+            if for_write and self.group_committer is not None:
+                return SQLStorageSession(self, committer=self.group_committer)
             return SQLStorageSession(self)
 
     #
@@ -190,13 +300,21 @@ class SQLStorage(SyncStorage):
             if (userid, collectionid) in session.locked_collections:
                 yield None
                 return
-            # Begin a transaction and take a lock in the database.
-            params = {"userid": userid, "collectionid": collectionid}
-            session.query("BEGIN_TRANSACTION_READ")
-            ts = session.query_scalar("LOCK_COLLECTION_READ", params)
-            if ts is not None:
-                ts = bigint2ts(ts)
-                session.cache[(userid, collectionid)].last_modified = ts
+            cached = session.cache[(userid, collectionid)]
+            if self._is_known_absent(userid, collectionid):
+                # There's nothing to read, so there's nothing to lock.
+                cached.exists = False
+            else:
+                # Begin a transaction and take a lock in the database.
+                params = {"userid": userid, "collectionid": collectionid}
+                with profile_phase("lock"):
+                    session.query("BEGIN_TRANSACTION_READ")
+                    ts = session.query_scalar("LOCK_COLLECTION_READ", params)
+                cached.exists = ts is not None
+                if ts is not None:
+                    cached.last_modified = bigint2ts(ts)
+                elif collectionid:
+                    self._remember_absent(userid, collectionid)
             session.locked_collections[(userid, collectionid)] = 0
             try:
                 # Yield context back to the calling code.
@@ -210,20 +328,35 @@ class SQLStorage(SyncStorage):
     @contextlib.contextmanager
     def lock_for_write(self, userid, collection):
         """Acquire an exclusive write lock on the named collection."""
-        with self._get_or_create_session() as session:
+        with self._get_or_create_session(for_write=True) as session:
             collectionid = self._get_collection_id(session, collection, True)
             locked = session.locked_collections.get((userid, collectionid))
             if locked == 0:
                 raise RuntimeError("Can't escalate read-lock to write-lock")
             params = {"userid": userid, "collectionid": collectionid}
-            session.query("BEGIN_TRANSACTION_WRITE")
-            ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
+            with profile_phase("lock"):
+                if session.group is None:
+                    session.query("BEGIN_TRANSACTION_WRITE")
+                    ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
+                elif session is session.group.leader:
+                    ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
+                else:
+                    # The shared transaction holds the locks of the members
+                    # before this one, and so must not wait for any more,
+                    # or it could deadlock with other processes.  If the
+                    # lock is taken then this fails with a ConflictError.
+                    ts = session.query_scalar("LOCK_COLLECTION_WRITE_NOWAIT",
+                                              params)
             if ts is not None:
                 ts = bigint2ts(ts)
                 # Forbid the write if it would not properly incr the timestamp.
                 if ts >= session.timestamp:
                     raise ConflictError
-                session.cache[(userid, collectionid)].last_modified = ts
+            # Remember what the lock told us about the collection's row,
+            # so that it doesn't have to be looked up again when writing.
+            cached = session.cache[(userid, collectionid)]
+            cached.exists = ts is not None
+            cached.last_modified = ts
             session.locked_collections[(userid, collectionid)] = 1
             try:
                 # Yield context back to the calling code.
@@ -290,12 +423,28 @@ class SQLStorage(SyncStorage):
     @with_session
     def delete_storage(self, session, userid):
         """Removes all data for the user."""
-        session.query("DELETE_ALL_BSOS", {
-            "userid": userid,
-        })
+        if not self.async_deletes:
+            session.query("DELETE_ALL_BSOS", {
+                "userid": userid,
+            })
+        else:
+            # Tombstone every collection, including any that are
+            # already tombstoned, rather than deleting the items.
+            params = {
+                "userid": userid,
+                "modified": ts2bigint(session.timestamp),
+            }
+            session.query("UPDATE_ALL_TOMBSTONES", params)
+            session.query("INSERT_ALL_TOMBSTONES", params)
+            session.query("DELETE_RECENT_BSOS", params)
         session.query("DELETE_ALL_COLLECTIONS", {
             "userid": userid,
         })
+        for (cached_userid, _), cached in session.cache.items():
+            if cached_userid == userid:
+                cached.forget()
+        if self.tombstone_reaper is not None:
+            session.after_commit.append(self.tombstone_reaper.notify)
 
     #
     # APIs to operate on an individual collection
@@ -306,15 +455,20 @@ class SQLStorage(SyncStorage):
         """Returns the last-modified timestamp of a collection."""
         collectionid = self._get_collection_id(session, collection)
         # The last-modified timestamp may be cached on the session.
-        cached_ts = session.cache[(userid, collectionid)].last_modified
-        if cached_ts is not None:
-            return cached_ts
+        cached = session.cache[(userid, collectionid)]
+        if cached.last_modified is not None:
+            return cached.last_modified
+        # Or we may already know that the collection doesn't exist.
+        if cached.exists is False or \
+                self._is_known_absent(userid, collectionid):
+            raise CollectionNotFoundError
         # Otherwise we need to look it up in the database.
         ts = session.query_scalar("COLLECTION_TIMESTAMP", {
             "userid": userid,
             "collectionid": collectionid,
         })
         if ts is None:
+            self._remember_absent(userid, collectionid)
             raise CollectionNotFoundError
         return bigint2ts(ts)
 
@@ -337,6 +491,9 @@ class SQLStorage(SyncStorage):
         """Find items matching the given search parameters."""
         params["userid"] = userid
         params["collectionid"] = self._get_collection_id(session, collection)
+        # Don't bother searching a collection that's known not to exist.
+        if self._is_absent(session, userid, params["collectionid"]):
+            raise CollectionNotFoundError
         if "ttl" not in params:
             params["ttl"] = int(session.timestamp)
         if "newer" in params:
@@ -351,7 +508,10 @@ class SQLStorage(SyncStorage):
         offset = params.pop("offset", None)
         if offset is not None:
             self.decode_offset(params, offset)
-        rows = session.query_fetchall("FIND_ITEMS", params)
+        if len(params.get("ids", ())) > MAX_IDS_PER_QUERY:
+            rows = self._find_rows_in_chunks(session, params)
+        else:
+            rows = session.query_fetchall("FIND_ITEMS", params)
         items = [self._row_to_bso(row, int(session.timestamp)) for row in rows]
         # If the query returned no results, we don't know whether that's
         # because it's empty or because it doesn't exist.  Read the collection
@@ -368,6 +528,39 @@ class SQLStorage(SyncStorage):
             "next_offset": next_offset,
         }
 
+    def _find_rows_in_chunks(self, session, params):
+        """Run FIND_ITEMS for a long list of ids, one chunk at a time.
+
+        Each chunk is sorted and limited by the database as usual, and the
+        results are then merged into the requested order before applying the
+        overall limit and offset.  Ties are broken by id, both within each
+        chunk and in the merge, so that every chunk keeps the same items that
+        the merge would and the order is consistent from one page to the next.
+        """
+        limit = params.get("limit")
+        offset = params.get("offset") or 0
+        chunk_params = params.copy()
+        chunk_params.pop("offset", None)
+        chunk_params["order_by_id"] = True
+        if limit is not None:
+            chunk_params["limit"] = offset + limit
+        rows = []
+        for ids in chunked(params["ids"]):
+            chunk_params["ids"] = ids
+            rows.extend(session.query_fetchall("FIND_ITEMS", chunk_params))
+        sort = params.get("sort")
+        if sort == "index":
+            # NULL sortindexes sort last, as they do in MySQL and SQLite.
+            rows.sort(key=lambda row: (row["sortindex"] is not None,
+                                       row["sortindex"], row["id"]),
+                      reverse=True)
+        else:
+            rows.sort(key=lambda row: (row["modified"], row["id"]),
+                      reverse=(sort != "oldest"))
+        if limit is None:
+            return rows[offset:]
+        return rows[offset:offset + limit]
+
     def _row_to_bso(self, row, timestamp):
         """Convert a database table row into a BSO object."""
         item = dict(row)
@@ -470,6 +663,8 @@ class SQLStorage(SyncStorage):
             "payload": "",
             "payload_size": 0,
         }
+        self._clear_tombstoned_items(session, userid, collectionid,
+                                     ids=[row["id"] for row in rows])
         session.insert_or_update("bso", rows, defaults)
         return self._touch_collection(session, userid, collectionid)
 
@@ -496,6 +691,9 @@ class SQLStorage(SyncStorage):
             "collection": collectionid
         }
         session.query("CREATE_BATCH", params)
+        cache_key = (userid, collectionid, batchid)
+        session.after_commit.append(
+            lambda: self.batch_cache.set(cache_key, True))
         return batchid
 
     @with_session
@@ -506,12 +704,22 @@ class SQLStorage(SyncStorage):
         if (batchid / 1000 + BATCH_LIFETIME) < session.timestamp:
             return False
         collectionid = self._get_collection_id(session, collection)
+        # Batches that this process has seen recently are known to be open,
+        # unless some other process has closed them since.  That's caught
+        # when items are appended or the batch is applied, since both check
+        # the batch in the db as part of the write, so it's safe to skip
+        # the db here.
+        cache_key = (userid, collectionid, batchid)
+        if self.batch_cache.get(cache_key):
+            return batchid
         params = {
             "batch": batchid,
             "userid": userid,
             "collection": collectionid
         }
         valid = session.query_scalar("VALID_BATCH", params=params)
+        if valid:
+            self.batch_cache.set(cache_key, True)
         return valid
 
     @metrics_timer("syncstorage.storage.sql.append_items_to_batch")
@@ -519,14 +727,63 @@ class SQLStorage(SyncStorage):
     def append_items_to_batch(self, session, userid, collection, batchid,
                               items):
         """Inserts items into batch_upload_items"""
+        collectionid = self._get_collection_id(session, collection)
+        params = {
+            "batch": batchid,
+            "userid": userid,
+            "collection": collectionid,
+        }
         rows = []
         for data in items:
             id_ = data["id"]
             row = self._prepare_bui_row(session, batchid, id_, data)
             rows.append(row)
-        session.insert_or_update("batch_upload_items", rows)
+        # Only add to the batch if it's still open, in case another process
+        # has closed it since we cached it.  That's checked by the statements
+        # that write to the batch, rather than by looking it up first: the
+        # update of the running totals when keeping them, and otherwise the
+        # upsert of the items themselves.
+        if self.track_batch_totals:
+            params["records"] = len(items)
+            params["bytes"] = sum(len(data.get("payload", ""))
+                                  for data in items)
+            is_open = session.query("ADD_TO_BATCH_TOTALS", params) > 0
+            if is_open:
+                session.insert_or_update("batch_upload_items", rows)
+        elif rows:
+            num_created = session.insert_or_update("batch_upload_items", rows,
+                                                   guard="VALID_BATCH",
+                                                   guard_params=params)
+            is_open = num_created is not None
+        else:
+            is_open = session.query_scalar("VALID_BATCH", params)
+        if not is_open:
+            self.batch_cache.delete((userid, collectionid, batchid))
+            raise InvalidBatch(batchid)
         return session.timestamp
 
+    @with_session
+    def get_batch_totals(self, session, userid, collection, batchid):
+        """Returns the number of records and bytes appended to a batch.
+
+        These are only known when keeping running totals; otherwise None is
+        returned and the size of the batch is limited by what the client
+        reports, since counting up its items on each POST would make a long
+        upload quadratic in the number of POSTs.
+        """
+        if not self.track_batch_totals:
+            return None
+        collectionid = self._get_collection_id(session, collection)
+        params = {
+            "batch": batchid,
+            "userid": userid,
+            "collection": collectionid,
+        }
+        row = session.query_fetchone("BATCH_TOTALS", params)
+        if row is None:
+            return None
+        return (int(row[0]), int(row[1]))
+
     @metrics_timer("syncstorage.storage.sql.apply_batch")
     @with_session
     def apply_batch(self, session, userid, collection, batchid):
@@ -539,10 +796,49 @@ class SQLStorage(SyncStorage):
             "ttl_base": int(session.timestamp),
             "modified": ts2bigint(session.timestamp)
         }
-        session.query("APPLY_BATCH_UPDATE", params)
-        session.query("APPLY_BATCH_INSERT", params)
+        # Make sure the batch is still open, in case it was only found in
+        # the cache and has since been closed by another process.
+        if not session.query_scalar("VALID_BATCH", params):
+            self.batch_cache.delete((userid, collectionid, batchid))
+            raise InvalidBatch(batchid)
+        self._clear_tombstoned_items(session, userid, collectionid,
+                                     batchid=batchid)
+        if self.batch_commit_chunk_size:
+            self._apply_batch_in_chunks(session, params)
+        else:
+            session.query("APPLY_BATCH_UPDATE", params)
+            session.query("APPLY_BATCH_INSERT", params)
         return self._touch_collection(session, userid, collectionid)
 
+    def _apply_batch_in_chunks(self, session, params):
+        """Apply a batch a chunk of items at a time, in order of id.
+
+        Each chunk is applied by its own short statements, but they all
+        belong to the same transaction and use the same timestamp, so the
+        commit as a whole is still atomic.  The last id applied is kept as a
+        progress marker, and reported if the commit is interrupted.
+        """
+        params = params.copy()
+        params["maxitems"] = self.batch_commit_chunk_size
+        params["after"] = ""
+        try:
+            while True:
+                rows = session.query_fetchall("BATCH_CHUNK_IDS", params)
+                ids = [row[0] for row in rows]
+                if not ids:
+                    break
+                for chunk in chunked(ids):
+                    params["ids"] = chunk
+                    session.query("APPLY_BATCH_CHUNK_UPDATE", params)
+                    session.query("APPLY_BATCH_CHUNK_INSERT", params)
+                params["after"] = ids[-1]
+                if len(ids) < self.batch_commit_chunk_size:
+                    break
+        except Exception:
+            logger.warning("Commit of batch %s interrupted after id %r",
+                           params["batch"], params["after"])
+            raise
+
     @with_session
     def close_batch(self, session, userid, collection, batchid):
         collectionid = self._get_collection_id(session, collection)
@@ -552,51 +848,123 @@ class SQLStorage(SyncStorage):
             "collection": collectionid
         }
         session.query("CLOSE_BATCH", params)
+        self.batch_cache.delete((userid, collectionid, batchid))
 
     @with_session
     def delete_collection(self, session, userid, collection):
         """Deletes an entire collection."""
         collectionid = self._get_collection_id(session, collection)
-        count = session.query("DELETE_COLLECTION_ITEMS", {
-            "userid": userid,
-            "collectionid": collectionid,
-        })
-        count += session.query("DELETE_COLLECTION", {
+        cached = session.cache[(userid, collectionid)]
+        params = {
             "userid": userid,
             "collectionid": collectionid,
-        })
+        }
+        count = 0
+        if not self.async_deletes:
+            count += session.query("DELETE_COLLECTION_ITEMS", params)
+        # If the write lock found no row for the collection, there's
+        # nothing more to delete.
+        if cached.exists is not False:
+            count += session.query("DELETE_COLLECTION", params)
+        cached.forget()
+        cached.exists = False
         if count == 0:
             raise CollectionNotFoundError
-        return self.get_storage_timestamp(userid)
+        if self.async_deletes:
+            self._tombstone_collection(session, userid, collectionid)
+        return self.get_storage_timestamp(session, userid)
+
+    def _tombstone_collection(self, session, userid, collectionid):
+        """Mark all current items in the collection as deleted."""
+        params = {
+            "userid": userid,
+            "collectionid": collectionid,
+            "modified": ts2bigint(session.timestamp),
+        }
+        if session.query("UPDATE_TOMBSTONE", params) != 1:
+            session.query("INSERT_TOMBSTONE", params)
+        session.query("DELETE_RECENT_COLLECTION_ITEMS", params)
+        session.cache[(userid, collectionid)].tombstone = params["modified"]
+        if self.tombstone_reaper is not None:
+            session.after_commit.append(self.tombstone_reaper.notify)
+
+    def _clear_tombstoned_items(self, session, userid, collectionid,
+                                ids=None, batchid=None):
+        """Clear tombstoned items out of the way of new writes.
+
+        When deletes are done asynchronously, a write may find a deleted
+        item that has not been purged yet.  To make sure it starts afresh
+        rather than updating the old item, the old items with the given ids,
+        or with the ids of the given batch, are purged first.
+        """
+        if not self.async_deletes:
+            return
+        cached = session.cache[(userid, collectionid)]
+        if cached.tombstone is UNKNOWN_TOMBSTONE:
+            cached.tombstone = session.query_scalar("TOMBSTONE_TIMESTAMP", {
+                "userid": userid,
+                "collectionid": collectionid,
+            })
+        if cached.tombstone is None:
+            return
+        # Forbid the write if its items would still count as deleted.
+        if ts2bigint(session.timestamp) < cached.tombstone:
+            raise ConflictError
+        params = {
+            "userid": userid,
+            "collectionid": collectionid,
+            "tombstone": cached.tombstone,
+        }
+        if batchid is not None:
+            params["batch"] = batchid
+            session.query("DELETE_TOMBSTONED_BATCH_ITEMS", params)
+        else:
+            for chunk in chunked(ids):
+                params["ids"] = chunk
+                session.query("DELETE_TOMBSTONED_ITEMS", params)
 
     @with_session
     def delete_items(self, session, userid, collection, items):
         """Deletes multiple items from a collection."""
         collectionid = self._get_collection_id(session, collection)
-        session.query("DELETE_ITEMS", {
-            "userid": userid,
-            "collectionid": collectionid,
-            "ids": items,
-        })
+        for ids in chunked(list(items)):
+            session.query("DELETE_ITEMS", {
+                "userid": userid,
+                "collectionid": collectionid,
+                "ids": ids,
+            })
         return self._touch_collection(session, userid, collectionid)
 
     def _touch_collection(self, session, userid, collectionid):
         """Update the last-modified timestamp of the given collection."""
+        self._forget_absent(session, userid, collectionid)
         params = {
             "userid": userid,
             "collectionid": collectionid,
             "modified": ts2bigint(session.timestamp),
         }
-        # The common case will be an UPDATE, so try that first.
-        # If it doesn't update any rows then do an INSERT.
-        rowcount = session.query("TOUCH_COLLECTION", params)
-        if rowcount != 1:
-            try:
-                session.query("INIT_COLLECTION", params)
-            except IntegrityError:
-                # Someone else inserted it at the same time.
-                if self.dbconnector.driver == "postgres":
-                    raise
+        cached = session.cache[(userid, collectionid)]
+        if cached.exists:
+            # The row is known to exist, and to be locked by this session.
+            session.query("TOUCH_COLLECTION", params)
+        elif cached.exists is None and self._can_upsert_collection:
+            session.query("UPSERT_COLLECTION", params)
+        else:
+            # The common case will be an UPDATE, so try that first unless
+            # the row is known not to exist.  If it doesn't update any rows
+            # then do an INSERT.
+            rowcount = 0
+            if cached.exists is None:
+                rowcount = session.query("TOUCH_COLLECTION", params)
+            if rowcount != 1:
+                try:
+                    session.query("INIT_COLLECTION", params)
+                except IntegrityError:
+                    # Someone else inserted it at the same time.
+                    if self.dbconnector.driver == "postgres":
+                        raise
+        cached.exists = True
+        cached.last_modified = session.timestamp
         return session.timestamp
 
     #
@@ -607,6 +975,8 @@ class SQLStorage(SyncStorage):
     def get_item_timestamp(self, session, userid, collection, item):
         """Returns the last-modified timestamp for the named item."""
         collectionid = self._get_collection_id(session, collection)
+        if self._is_absent(session, userid, collectionid):
+            raise ItemNotFoundError
         ts = session.query_scalar("ITEM_TIMESTAMP", {
             "userid": userid,
             "collectionid": collectionid,
@@ -621,6 +991,8 @@ class SQLStorage(SyncStorage):
     def get_item(self, session, userid, collection, item):
         """Returns one item from a collection."""
         collectionid = self._get_collection_id(session, collection)
+        if self._is_absent(session, userid, collectionid):
+            raise ItemNotFoundError
         row = session.query_fetchone("ITEM_DETAILS", {
             "userid": userid,
             "collectionid": collectionid,
@@ -641,6 +1013,8 @@ class SQLStorage(SyncStorage):
             "payload": "",
             "payload_size": 0,
         }
+        self._clear_tombstoned_items(session, userid, collectionid,
+                                     ids=[item])
         num_created = session.insert_or_update("bso", [row], defaults)
         return {
             "created": bool(num_created),
@@ -718,12 +1092,48 @@ class SQLStorage(SyncStorage):
         num_bui_rows_purged = res["num_purged"]
         is_complete = is_complete and res["is_complete"]
 
-        return {
+        result = {
             "num_batches_purged": num_batches_purged,
             "num_bso_rows_purged": num_bso_rows_purged,
             "num_bui_rows_purged": num_bui_rows_purged,
             "is_complete": is_complete,
         }
+        if self.async_deletes:
+            res = self.purge_tombstoned_items(max_per_loop)
+            result["num_tombstoned_rows_purged"] = res["num_purged"]
+            result["is_complete"] = is_complete and res["is_complete"]
+        return result
+
+    def purge_tombstoned_items(self, max_per_loop=1000):
+        """Purges the items of tombstoned collections from the database.
+
+        Each collection's items are deleted a few at a time, and once they
+        are all gone its tombstone is removed, unless it was deleted again
+        in the meantime.
+        """
+        with self._get_or_create_session() as session:
+            tombstones = list(session.query_fetchall("FIND_TOMBSTONES"))
+        num_purged = 0
+        is_incomplete = False
+        for userid, collectionid, modified in tombstones:
+            table = self.dbconnector.get_bso_table(userid).name
+            params = {
+                "userid": userid,
+                "collectionid": collectionid,
+                "modified": modified,
+            }
+            res = self._purge_items_loop(table, "PURGE_SOME_TOMBSTONED_ITEMS",
+                                         dict(params, maxitems=max_per_loop))
+            num_purged += res["num_purged"]
+            if not res["is_complete"]:
+                is_incomplete = True
+                continue
+            with self._get_or_create_session() as session:
+                session.query("DELETE_TOMBSTONE", params)
+        return {
+            "num_purged": num_purged,
+            "is_complete": not is_incomplete,
+        }
 
     def _purge_expired_bsos(self, grace_period=0, max_per_loop=1000):
         """Purges BSOs with an expired TTL from the database."""
@@ -820,6 +1230,79 @@ class SQLStorage(SyncStorage):
             "is_complete": not is_incomplete,
         }
 
+    def get_pool_status(self):
+        """Get information about the state of the db connection pool.
+
+        This is used to make load-shedding decisions, and returns None if
+        the backend is not using a connection pool.
+        """
+        status = self.dbconnector.get_pool_status()
+        if status is not None and self.group_committer is not None:
+            status["group_commit"] = self.group_committer.get_status()
+        if status is not None:
+            status["batch_cache"] = {
+                "size": len(self.batch_cache),
+                "hit_rate": self.batch_cache.hit_rate,
+            }
+        if status is not None and self.absent_collections is not None:
+            status["absent_collections"] = {
+                "size": len(self.absent_collections),
+                "hit_rate": self.absent_collections.hit_rate,
+            }
+        return status
+
+    def get_query_stats(self):
+        """Get the latency and row count statistics for each named query.
+
+        See QueryStats for the details of what is recorded.
+        """
+        return self.dbconnector.query_stats.get_stats()
+
+    #
+    # Private methods for remembering collections that don't exist.
+    #
+
+    def _is_absent(self, session, userid, collectionid):
+        """Check whether a collection is already known not to exist.
+
+        This is known either from the row lookups done earlier in the
+        session, or from the in-process cache of absent collections.
+        """
+        if session.cache[(userid, collectionid)].exists is False:
+            return True
+        return self._is_known_absent(userid, collectionid)
+
+    def _is_known_absent(self, userid, collectionid):
+        """Check the in-process cache of absent collections."""
+        if self.absent_collections is None:
+            return False
+        key = (userid, collectionid)
+        expires = self.absent_collections.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            self.absent_collections.delete(key)
+            return False
+        return True
+
+    def _remember_absent(self, userid, collectionid):
+        """Record in the in-process cache that a collection doesn't exist."""
+        if self.absent_collections is not None:
+            expires = time.time() + self.absent_collections_ttl
+            self.absent_collections.set((userid, collectionid), expires)
+
+    def _forget_absent(self, session, userid, collectionid):
+        """Clear any cached absence of a collection that is being written.
+
+        The entry is cleared again once the write commits, in case a
+        concurrent read re-populated it in the meantime.
+        """
+        if self.absent_collections is not None:
+            key = (userid, collectionid)
+            self.absent_collections.delete(key)
+            session.after_commit.append(
+                lambda: self.absent_collections.delete(key))
+
     #
     # Private methods for manipulating collections.
     #
@@ -903,10 +1386,10 @@ class SQLStorage(SyncStorage):
                 names[id] = self._collections_by_id[id]
             except KeyError:
                 uncached_ids.append(id)
-        # Use a single query to fetch the names for all uncached collections.
-        if uncached_ids:
+        # Fetch the names for all uncached collections, a chunk at a time.
+        for ids in chunked(uncached_ids):
             uncached_names = session.query_fetchall("COLLECTION_NAMES", {
-                "ids": uncached_ids,
+                "ids": ids,
             })
             for id, name in uncached_names:
                 names[id] = name
@@ -919,6 +1402,27 @@ class SQLStorage(SyncStorage):
                 raise KeyError(msg % (id,))
         return names
 
+    def _load_all_collection_names(self):
+        """Load the names of all collections into the internal name cache.
+
+        This takes a single query, rather than one for each collection name
+        as it is first used, so the first requests after startup don't have
+        to pay for looking them up.
+        """
+        with self._get_or_create_session() as session:
+            rows = session.query_fetchall("ALL_COLLECTIONS")
+            for id, name in rows:
+                # Skip the placeholder that reserves the standard ids.
+                if self.standard_collections:
+                    if id < FIRST_CUSTOM_COLLECTION_ID:
+                        continue
+                is_full = \
+                    len(self._collections_by_name) > MAX_COLLECTIONS_CACHE_SIZE
+                self._cache_collection_id(id, name)
+                # Once full, it has warned about it and won't cache any more.
+                if is_full:
+                    break
+
     def _map_collection_names(self, session, values):
         """Helper to create a map of collection names to values.
 
@@ -953,12 +1457,15 @@ class SQLStorageSession(object):
 
     """
 
-    def __init__(self, storage, timestamp=None):
+    def __init__(self, storage, timestamp=None, committer=None):
         self.storage = storage
         self.connection = storage.dbconnector.connect()
         self.timestamp = get_timestamp(timestamp)
         self.cache = defaultdict(SQLCachedCollectionData)
         self.locked_collections = {}
+        self.committer = committer
+        self.group = None
+        self.after_commit = []
         self._nesting_level = 0
 
     def __enter__(self):
@@ -972,10 +1479,13 @@ class SQLStorageSession(object):
             self.rollback()
 
     @convert_db_errors
-    def insert_or_update(self, table, items, defaults=None):
+    def insert_or_update(self, table, items, defaults=None, guard=None,
+                         guard_params=None):
         """Do a bulk insert/update of the given items."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.insert_or_update(table, items, defaults)
+        return self.connection.insert_or_update(table, items, defaults,
+                                                guard=guard,
+                                                guard_params=guard_params)
 
     @convert_db_errors
     def query(self, query, params={}):
@@ -1010,6 +1520,9 @@ class SQLStorageSession(object):
         """
         if self._nesting_level == 0:
             assert not hasattr(self.storage._tldata, "session")
+            if self.committer is not None:
+                self.group = self.committer.join(self)
+                self.connection = self.group.connection
             self.storage._tldata.session = self
         self._nesting_level += 1
 
@@ -1018,31 +1531,43 @@ class SQLStorageSession(object):
         """Successfully exit the context of this session.
 
         Once each entered context has been exited, this method will commit
-        the underlying database transaction and close the connection.
+        the underlying database transaction and close the connection.  If
+        the session is part of a group commit, it waits for the whole group
+        to be committed instead.
         """
         self._nesting_level -= 1
         assert self._nesting_level >= 0
         if self._nesting_level == 0:
             try:
-                self.connection.commit()
+                if self.group is not None:
+                    self.committer.release(self.group, self, False)
+                else:
+                    self.connection.commit()
             finally:
                 del self.storage._tldata.session
             if self.locked_collections:
                 msg = "You must unlock all collections before ending a session"
                 raise RuntimeError(msg)
+            for callback in self.after_commit:
+                callback()
 
     @convert_db_errors
     def rollback(self):
         """Unsuccessfully exit the context of this session.
 
         Once each entered context has been exited, this method will rollback
-        the underlying database transaction and close the connection.
+        the underlying database transaction and close the connection.  If
+        the session is part of a group commit, only its own changes to the
+        group's transaction are rolled back.
         """
         self._nesting_level -= 1
         assert self._nesting_level >= 0
         if self._nesting_level == 0:
             try:
-                self.connection.rollback()
+                if self.group is not None:
+                    self.committer.release(self.group, self, True)
+                else:
+                    self.connection.rollback()
             finally:
                 del self.storage._tldata.session
             if self.locked_collections:
@@ -1050,12 +1575,203 @@ class SQLStorageSession(object):
                 raise RuntimeError(msg)
 
 
+class _CommitGroup(object):
+    """A set of write sessions sharing a single database transaction."""
+
+    def __init__(self, leader, connection):
+        self.leader = leader
+        self.connection = connection
+        self.started = timeit.default_timer()
+        self.num_members = 1
+        self.num_finished = 0
+        self.busy = True
+        self.sealed = False
+        self.poisoned = False
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """Helper to merge concurrent write sessions into a single db commit.
+
+    Each write session joins the currently-open group, taking turns to run
+    its queries in the group's transaction.  The first session to join is
+    the group's leader; when it finishes, it waits for the rest of the
+    commit window and for all other members to finish, and then commits
+    the transaction on behalf of the whole group.  Every member waits for
+    that commit before reporting success, so a write is never acknowledged
+    before it is durable.
+
+    Each member keeps its own timestamp and its own collection locks, so
+    conflicts are detected per-session just as without group commit.  Each
+    member also runs inside a savepoint, so one that fails is rolled back
+    on its own and the rest of the group commits as normal.  Only if that
+    fails too, e.g. because the database aborted the whole transaction to
+    break a deadlock, is the group rolled back and the other members given
+    a ConflictError, which tells the client to retry.
+
+    Members take turns because they share a connection.  So that no member
+    waits for a lock while the group holds the locks of earlier members,
+    any but the first take their collection lock without waiting, and get
+    a ConflictError if another transaction has it.
+    """
+
+    def __init__(self, window, max_size=20):
+        self.window = window
+        self.max_size = max_size
+        self.num_groups = 0
+        self.num_sessions = 0
+        self._cond = threading.Condition()
+        self._group = None
+
+    def get_status(self):
+        with self._cond:
+            return {
+                "num_groups": self.num_groups,
+                "num_sessions": self.num_sessions,
+            }
+
+    def join(self, session):
+        """Join the current group, or start a new one, and take a turn."""
+        with self._cond:
+            group = self._group
+            if group is None or group.sealed:
+                connection = session.storage.dbconnector.connect()
+                group = self._group = _CommitGroup(session, connection)
+                group.sealed = self.max_size <= 1
+                self.num_groups += 1
+            else:
+                group.num_members += 1
+                if group.num_members >= self.max_size:
+                    # Tell the leader not to wait for any more members.
+                    group.sealed = True
+                    self._cond.notify_all()
+                while group.busy:
+                    self._cond.wait()
+                group.busy = True
+            self.num_sessions += 1
+        try:
+            if session is group.leader:
+                group.connection.query("BEGIN_TRANSACTION_WRITE")
+            group.connection.query("SAVEPOINT_GROUP_MEMBER")
+        except Exception:
+            self.release(group, session, True)
+            raise
+        return group
+
+    def release(self, group, session, failed):
+        """Finish this session's turn and wait for the group to commit."""
+        try:
+            group.connection.reset_deadline()
+        except BackendError:
+            failed = True
+        # Keep this session's changes, or undo them without touching those
+        # of the other members.  If that's not possible then the state of
+        # the transaction is unknown, and the whole group must fail.
+        poisoned = False
+        try:
+            if failed:
+                group.connection.query("ROLLBACK_GROUP_MEMBER")
+            else:
+                group.connection.query("RELEASE_GROUP_MEMBER")
+        except Exception:
+            failed = poisoned = True
+        with self._cond:
+            if poisoned:
+                group.poisoned = True
+            group.busy = False
+            group.num_finished += 1
+            self._cond.notify_all()
+            if session is not group.leader:
+                if failed:
+                    return
+            else:
+                deadline = group.started + self.window
+                while not group.sealed:
+                    remaining = deadline - timeit.default_timer()
+                    if remaining <= 0:
+                        group.sealed = True
+                    else:
+                        self._cond.wait(remaining)
+                if self._group is group:
+                    self._group = None
+                while group.num_finished < group.num_members:
+                    self._cond.wait()
+        if session is group.leader:
+            self._finish(group)
+            if failed:
+                return
+        group.done.wait()
+        if group.exc_info is not None:
+            six.reraise(*group.exc_info)
+        if group.poisoned:
+            raise ConflictError
+
+    def _finish(self, group):
+        try:
+            if group.poisoned:
+                group.connection.rollback()
+            else:
+                group.connection.commit()
+        except Exception:
+            group.exc_info = sys.exc_info()
+        finally:
+            group.done.set()
+
+
+class TombstoneReaper(object):
+    """Background thread to purge the items of tombstoned collections.
+
+    The thread is started on first use, and each call to notify() wakes it
+    up to purge all pending tombstones; sessions call it once they have
+    committed a new tombstone.  It does so in small chunks, each
+    in its own transaction, so that it never holds locks for long.  Any
+    tombstones that it misses, e.g. because the process was restarted, are
+    picked up by purge_expired_items().
+    """
+
+    def __init__(self, storage, max_per_loop=1000):
+        self.storage = storage
+        self.max_per_loop = max_per_loop
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self):
+        """Ask the thread to purge all pending tombstones."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                while not self.storage.purge_tombstoned_items(
+                        self.max_per_loop)["is_complete"]:
+                    pass
+            except Exception:
+                logger.exception("Error while purging tombstoned items")
+
+
 class SQLCachedCollectionData(object):
     """Object for storing cached information about a collection.
 
     The SQLStorageSession object maintains a small cache of data that has
-    already been looked up during that session.  Currently this includes only
-    the last-modified timestamp of any collections locked by that session.
+    already been looked up during that session.  Currently this includes
+    the last-modified timestamp of any collections locked by that session,
+    and whether their row in the user_collections table exists (or None if
+    that is not known), and the timestamp of any tombstone for the collection.
     """
     def __init__(self):
+        self.forget()
+
+    def forget(self):
+        """Forget everything we knew, e.g. because the row was deleted."""
         self.last_modified = None
+        self.exists = None
+        self.tombstone = UNKNOWN_TOMBSTONE
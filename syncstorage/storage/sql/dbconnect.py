@@ -22,24 +22,31 @@ import os
 import re
 import sys
 import copy
+import time
+import timeit
+import hashlib
 import logging
+import threading
 import traceback
 import functools
 from collections import defaultdict
 
 import sqlalchemy.event
 from sqlalchemy import create_engine
-from sqlalchemy.util.queue import Queue
+from sqlalchemy.util.queue import Queue, Empty
 from sqlalchemy.pool import NullPool, QueuePool
-from sqlalchemy.sql import insert, update, text as sqltext
+from sqlalchemy.sql import insert, update, select, literal
+from sqlalchemy.sql import text as sqltext
 from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
 from sqlalchemy import (Integer, String, Text, BigInteger,
                         MetaData, Column, Table, Index)
 from sqlalchemy.dialects import postgresql
 
 from mozsvc.metrics import metrics_timer, annotate_request
-from mozsvc.exceptions import BackendError
+from mozsvc.exceptions import BackendError, BackendTimeoutError
 
+from syncstorage.util import profile_phase
+from syncstorage.storage import get_deadline
 from syncstorage.storage.sql import (queries_generic,
                                      queries_sqlite,
                                      queries_postgres,
@@ -49,6 +56,8 @@ import six
 from six.moves import urllib
 
 logger = logging.getLogger("syncstorage.storage.sql")  # pylint: disable=C0103
+slow_query_logger = logging.getLogger(  # pylint: disable=C0103
+    "syncstorage.storage.sql.slow_queries")
 
 # Regex to match safe database field/column names.
 SAFE_FIELD_NAME_RE = re.compile("^[a-zA-Z0-9_]+$")
@@ -58,9 +67,31 @@ SAFE_FIELD_NAME_RE = re.compile("^[a-zA-Z0-9_]+$")
 SAFE_TO_KILL_QUERY = r"^\s*(/\*.*\*/)?\s*(SELECT|INSERT|UPDATE)\s"
 SAFE_TO_KILL_QUERY = re.compile(SAFE_TO_KILL_QUERY, re.I)
 
+# Regex to find where to insert an optimizer hint into a SELECT statement.
+# It's the SELECT keyword, with optional leading comment.
+SELECT_HINT_POSITION = r"^(\s*(/\*.*?\*/)?\s*SELECT)\s"
+SELECT_HINT_POSITION = re.compile(SELECT_HINT_POSITION, re.I)
+
+# How many SQLite virtual-machine instructions to run between deadline checks.
+SQLITE_PROGRESS_INTERVAL = 1000
+
+# Upper bounds, in seconds, of the buckets in the query latency histograms.
+QUERY_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# Regexes used to reduce a rendered query to its general shape for logging.
+QUERY_TABLES_RE = re.compile(r"\b(bso\d*|batch_upload_items\d*)\b")
+QUERY_BINDS_LIST_RE = re.compile(r"\(:[a-z_]+\d+(,\s*:[a-z_]+\d+)*\)", re.I)
+QUERY_WHITESPACE_RE = re.compile(r"\s+")
+
 # The ttl to use for rows that are never supposed to expire.
 MAX_TTL = 2100000000
 
+# Condition to exclude items of tombstoned collections from a query.
+NOT_TOMBSTONED_FILTER = " AND %(bso)s.modified >= COALESCE((" \
+    "SELECT bso_tombstones.modified FROM bso_tombstones WHERE " \
+    "bso_tombstones.userid = %(bso)s.userid AND " \
+    "bso_tombstones.collection = %(bso)s.collection), 0)"
+
 metadata = MetaData()
 
 
@@ -104,6 +135,24 @@ user_collections = Table(
 )
 
 
+# Table mapping (user_id, collection_id) => deletion timestamp.
+#
+# When deletes are done asynchronously, deleting a collection leaves a
+# tombstone here rather than deleting its items straight away.  Items with
+# a timestamp before that of the tombstone are ignored, and are gradually
+# purged in the background.
+
+bso_tombstones = Table(
+    "bso_tombstones",
+    metadata,
+    Column("userid", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("collection", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("modified", BigInteger, nullable=False)
+)
+
+
 # Column definitions for BSO storage table/tables.
 #
 # This list class defines the columns used for storage of BSO records.
@@ -159,7 +208,20 @@ batch_uploads = Table(
     Column("batch", BigInteger, primary_key=True, nullable=False),
     Column("userid", Integer, primary_key=True, nullable=False,
            autoincrement=False),
-    Column("collection", Integer, nullable=False)
+    Column("collection", Integer, nullable=False),
+    # Running totals of the items appended to the batch, so that its size
+    # can be limited without trusting the client to report it.  These are
+    # only used with the track_batch_totals option; existing MySQL databases
+    # can add them with:
+    #
+    #   ALTER TABLE batch_uploads
+    #   ADD COLUMN total_records INTEGER NOT NULL DEFAULT 0,
+    #   ADD COLUMN total_bytes BIGINT NOT NULL DEFAULT 0
+    #
+    Column("total_records", Integer, nullable=False,
+           server_default=sqltext("0")),
+    Column("total_bytes", BigInteger, nullable=False,
+           server_default=sqltext("0"))
 )
 
 # Column definitions for batch upload item table(s)
@@ -225,6 +287,15 @@ def get_batch_item_table(index):
     return get_sharded_table(index, which="batch_upload_items")
 
 
+# Weight given to each new sample in the average checkout latency,
+# and the time in seconds it takes to halve that average when idle.
+CHECKOUT_LATENCY_WEIGHT = 0.1
+CHECKOUT_LATENCY_HALF_LIFE = 1.0
+
+# Minimum time in seconds between resizes of an adaptively-sized pool.
+ADAPTIVE_RESIZE_INTERVAL = 1.0
+
+
 class _QueueWithMaxBacklog(Queue):
     """SQLAlchemy Queue subclass with a limit on the length of the backlog.
 
@@ -236,6 +307,7 @@ class _QueueWithMaxBacklog(Queue):
     def __init__(self, maxsize=0, max_backlog=-1):
         self.max_backlog = max_backlog
         self.cur_backlog = 0
+        self.num_rejected = 0
         Queue.__init__(self, maxsize)
 
     def get(self, block=True, timeout=None):
@@ -243,12 +315,19 @@ class _QueueWithMaxBacklog(Queue):
         # so it's safe to acquire it both here and in the superclass method.
         with self.mutex:
             self.cur_backlog += 1
+            rejected = False
             try:
                 if self.max_backlog >= 0:
                     if self.cur_backlog > self.max_backlog:
+                        rejected = block
                         block = False
                         timeout = None
                 return Queue.get(self, block, timeout)
+            except Empty:
+                # Count callers that would have waited, but weren't allowed.
+                if rejected:
+                    self.num_rejected += 1
+                raise
             finally:
                 self.cur_backlog -= 1
 
@@ -265,21 +344,202 @@ class QueuePoolWithMaxBacklog(QueuePool):
     of threads that can be in the queue waiting for a connection.  Once this
     limit has been reached, any further attempts to acquire a connection will
     be rejected immediately.
+
+    It also keeps some statistics about its use, which can be retrieved by
+    calling get_status().  If "adaptive_min_size" is given then the pool will
+    start at that size and periodically grow or shrink itself, within that
+    and the configured pool_size, based on the time that threads are spending
+    waiting for a connection.
     """
 
-    def __init__(self, creator, max_backlog=-1, **kwds):
+    def __init__(self, creator, max_backlog=-1, adaptive_min_size=None,
+                 adaptive_grow_latency=0.01, adaptive_shrink_latency=0.001,
+                 **kwds):
         QueuePool.__init__(self, creator, **kwds)
         self._pool = _QueueWithMaxBacklog(self._pool.maxsize, max_backlog)
+        self._checkout_latency = 0.0
+        self._last_checkout_time = timeit.default_timer()
+        self._num_checkouts = 0
+        self._num_failed_checkouts = 0
+        self._num_closed = 0
+        self._total_lifetime = 0.0
+        # Settings for adaptive sizing.
+        self._max_size = self._pool.maxsize
+        self._adaptive_min_size = adaptive_min_size
+        self._adaptive_grow_latency = adaptive_grow_latency
+        self._adaptive_shrink_latency = adaptive_shrink_latency
+        self._last_resize_time = self._last_checkout_time
+        if adaptive_min_size is not None:
+            self._grow(adaptive_min_size - self._max_size)
 
     def recreate(self):
         new_self = QueuePool.recreate(self)
         new_self._pool = _QueueWithMaxBacklog(self._pool.maxsize,
                                               self._pool.max_backlog)
+        new_self._max_size = self._max_size
+        new_self._adaptive_min_size = self._adaptive_min_size
+        new_self._adaptive_grow_latency = self._adaptive_grow_latency
+        new_self._adaptive_shrink_latency = self._adaptive_shrink_latency
         return new_self
 
     @metrics_timer("syncstorage.storage.sql.pool.get")
     def _do_get(self):
-        return QueuePool._do_get(self)
+        start = timeit.default_timer()
+        try:
+            return QueuePool._do_get(self)
+        except TimeoutError:
+            self._num_failed_checkouts += 1
+            raise
+        finally:
+            end = timeit.default_timer()
+            # Keep an exponentially-weighted average of recent waits.
+            # This is updated without locking; the odd lost update is
+            # harmless since it's only used as a rough load indicator.
+            latency = (1 - CHECKOUT_LATENCY_WEIGHT) * self._checkout_latency
+            latency += CHECKOUT_LATENCY_WEIGHT * (end - start)
+            self._checkout_latency = latency
+            self._last_checkout_time = end
+            self._num_checkouts += 1
+            if self._adaptive_min_size is not None:
+                if end - self._last_resize_time >= ADAPTIVE_RESIZE_INTERVAL:
+                    self._last_resize_time = end
+                    self._adapt_size()
+
+    def _adapt_size(self):
+        """Grow or shrink the pool by one, based on recent checkout times."""
+        size = self._pool.maxsize
+        if self._checkout_latency > self._adaptive_grow_latency:
+            if size < self._max_size:
+                self._grow(1)
+                logger.info("Grew connection pool to %d", size + 1)
+        elif self._checkout_latency < self._adaptive_shrink_latency:
+            if size > self._adaptive_min_size:
+                if self._shrink():
+                    logger.info("Shrank connection pool to %d", size - 1)
+
+    def _grow(self, delta):
+        """Change the size of the pool, without closing any connections.
+
+        QueuePool tracks the number of open connections as an "overflow"
+        relative to its size, so this needs to be adjusted in the opposite
+        direction to keep the count of open connections the same.
+        """
+        with self._overflow_lock:
+            self._pool.maxsize += delta
+            self._overflow -= delta
+
+    def _shrink(self):
+        """Reduce the size of the pool by closing an idle connection.
+
+        If there are no idle connections then the pool stays the same size,
+        and this method returns False.
+        """
+        try:
+            conn = self._pool.get(False)
+        except Empty:
+            return False
+        with self._overflow_lock:
+            self._pool.maxsize -= 1
+        conn.close()
+        return True
+
+    def record_connection_closed(self, connection_record):
+        """Record the lifetime of a database connection that is closing."""
+        if connection_record.starttime is not None:
+            self._num_closed += 1
+            self._total_lifetime += time.time() - connection_record.starttime
+
+    def checkout_latency(self):
+        """Get the recent average time spent waiting for a connection.
+
+        The average decays while the pool is idle, so that a burst of slow
+        checkouts isn't remembered forever if no further requests arrive.
+        """
+        idle_time = timeit.default_timer() - self._last_checkout_time
+        decay = 0.5 ** (idle_time / CHECKOUT_LATENCY_HALF_LIFE)
+        return self._checkout_latency * decay
+
+    def backlog(self):
+        """Get the number of threads currently waiting for a connection."""
+        return self._pool.cur_backlog
+
+    def max_backlog(self):
+        """Get the maximum allowed number of waiting threads, or -1."""
+        return self._pool.max_backlog
+
+    def get_status(self):
+        """Get a dict of information about the current state of the pool."""
+        if self._num_closed:
+            avg_lifetime = self._total_lifetime / self._num_closed
+        else:
+            avg_lifetime = None
+        return {
+            "size": self.size(),
+            "max_size": self._max_size,
+            "min_size": self._adaptive_min_size,
+            "checkedout": self.checkedout(),
+            "checkedin": self.checkedin(),
+            "overflow": self.overflow(),
+            "max_overflow": self._max_overflow,
+            "backlog": self.backlog(),
+            "max_backlog": self.max_backlog(),
+            "checkout_latency": self.checkout_latency(),
+            "num_checkouts": self._num_checkouts,
+            "num_failed_checkouts": self._num_failed_checkouts,
+            "num_rejected_checkouts": self._pool.num_rejected,
+            "num_connections_closed": self._num_closed,
+            "avg_connection_lifetime": avg_lifetime,
+        }
+
+
+class QueryStats(object):
+    """Per-query-name statistics about the queries sent to the database.
+
+    This keeps a count, total time and latency histogram for each named
+    query, along with the total number of rows that it affected or returned.
+    The histogram has one count per entry in QUERY_LATENCY_BUCKETS, plus a
+    final count for queries slower than the largest bucket.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get_entry(self, query_name):
+        try:
+            return self._stats[query_name]
+        except KeyError:
+            return self._stats.setdefault(query_name, {
+                "count": 0,
+                "total_time": 0.0,
+                "rows": 0,
+                "histogram": [0] * (len(QUERY_LATENCY_BUCKETS) + 1),
+            })
+
+    def record_latency(self, query_name, duration):
+        """Record the execution time of a single query."""
+        for i, bound in enumerate(QUERY_LATENCY_BUCKETS):
+            if duration <= bound:
+                break
+        else:
+            i = len(QUERY_LATENCY_BUCKETS)
+        with self._lock:
+            entry = self._get_entry(query_name)
+            entry["count"] += 1
+            entry["total_time"] += duration
+            entry["histogram"][i] += 1
+
+    def record_rows(self, query_name, num_rows):
+        """Record the number of rows affected or returned by a query."""
+        if num_rows > 0:
+            with self._lock:
+                self._get_entry(query_name)["rows"] += num_rows
+
+    def get_stats(self):
+        """Get a copy of the statistics, as a dict keyed by query name."""
+        with self._lock:
+            return dict((name, dict(entry, histogram=list(entry["histogram"])))
+                        for name, entry in self._stats.iteritems())
 
 
 class DBConnector(object):
@@ -300,7 +560,9 @@ class DBConnector(object):
     def __init__(self, sqluri, create_tables=False, pool_size=100,
                  no_pool=False, pool_recycle=60, reset_on_return=True,
                  pool_max_overflow=10, pool_max_backlog=-1, pool_timeout=30,
-                 shard=False, shardsize=100, **kwds):
+                 pool_min_size=None, pool_grow_latency=0.01,
+                 pool_shrink_latency=0.001, shard=False, shardsize=100,
+                 slow_query_threshold=None, async_deletes=False, **kwds):
 
         parsed_sqluri = urllib.parse.urlparse(sqluri)
         self.sqluri = sqluri
@@ -317,6 +579,20 @@ class DBConnector(object):
         self.shard = shard
         self.shardsize = shardsize
 
+        # With async deletes, queries must ignore items that have been
+        # tombstoned but not yet purged.
+        self.async_deletes = async_deletes
+        if async_deletes:
+            self._not_tombstoned_filter = NOT_TOMBSTONED_FILTER
+        else:
+            self._not_tombstoned_filter = ""
+
+        # Statistics about each named query, and when to log slow ones.
+        self.query_stats = QueryStats()
+        if slow_query_threshold is not None:
+            slow_query_threshold = float(slow_query_threshold)
+        self.slow_query_threshold = slow_query_threshold
+
         # Construct the pooling-related arguments for SQLAlchemy engine.
         sqlkw = {}
         sqlkw["logging_name"] = "syncstorage"
@@ -331,6 +607,11 @@ class DBConnector(object):
             sqlkw["pool_reset_on_return"] = reset_on_return
             sqlkw["max_overflow"] = int(pool_max_overflow)
             sqlkw["max_backlog"] = int(pool_max_backlog)
+            # Giving a minimum size enables adaptive sizing of the pool.
+            if pool_min_size is not None:
+                sqlkw["adaptive_min_size"] = int(pool_min_size)
+                sqlkw["adaptive_grow_latency"] = float(pool_grow_latency)
+                sqlkw["adaptive_shrink_latency"] = float(pool_shrink_latency)
 
         # Connection handling in sqlite needs some extra care.
         if self.driver == "sqlite":
@@ -347,6 +628,7 @@ class DBConnector(object):
                     raise ValueError(msg)
                 sqlkw["pool_size"] = 1
                 sqlkw["max_overflow"] = 0
+                sqlkw.pop("adaptive_min_size", None)
 
         # Create the engine.
         # We set the umask during this call, to ensure that any sqlite
@@ -361,6 +643,7 @@ class DBConnector(object):
         if create_tables:
             collections.create(self.engine, checkfirst=True)
             user_collections.create(self.engine, checkfirst=True)
+            bso_tombstones.create(self.engine, checkfirst=True)
             batch_uploads.create(self.engine, checkfirst=True)
             if not self.shard:
                 bso.create(self.engine, checkfirst=True)
@@ -406,10 +689,32 @@ class DBConnector(object):
             sqlalchemy.event.listen(self.engine.pool, "checkin",
                                     clear_result_on_pool_checkin)
 
+        # Track the lifetime of each connection as it is closed.  We look up
+        # the pool from the engine each time, since it may be recreated.
+        if isinstance(self.engine.pool, QueuePoolWithMaxBacklog):
+
+            def record_connection_lifetime(conn, conn_record):
+                self.engine.pool.record_connection_closed(conn_record)
+
+            sqlalchemy.event.listen(self.engine.pool, "close",
+                                    record_connection_lifetime)
+
     def connect(self, *args, **kwds):
         """Create a new DBConnection object from this connector."""
         return DBConnection(self)
 
+    def get_pool_status(self):
+        """Get information about the state of the connection pool.
+
+        This returns a dict of pool statistics as produced by the
+        QueuePoolWithMaxBacklog.get_status() method, or None if no
+        such pool is in use.
+        """
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePoolWithMaxBacklog):
+            return None
+        return pool.get_status()
+
     def get_query(self, name, params):
         """Get the named pre-built query.
 
@@ -428,11 +733,16 @@ class DBConnector(object):
         # If it's a callable, call it with the sharded bso table.
         if callable(query):
             bso = self.get_bso_table(params.get("userid"))
+            if self.async_deletes:
+                params["not_tombstoned"] = True
             return query(bso, params)
         # If it's a string, do some interpolation and return it.
         # XXX TODO: we could pre-parse these queries at load time to look for
         # string interpolation variables, saving some time on each call.
         assert isinstance(query, six.string_types)
+        if "%(not_tombstoned)s" in query:
+            query = query.replace("%(not_tombstoned)s",
+                                  self._not_tombstoned_filter)
         qvars = {}
         if "%(bso)s" in query:
             if "bso" in params:
@@ -446,7 +756,7 @@ class DBConnector(object):
                 qvars["bui"] = self.get_batch_item_table(params["batch"])
         if "%(ids)s" in query:
             bindparams = []
-            for i, id in enumerate(params["ids"]):
+            for i, id in enumerate(queries_generic.pad_ids(params["ids"])):
                 params["id%d" % (i,)] = id
                 bindparams.append(":id%d" % (i,))
             qvars["ids"] = "(" + ",".join(bindparams) + ")"
@@ -501,6 +811,32 @@ def is_retryable_db_error(engine, exc):
     return False
 
 
+def is_query_timeout_error(engine, exc):
+    """Check whether the given error is due to a query running out of time.
+
+    These are produced when the database enforces the deadline set for
+    a query, and are reported differently by each database backend.
+    """
+    if not isinstance(exc, DBAPIError):
+        return False
+    # MySQL reports this via an error code:
+    #    3024: maximum statement execution time exceeded
+    #    1969: max_statement_time exceeded (MariaDB)
+    try:
+        mysql_error_code = engine.dialect._extract_error_code(exc.orig)
+    except AttributeError:
+        pass
+    else:
+        return mysql_error_code in (3024, 1969)
+    # PostgreSQL reports "57014: canceling statement due to statement timeout".
+    if getattr(exc.orig, "pgcode", None) == "57014":
+        return True
+    # SQLite reports an "interrupted" error when the progress handler aborts.
+    if engine.dialect.name == "sqlite":
+        return "interrupted" in str(exc.orig).lower()
+    return False
+
+
 def is_operational_db_error(engine, exc):
     """Check whether the given error is an operations-related db error.
 
@@ -531,6 +867,11 @@ def report_backend_errors(func):
         try:
             return func(self, *args, **kwds)
         except Exception as exc:
+            # A query that ran past its deadline is not unexpected,
+            # so just report it as a timeout without the full traceback.
+            if is_query_timeout_error(self._connector.engine, exc):
+                logger.warn("Query exceeded its deadline: %s", exc)
+                raise BackendTimeoutError(str(exc))
             if not is_operational_db_error(self._connector.engine, exc):
                 raise
             # An unexpected database-level error.
@@ -562,6 +903,7 @@ class DBConnection(object):
         self._connector = connector
         self._connection = None
         self._transaction = None
+        self._statement_timeout_set = None
 
     def __enter__(self):
         return self
@@ -572,9 +914,11 @@ class DBConnection(object):
         else:
             self.rollback()
 
+    @profile_phase("sql")
     @report_backend_errors
     def commit(self):
         """Commit the active transaction and close the connection."""
+        self._clear_deadline()
         try:
             if self._transaction is not None:
                 self._transaction.commit()
@@ -584,9 +928,11 @@ class DBConnection(object):
                 self._connection.close()
                 self._connection = None
 
+    @profile_phase("sql")
     @report_backend_errors
     def rollback(self):
         """Abort the active transaction and close the connection."""
+        self._clear_deadline()
         try:
             if self._transaction is not None:
                 self._transaction.rollback()
@@ -596,6 +942,7 @@ class DBConnection(object):
                 self._connection.close()
                 self._connection = None
 
+    @profile_phase("sql")
     @report_backend_errors
     def execute(self, query, params=None, annotations=None):
         """Execute a database query, with retry and exception-catching logic.
@@ -625,7 +972,8 @@ class DBConnection(object):
             # successfully used as part of this transaction.
             try:
                 query_str = self._render_query(query, params, annotations)
-                return self._exec_with_cleanup(connection, query_str, **params)
+                return self._exec_with_stats(connection, query_str, params,
+                                             annotations)
             except DBAPIError as exc:
                 if not is_retryable_db_error(self._connector.engine, exc):
                     raise
@@ -639,7 +987,8 @@ class DBConnection(object):
                 transaction = connection.begin()
                 annotations["retry"] = "1"
                 query_str = self._render_query(query, params, annotations)
-                return self._exec_with_cleanup(connection, query_str, **params)
+                return self._exec_with_stats(connection, query_str, params,
+                                             annotations)
         finally:
             # Now that the underlying connection has been used, remember it
             # so that all subsequent queries are part of the same transaction.
@@ -647,6 +996,126 @@ class DBConnection(object):
                 self._connection = connection
                 self._transaction = transaction
 
+    def _exec_with_stats(self, connection, query_str, params, annotations):
+        """Execution wrapper that records per-query statistics.
+
+        This times the execution of the query and records it in the
+        connector's QueryStats under the query's name, as well as in the
+        request metrics.  If it took longer than the configured threshold
+        then the shape of the query is written to the slow-query log.
+        """
+        query_name = annotations.get("queryName", "UNNAMED")
+        start = timeit.default_timer()
+        try:
+            return self._exec_with_deadline(connection, query_str, params)
+        finally:
+            duration = timeit.default_timer() - start
+            self._connector.query_stats.record_latency(query_name, duration)
+            metric_name = "syncstorage.storage.sql.query." + query_name
+            annotate_request(None, metric_name, duration)
+            threshold = self._connector.slow_query_threshold
+            if threshold is not None and duration >= threshold:
+                self._log_slow_query(query_name, query_str, params, duration)
+
+    def _log_slow_query(self, query_name, query_str, params, duration):
+        """Write details of a slow query to the slow-query log.
+
+        To keep the log useful and safe, this records only the general shape
+        of the query rather than the values of its parameters, and a hash of
+        the userid rather than the userid itself.
+        """
+        shape = QUERY_BINDS_LIST_RE.sub("(...)", query_str)
+        shape = QUERY_WHITESPACE_RE.sub(" ", shape).strip()
+        tables = sorted(set(QUERY_TABLES_RE.findall(query_str)))
+        # Multi-row upserts have numbered bind params for each row.
+        userid = params.get("userid", params.get("userid0"))
+        if userid is None:
+            userid_hash = None
+        else:
+            userid_hash = hashlib.sha256(str(userid)).hexdigest()[:16]
+        info = {
+            "query_name": query_name,
+            "query_shape": shape,
+            "query_tables": ",".join(tables),
+            "userid_hash": userid_hash,
+            "duration": duration,
+        }
+        slow_query_logger.warn("Slow query %s took %.3fs: %s",
+                               query_name, duration, shape, extra=info)
+
+    def _exec_with_deadline(self, connection, query_str, params):
+        """Execution wrapper that limits queries to the active deadline.
+
+        If a deadline has been set for the current storage operations, this
+        method asks the database to abort the query if it runs past that
+        deadline.  The mechanism depends on the database in use:
+
+            * MySQL gets a MAX_EXECUTION_TIME hint on SELECT statements
+            * PostgreSQL gets a statement_timeout for the transaction
+            * SQLite gets a progress handler that checks the time, which
+              stays in place until the transaction is finished
+
+        The statement_timeout is set only once per transaction and applies to
+        each statement individually, so on PostgreSQL a series of queries can
+        still overrun the deadline by up to one query's worth of time.
+        """
+        deadline = get_deadline()
+        if deadline is None:
+            return self._exec_with_cleanup(connection, query_str, **params)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise BackendTimeoutError("request deadline exceeded")
+        timeout_ms = max(int(remaining * 1000), 1)
+        driver = self._connector.driver
+        if driver == "mysql":
+            hint = r"\1 /*+ MAX_EXECUTION_TIME(%d) */ " % (timeout_ms,)
+            query_str = SELECT_HINT_POSITION.sub(hint, query_str, count=1)
+        elif driver == "postgres":
+            if self._statement_timeout_set != (connection, deadline):
+                timeout_query = self._render_query(
+                    "SET LOCAL statement_timeout = %d" % (timeout_ms,), {},
+                    {"queryName": "SET_STATEMENT_TIMEOUT"}
+                )
+                connection.execute(sqltext(timeout_query))
+                self._statement_timeout_set = (connection, deadline)
+        elif driver == "sqlite":
+            if self._statement_timeout_set != (connection, deadline):
+                connection.connection.set_progress_handler(
+                    lambda: time.time() > deadline, SQLITE_PROGRESS_INTERVAL
+                )
+                self._statement_timeout_set = (connection, deadline)
+        return self._exec_with_cleanup(connection, query_str, **params)
+
+    def reset_deadline(self):
+        """Drop the deadline from the active transaction, leaving it open.
+
+        This is for transactions that are shared by several operations in
+        turn, so that each one is not limited by the previous one's deadline.
+        """
+        if self._statement_timeout_set is not None:
+            if self._connector.driver == "postgres":
+                connection = self._statement_timeout_set[0]
+                reset_query = self._render_query(
+                    "SET LOCAL statement_timeout = 0", {},
+                    {"queryName": "RESET_STATEMENT_TIMEOUT"}
+                )
+                connection.execute(sqltext(reset_query))
+        self._clear_deadline()
+
+    def _clear_deadline(self):
+        """Remove any deadline-enforcing state from the active connection.
+
+        The PostgreSQL statement_timeout goes away with the transaction, but
+        the SQLite progress handler must be removed explicitly before the
+        connection is returned to the pool.
+        """
+        if self._statement_timeout_set is not None:
+            connection = self._statement_timeout_set[0]
+            self._statement_timeout_set = None
+            if self._connector.driver == "sqlite":
+                if not connection.invalidated:
+                    connection.connection.set_progress_handler(None, 0)
+
     @metrics_timer("syncstorage.storage.sql.db.execute")
     def _exec_with_cleanup(self, connection, query_str, **params):
         """Execution wrapper that kills queries if it is interrupted.
@@ -746,6 +1215,7 @@ class DBConnection(object):
         annotations.setdefault("queryName", query_name)
         res = self.execute(query, params, annotations)
         try:
+            self._record_rows(annotations, res.rowcount)
             return res.rowcount
         finally:
             res.close()
@@ -764,6 +1234,7 @@ class DBConnection(object):
             row = res.fetchone()
             if row is None or row[0] is None:
                 return default
+            self._record_rows(annotations, 1)
             return row[0]
         finally:
             res.close()
@@ -778,7 +1249,10 @@ class DBConnection(object):
         annotations.setdefault("queryName", query_name)
         res = self.execute(query, params, annotations)
         try:
-            return res.fetchone()
+            row = res.fetchone()
+            if row is not None:
+                self._record_rows(annotations, 1)
+            return row
         finally:
             res.close()
 
@@ -790,13 +1264,24 @@ class DBConnection(object):
                 annotations = {}
             annotations.setdefault("queryName", query_name)
             res = self.execute(query, params, annotations)
+            num_rows = 0
             try:
                 for row in res:
+                    num_rows += 1
                     yield row
             finally:
                 res.close()
+                self._record_rows(annotations, num_rows)
 
-    def insert_or_update(self, table, items, defaults=None, annotations=None):
+    def _record_rows(self, annotations, num_rows):
+        """Record the number of rows affected or returned by a query."""
+        query_name = annotations["queryName"]
+        self._connector.query_stats.record_rows(query_name, num_rows)
+        metric_name = "syncstorage.storage.sql.query." + query_name + ".rows"
+        annotate_request(None, metric_name, max(num_rows, 0))
+
+    def insert_or_update(self, table, items, defaults=None, annotations=None,
+                         guard=None, guard_params=None):
         """Perform an efficient bulk "upsert" of the given items.
 
         Given the name of a table and a list of data dicts to insert or update,
@@ -809,7 +1294,14 @@ class DBConnection(object):
         we can use the "ON DUPLICATE KEY UPDATE" syntax to do the operation
         in a single query.
 
-        The number of newly-inserted rows is returned.
+        If the name of a guard query is given, the items are only written
+        if that query finds a row when run with the given guard_params.  The
+        check is made by the statements that write the items, rather than by
+        a separate query beforehand.  The guard_params must not share names
+        with any of the columns being written.
+
+        The number of newly-inserted rows is returned, or None if the guard
+        query didn't find a row and so nothing was written.
         """
         if annotations is None:
             annotations = {}
@@ -830,19 +1322,38 @@ class DBConnection(object):
             table = self._connector.get_batch_item_table(batchid)
         else:
             table = metadata.tables[table]
+        # Render the guard into a condition that each statement can include.
+        if guard is not None:
+            if guard_params is None:
+                guard_params = {}
+            guard_params = guard_params.copy()
+            guard = self._connector.get_query(guard, guard_params)
+            assert guard is None or isinstance(guard, six.string_types)
+        if guard is not None:
+            guard = "EXISTS (%s)" % (guard,)
         # Dispatch to an appropriate implementation.
         if self._connector.driver == "mysql":
-            return self._upsert_onduplicatekey(table, items, defaults,
-                                               annotations)
+            num_created = self._upsert_onduplicatekey(table, items, defaults,
+                                                      annotations, guard,
+                                                      guard_params)
         else:
-            return self._upsert_generic(table, items, defaults, annotations)
+            num_created = self._upsert_generic(table, items, defaults,
+                                               annotations, guard,
+                                               guard_params)
+        if num_created is not None:
+            self._record_rows(annotations, len(items))
+        return num_created
 
-    def _upsert_generic(self, table, items, defaults, annotations):
+    def _upsert_generic(self, table, items, defaults, annotations,
+                        guard=None, guard_params=None):
         """Upsert a batch of items one at a time, trying UPDATE then INSERT.
 
         This is a tremendously inefficient way to write a batch of items,
         but it's guaranteed to work without special cooperation from the
         database.  For MySQL we use the much improved _upsert_onduplicatekey.
+
+        With a guard, the insert becomes an INSERT ... SELECT so that it can
+        have a WHERE clause, and nothing is written if the guard fails.
         """
         userid = items[0].get("userid")
         num_created = 0
@@ -862,19 +1373,36 @@ class DBConnection(object):
                     msg = "Item is missing primary key column %r"
                     raise ValueError(msg % (key.name,))
             query = query.values(**values)
-            res = self.execute(query, {}, annotations)
+            if guard is not None:
+                query = query.where(sqltext(guard))
+            res = self.execute(query, dict(guard_params or {}), annotations)
             res.close()
             # If the item wasnt there, insert it instead.
             if res.rowcount == 0:
-                query = insert(table)
-                if defaults is not None:
-                    query = query.values(**defaults)
-                query = query.values(**item)
-                self.execute(query, {}, annotations).close()
+                if guard is None:
+                    query = insert(table)
+                    if defaults is not None:
+                        query = query.values(**defaults)
+                    query = query.values(**item)
+                else:
+                    values = {}
+                    if defaults is not None:
+                        values.update(defaults)
+                    values.update(item)
+                    fields = sorted(values)
+                    rows = select([literal(values[f]) for f in fields])
+                    rows = rows.where(sqltext(guard))
+                    query = insert(table).from_select(fields, rows)
+                res = self.execute(query, dict(guard_params or {}),
+                                   annotations)
+                res.close()
+                if res.rowcount == 0:
+                    return None
                 num_created += 1
         return num_created
 
-    def _upsert_onduplicatekey(self, table, items, defaults, annotations):
+    def _upsert_onduplicatekey(self, table, items, defaults, annotations,
+                               guard=None, guard_params=None):
         """Upsert a batch of items using the ON DUPLICATE KEY UPDATE syntax.
 
         This is a custom batch upsert implementation based on non-standard
@@ -888,6 +1416,15 @@ class DBConnection(object):
 
         The values from the given items will be collected into a matching set
         of bind parameters :c11 through :cMN  when executing the query.
+
+        With a guard, the VALUES clause becomes a SELECT from the rows to be
+        written, with the guard in its WHERE clause:
+
+            INSERT INTO table (c1, ..., cM)
+            SELECT * FROM (SELECT :c11 AS c1, ..., :cM1 AS cM UNION ALL
+                           ... SELECT :c1N, ..., :cMN) AS new_rows
+            WHERE EXISTS (guard)
+            ON DUPLICATE KEY UPDATE c1 = VALUES(c1), ..., cM = VALUES(cM)
         """
         userid = items[0].get("userid")
         # Group the items to be inserted into batches that all have the same
@@ -912,11 +1449,14 @@ class DBConnection(object):
             assert all(SAFE_FIELD_NAME_RE.match(f) for f in insert_fields)
             # Each item corresponds to a set of bindparams and a matching
             # entry in the "VALUES" clause of the query.
-            query = "INSERT INTO %s (%s) VALUES "\
+            query = "INSERT INTO %s (%s) "\
                     % (table.name, ",".join(insert_fields))
             binds = [":%s%%(num)d" % field for field in insert_fields]
-            pattern = "(%s) " % ",".join(binds)
-            params = {}
+            if guard is None:
+                pattern = "(%s) " % ",".join(binds)
+            else:
+                pattern = "SELECT %s " % ",".join(binds)
+            params = dict(guard_params or {})
             vclauses = []
             for num, item in enumerate(batch):
                 vclauses.append(pattern % {"num": num})
@@ -926,7 +1466,15 @@ class DBConnection(object):
                     except KeyError:
                         value = defaults[field]
                     params["%s%d" % (field, num)] = value
-            query += ",".join(vclauses)
+            if guard is None:
+                query += "VALUES " + ",".join(vclauses)
+            else:
+                # Name the columns of the new rows in the first SELECT.
+                vclauses[0] = "SELECT %s " % ",".join(
+                    "%s AS %s" % (bind % {"num": 0}, field)
+                    for bind, field in zip(binds, insert_fields))
+                query += "SELECT * FROM (%s) AS new_rows WHERE %s"\
+                         % ("UNION ALL ".join(vclauses), guard)
             # The ON DUPLICATE KEY CLAUSE updates all the given fields.
             updates = ["%s = VALUES(%s)" % (f, f) for f in update_fields]
             query += " ON DUPLICATE KEY UPDATE " + ",".join(updates)
@@ -936,6 +1484,8 @@ class DBConnection(object):
             # and adds two to the rowcount for each item that was updated.
             # Arithmetic lets us find the actual numbers.
             try:
+                if guard is not None and res.rowcount == 0:
+                    return None
                 num_updated = res.rowcount - len(batch)
                 assert num_updated >= 0
                 num_created += (len(batch) - num_updated)
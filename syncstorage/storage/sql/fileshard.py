@@ -0,0 +1,468 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+SQLite backend for syncstorage that keeps a database file per user.
+
+With a single SQLite database, every writer takes an exclusive lock on the
+whole file, so write throughput doesn't grow with the number of cores.  This
+backend instead takes an sqluri template like:
+
+    sqlite:////var/lib/syncstorage/{shard}.db
+
+and gives each user their own database file, with "{shard}" replaced by
+their userid.  Alternatively the num_buckets setting hashes users into a
+fixed number of files, with "{shard}" replaced by userid % num_buckets.
+
+Each file is accessed through its own SQLStorage instance, and a bounded
+number of them are kept open at a time.  The files are put in WAL mode so
+that readers don't wait for writers either.
+"""
+
+import os
+import re
+import glob
+import errno
+import threading
+import contextlib
+from collections import OrderedDict
+
+from sqlalchemy.engine.url import make_url
+
+from syncstorage.storage import SyncStorage
+from syncstorage.storage.sql import SQLStorage
+
+
+SHARD_PLACEHOLDER = "{shard}"
+
+# Number of shards whose database files are kept open at once.
+DEFAULT_MAX_OPEN_SHARDS = 100
+
+# Each file only sees the requests of a few users at a time, so it doesn't
+# need a big connection pool of its own.
+DEFAULT_SHARD_POOL_SIZE = 5
+
+# Suffixes of the files that SQLite keeps alongside a database file.
+SQLITE_FILE_SUFFIXES = ("", "-wal", "-shm", "-journal")
+
+
+class FileShardedSQLStorage(SyncStorage):
+    """Storage plugin keeping a separate SQLite database file for each user.
+
+    The sqluri must be an SQLite URI containing the string "{shard}".  The
+    following keyword arguments customize the sharding:
+
+        * num_buckets:      hash users into this many database files,
+                            rather than giving each user a file of their own
+        * max_open_shards:  number of database files to keep open at once;
+                            the least recently used ones are closed, unless
+                            they are still in use
+        * journal_mode:     the SQLite journal mode to use for each file,
+                            which defaults to WAL
+
+    Any other arguments are passed to the SQLStorage instance for each file.
+    Tables are created in new files automatically, and tombstoned
+    collections are purged by purge_expired_items() rather than by a
+    background thread per file.
+
+    Each operation counts as a use of its shard for as long as it runs, or
+    for as long as the lock is held if it is made under a lock.  A shard's
+    files are only removed once it has no other uses, and it can't be
+    opened again until they have been.
+    """
+
+    def __init__(self, sqluri, num_buckets=None,
+                 max_open_shards=DEFAULT_MAX_OPEN_SHARDS,
+                 journal_mode="wal", **kwds):
+        url = make_url(sqluri)
+        if url.drivername != "sqlite" or not url.database or \
+                SHARD_PLACEHOLDER not in url.database:
+            msg = "sqluri must be an sqlite file path containing %r"
+            raise ValueError(msg % (SHARD_PLACEHOLDER,))
+        self.sqluri = sqluri
+        self.path_template = url.database
+        if num_buckets:
+            self.num_buckets = int(num_buckets)
+        else:
+            self.num_buckets = None
+        self.journal_mode = journal_mode
+        # Tables are only created in new files, see _create_shard_storage.
+        kwds.pop("create_tables", None)
+        kwds["async_delete_worker"] = False
+        kwds.setdefault("pool_size", DEFAULT_SHARD_POOL_SIZE)
+        self._shard_kwds = kwds
+        self.max_open_shards = int(max_open_shards)
+        # The open shards, from least to most recently used.
+        self._shards = OrderedDict()
+        # Protects the open shards, the uses of each shard, and the shards
+        # being opened or removed.  It's never held while opening or closing
+        # a file, so that doesn't hold up the users of other shards.
+        self._shards_lock = threading.Condition()
+        self._shard_uses = {}
+        self._opening_shards = set()
+        self._removing_shards = set()
+        # A thread-local to track the shards locked by the current thread.
+        self._tldata = threading.local()
+
+    #
+    # Private methods for finding the storage of each shard.
+    #
+
+    def _get_shard(self, userid):
+        if self.num_buckets is None:
+            return userid
+        return userid % self.num_buckets
+
+    def _get_shard_path(self, shard):
+        return self.path_template.replace(SHARD_PLACEHOLDER, str(shard))
+
+    @contextlib.contextmanager
+    def _get_storage(self, userid):
+        """Use the storage for the shard that holds the given user's data.
+
+        If the current thread has the shard locked, this is the instance
+        that holds the lock, without counting another use of it.
+        """
+        shard = self._get_shard(userid)
+        pinned = getattr(self._tldata, "pinned", {})
+        if shard in pinned:
+            yield pinned[shard][0]
+        else:
+            with self._using_shard(shard) as storage:
+                yield storage
+
+    @contextlib.contextmanager
+    def _using_shard(self, shard):
+        """Count a use of a shard's storage for the duration."""
+        storage = self._open_shard(shard)
+        try:
+            yield storage
+        finally:
+            self._release_shard(shard)
+
+    def _open_shard(self, shard):
+        """Get the storage for a shard, counting a new use of it.
+
+        If the shard isn't open, its storage is created outside of the lock,
+        and any other uses of the shard wait until it's ready.
+        """
+        with self._shards_lock:
+            while shard in self._removing_shards or \
+                    shard in self._opening_shards:
+                self._shards_lock.wait()
+            self._shard_uses[shard] = self._shard_uses.get(shard, 0) + 1
+            storage = self._shards.pop(shard, None)
+            if storage is not None:
+                self._shards[shard] = storage
+                return storage
+            self._opening_shards.add(shard)
+        try:
+            storage = self._create_shard_storage(shard)
+        except Exception:
+            with self._shards_lock:
+                self._opening_shards.discard(shard)
+            self._release_shard(shard)
+            raise
+        with self._shards_lock:
+            self._opening_shards.discard(shard)
+            self._shards[shard] = storage
+            evicted = self._evict_shards()
+            self._shards_lock.notify_all()
+        for old_shard, old_storage in evicted:
+            self._close_shard(old_shard, old_storage)
+        return storage
+
+    def _release_shard(self, shard):
+        """Count the end of a use of a shard."""
+        with self._shards_lock:
+            self._shard_uses[shard] -= 1
+            if self._shard_uses[shard]:
+                return
+            del self._shard_uses[shard]
+            evicted = self._evict_shards()
+            self._shards_lock.notify_all()
+        for old_shard, old_storage in evicted:
+            self._close_shard(old_shard, old_storage)
+
+    def _evict_shards(self):
+        """Take the least recently used shards out of the open shards.
+
+        This brings the number of open shards down to max_open_shards, if
+        possible without evicting any that are in use, and returns the ones
+        that need closing.  It must be called with the lock held.
+        """
+        evicted = []
+        num_excess = len(self._shards) - self.max_open_shards
+        for shard in list(self._shards):
+            if num_excess <= 0:
+                break
+            if not self._shard_uses.get(shard):
+                evicted.append((shard, self._shards.pop(shard)))
+                num_excess -= 1
+        return evicted
+
+    def _create_shard_storage(self, shard):
+        path = self._get_shard_path(shard)
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # Files that were already set up don't need to be again when
+        # they are reopened after being evicted from the cache.
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        sqluri = self.sqluri.replace(SHARD_PLACEHOLDER, str(shard))
+        storage = SQLStorage(sqluri, create_tables=is_new,
+                             **self._shard_kwds)
+        # The journal mode is stored in the file, so setting it once is
+        # enough for every connection that is opened on it.
+        if is_new and self.journal_mode:
+            engine = storage.dbconnector.engine
+            engine.execute("PRAGMA journal_mode=%s" %
+                           (self.journal_mode,)).scalar()
+        return storage
+
+    def _close_shard(self, shard, storage):  # pylint: disable=W0613
+        storage.dbconnector.engine.dispose()
+
+    def _remove_shard(self, shard):
+        """Close a shard and remove its database files.
+
+        This waits for any other uses of the shard to finish first, e.g.
+        another thread's transaction, and holds off any new ones until the
+        files are gone.  The current thread must not be using it.
+        """
+        with self._shards_lock:
+            while shard in self._removing_shards:
+                self._shards_lock.wait()
+            self._removing_shards.add(shard)
+        try:
+            with self._shards_lock:
+                while self._shard_uses.get(shard):
+                    self._shards_lock.wait()
+                storage = self._shards.pop(shard, None)
+            if storage is not None:
+                self._close_shard(shard, storage)
+            path = self._get_shard_path(shard)
+            for suffix in SQLITE_FILE_SUFFIXES:
+                try:
+                    os.unlink(path + suffix)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        finally:
+            with self._shards_lock:
+                self._removing_shards.discard(shard)
+                self._shards_lock.notify_all()
+
+    def _list_shards(self):
+        """List the shards that have a database file on disk."""
+        prefix, suffix = self.path_template.split(SHARD_PLACEHOLDER, 1)
+        pattern = re.compile(re.escape(prefix) + r"(\d+)" +
+                             re.escape(suffix) + "$")
+        shards = []
+        for path in glob.glob(self.path_template.replace(SHARD_PLACEHOLDER,
+                                                         "*")):
+            match = pattern.match(path)
+            if match is not None:
+                shards.append(int(match.group(1)))
+        return sorted(shards)
+
+    @contextlib.contextmanager
+    def _pinned(self, userid):
+        """Pin the storage of a user's shard to the current thread."""
+        shard = self._get_shard(userid)
+        try:
+            pinned = self._tldata.pinned
+        except AttributeError:
+            pinned = self._tldata.pinned = {}
+        if shard in pinned:
+            yield pinned[shard][0]
+            return
+        with self._using_shard(shard) as storage:
+            # Track whether the shard's files need removing on release.
+            pinned[shard] = [storage, False]
+            try:
+                yield storage
+            finally:
+                _, removed = pinned.pop(shard)
+        # The files of a deleted user can only be removed once the
+        # lock, and hence the transaction, has been released.  If it
+        # failed then the delete was rolled back and they must stay.
+        if removed:
+            self._remove_shard(shard)
+
+    #
+    # APIs for collection-level locking.
+    #
+
+    @contextlib.contextmanager
+    def lock_for_read(self, userid, collection):
+        """Acquire a shared read lock on the named collection."""
+        with self._pinned(userid) as storage:
+            with storage.lock_for_read(userid, collection):
+                yield None
+
+    @contextlib.contextmanager
+    def lock_for_write(self, userid, collection):
+        """Acquire an exclusive write lock on the named collection."""
+        with self._pinned(userid) as storage:
+            with storage.lock_for_write(userid, collection):
+                yield None
+
+    #
+    # APIs to operate on the entire storage.
+    #
+
+    def get_storage_timestamp(self, userid):
+        """Returns the last-modified timestamp for the entire storage."""
+        with self._get_storage(userid) as storage:
+            return storage.get_storage_timestamp(userid)
+
+    def get_collection_timestamps(self, userid):
+        """Returns the collection timestamps for a user."""
+        with self._get_storage(userid) as storage:
+            return storage.get_collection_timestamps(userid)
+
+    def get_collection_counts(self, userid):
+        """Returns the collection counts."""
+        with self._get_storage(userid) as storage:
+            return storage.get_collection_counts(userid)
+
+    def get_collection_sizes(self, userid):
+        """Returns the total size for each collection."""
+        with self._get_storage(userid) as storage:
+            return storage.get_collection_sizes(userid)
+
+    def get_total_size(self, userid, recalculate=False):
+        """Returns the total size a user's stored data."""
+        with self._get_storage(userid) as storage:
+            return storage.get_total_size(userid, recalculate)
+
+    def delete_storage(self, userid):
+        """Removes all data for the user.
+
+        If the user has a file of their own then the file is removed too,
+        as soon as any lock that the current thread holds on it is released.
+        """
+        with self._get_storage(userid) as storage:
+            storage.delete_storage(userid)
+        if self.num_buckets is None:
+            shard = self._get_shard(userid)
+            pinned = getattr(self._tldata, "pinned", {})
+            if shard in pinned:
+                pinned[shard][1] = True
+            else:
+                self._remove_shard(shard)
+
+    #
+    # APIs to operate on an individual collection
+    #
+
+    def get_collection_timestamp(self, userid, collection):
+        """Returns the last-modified timestamp for the named collection."""
+        with self._get_storage(userid) as storage:
+            return storage.get_collection_timestamp(userid, collection)
+
+    def get_items(self, userid, collection, **params):
+        """Returns items from a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.get_items(userid, collection, **params)
+
+    def get_item_ids(self, userid, collection, **params):
+        """Returns item ids from a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.get_item_ids(userid, collection, **params)
+
+    def set_items(self, userid, collection, items):
+        """Creates or updates multiple items in a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.set_items(userid, collection, items)
+
+    def delete_collection(self, userid, collection):
+        """Deletes an entire collection."""
+        with self._get_storage(userid) as storage:
+            return storage.delete_collection(userid, collection)
+
+    def delete_items(self, userid, collection, items):
+        """Deletes multiple items from a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.delete_items(userid, collection, items)
+
+    def create_batch(self, userid, collection):
+        """Creates a batch for multi-POST batch uploads."""
+        with self._get_storage(userid) as storage:
+            return storage.create_batch(userid, collection)
+
+    def valid_batch(self, userid, collection, batchid):
+        """Checks to see if the batch ID is valid and still open."""
+        with self._get_storage(userid) as storage:
+            return storage.valid_batch(userid, collection, batchid)
+
+    def append_items_to_batch(self, userid, collection, batchid, items):
+        """Appends items to the pending batch."""
+        with self._get_storage(userid) as storage:
+            return storage.append_items_to_batch(userid, collection, batchid,
+                                                 items)
+
+    def get_batch_totals(self, userid, collection, batchid):
+        """Returns the number of records and bytes appended to a batch."""
+        with self._get_storage(userid) as storage:
+            return storage.get_batch_totals(userid, collection, batchid)
+
+    def apply_batch(self, userid, collection, batchid):
+        """Applies the pending batch."""
+        with self._get_storage(userid) as storage:
+            return storage.apply_batch(userid, collection, batchid)
+
+    def close_batch(self, userid, collection, batchid):
+        """Close a specific batch."""
+        with self._get_storage(userid) as storage:
+            return storage.close_batch(userid, collection, batchid)
+
+    #
+    # Items APIs
+    #
+
+    def get_item_timestamp(self, userid, collection, item):
+        """Returns the last-modified timestamp for the named item."""
+        with self._get_storage(userid) as storage:
+            return storage.get_item_timestamp(userid, collection, item)
+
+    def get_item(self, userid, collection, item):
+        """Returns one item from a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.get_item(userid, collection, item)
+
+    def set_item(self, userid, collection, item, data):
+        """Creates or updates a single item in a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.set_item(userid, collection, item, data)
+
+    def delete_item(self, userid, collection, item):
+        """Deletes a single item from a collection."""
+        with self._get_storage(userid) as storage:
+            return storage.delete_item(userid, collection, item)
+
+    #
+    # Administrative/maintenance methods.
+    #
+
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000):
+        """Purges expired items from each of the database files in turn.
+
+        The counts of purged rows in the result are totalled over all files.
+        """
+        result = {"is_complete": True}
+        for shard in self._list_shards():
+            with self._using_shard(shard) as storage:
+                res = storage.purge_expired_items(grace_period, max_per_loop)
+            for key, value in res.items():
+                if key == "is_complete":
+                    result[key] = result[key] and value
+                else:
+                    result[key] = result.get(key, 0) + value
+        return result
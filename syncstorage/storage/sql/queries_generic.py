@@ -17,10 +17,36 @@ string interpolation variables with special meaning:
     * %(bso)s:   insert the name of the user's sharded BSO storage table
     * %(bui)s:   insert the name of the user's sharded batch_upload_items table
     * %(ids)s:   insert a list of items matching the "ids" query parameter.
+    * %(not_tombstoned)s:  insert a condition excluding items that belong to
+                           a deleted collection but haven't been purged yet;
+                           this is empty unless async_deletes is enabled.
+
+Lists of ids are padded to a power-of-two length, so that each query has
+only a handful of distinct forms for the database to parse and cache.
 
 """
 
-from sqlalchemy.sql import select, bindparam
+from sqlalchemy.sql import select, bindparam, func, table, column
+
+# Lightweight description of the bso_tombstones table, for use in FIND_ITEMS.
+bso_tombstones = table("bso_tombstones", column("userid"),
+                       column("collection"), column("modified"))
+
+
+def pad_ids(ids):
+    """Pad a list of ids to a power-of-two length by repeating the last one.
+
+    Repeating an id in an "IN" expression does not change its result, so
+    the padding is harmless.  An empty list is returned unchanged.
+    """
+    ids = list(ids)
+    size = 1
+    while size < len(ids):
+        size *= 2
+    if ids:
+        ids.extend([ids[-1]] * (size - len(ids)))
+    return ids
+
 
 # Queries operating on all collections in the storage.
 
@@ -28,23 +54,74 @@ STORAGE_TIMESTAMP = "SELECT MAX(last_modified) FROM user_collections "\
                     "WHERE userid=:userid"
 
 STORAGE_SIZE = "SELECT SUM(payload_size) FROM %(bso)s WHERE "\
-               "userid=:userid AND ttl>:ttl"
+               "userid=:userid AND ttl>:ttl%(not_tombstoned)s"
 
 COLLECTIONS_TIMESTAMPS = "SELECT collection, last_modified "\
                          "FROM user_collections WHERE userid=:userid"
 
 COLLECTIONS_COUNTS = "SELECT collection, COUNT(collection) FROM %(bso)s "\
-                     "WHERE userid=:userid AND ttl>:ttl "\
+                     "WHERE userid=:userid AND ttl>:ttl%(not_tombstoned)s "\
                      "GROUP BY collection"
 
 COLLECTIONS_SIZES = "SELECT collection, SUM(payload_size) FROM %(bso)s "\
-                    "WHERE userid=:userid AND ttl>:ttl "\
+                    "WHERE userid=:userid AND ttl>:ttl%(not_tombstoned)s "\
                     "GROUP BY collection"
 
 DELETE_ALL_BSOS = "DELETE FROM %(bso)s WHERE userid=:userid"
 
 DELETE_ALL_COLLECTIONS = "DELETE FROM user_collections WHERE userid=:userid"
 
+# Queries for deleting collections by tombstoning them.  Any items in the
+# collection with a timestamp before that of its tombstone are treated as
+# deleted, and are purged in the background.
+
+TOMBSTONE_TIMESTAMP = "SELECT modified FROM bso_tombstones "\
+                      "WHERE userid=:userid AND collection=:collectionid"
+
+UPDATE_TOMBSTONE = "UPDATE bso_tombstones SET modified=:modified "\
+                   "WHERE userid=:userid AND collection=:collectionid"
+
+INSERT_TOMBSTONE = "INSERT INTO bso_tombstones "\
+                   "(userid, collection, modified) "\
+                   "VALUES (:userid, :collectionid, :modified)"
+
+UPDATE_ALL_TOMBSTONES = "UPDATE bso_tombstones SET modified=:modified "\
+                        "WHERE userid=:userid AND modified<:modified"
+
+INSERT_ALL_TOMBSTONES = """
+    INSERT INTO bso_tombstones (userid, collection, modified)
+    SELECT userid, collection, :modified
+    FROM user_collections
+    WHERE
+        userid = :userid AND
+        collection NOT IN (
+            SELECT collection FROM bso_tombstones WHERE userid = :userid
+        )
+"""
+
+# Items written in the same instant as the tombstone would outlive it,
+# so they are deleted straight away.
+
+DELETE_RECENT_BSOS = "DELETE FROM %(bso)s WHERE userid=:userid "\
+                     "AND modified>=:modified"
+
+DELETE_RECENT_COLLECTION_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
+                                 "AND collection=:collectionid "\
+                                 "AND modified>=:modified"
+
+DELETE_TOMBSTONED_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
+                          "AND collection=:collectionid "\
+                          "AND modified<:tombstone AND id IN %(ids)s"
+
+DELETE_TOMBSTONED_BATCH_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE
+        userid = :userid AND
+        collection = :collectionid AND
+        modified < :tombstone AND
+        id IN (SELECT id FROM %(bui)s WHERE batch = :batch)
+"""
+
 # Queries for locking/unlocking a collection.
 
 BEGIN_TRANSACTION_READ = None
@@ -59,6 +136,19 @@ LOCK_COLLECTION_WRITE = "SELECT last_modified FROM user_collections "\
                         "WHERE userid=:userid AND collection=:collectionid "\
                         "FOR UPDATE"
 
+LOCK_COLLECTION_WRITE_NOWAIT = "SELECT last_modified FROM user_collections "\
+                               "WHERE userid=:userid "\
+                               "AND collection=:collectionid "\
+                               "FOR UPDATE NOWAIT"
+
+# Queries for isolating the members of a group commit from each other.
+
+SAVEPOINT_GROUP_MEMBER = "SAVEPOINT group_member"
+
+RELEASE_GROUP_MEMBER = "RELEASE SAVEPOINT group_member"
+
+ROLLBACK_GROUP_MEMBER = "ROLLBACK TO SAVEPOINT group_member"
+
 # Queries operating on a particular collection.
 
 COLLECTION_ID = "SELECT collectionid FROM collections "\
@@ -70,6 +160,8 @@ COLLECTION_NAME = "SELECT name FROM collections "\
 COLLECTION_NAMES = "SELECT collectionid, name FROM collections "\
                    "WHERE collectionid IN %(ids)s"
 
+ALL_COLLECTIONS = "SELECT collectionid, name FROM collections"
+
 # This adds a dummy collection at (:id - 1) so the next autoincr value is :id.
 SET_MIN_COLLECTION_ID = "INSERT INTO collections (collectionid, name) "\
                         "VALUES (:collectionid - 1, \"\")"
@@ -84,6 +176,10 @@ INIT_COLLECTION = "INSERT INTO user_collections "\
 TOUCH_COLLECTION = "UPDATE user_collections SET last_modified=:modified "\
                    "WHERE userid=:userid AND collection=:collectionid"
 
+# There's no standard way to insert-or-update a row in a single statement,
+# so by default we fall back to TOUCH_COLLECTION then INIT_COLLECTION.
+UPSERT_COLLECTION = None
+
 COLLECTION_TIMESTAMP = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid"
 
@@ -102,6 +198,16 @@ CREATE_BATCH = "INSERT INTO batch_uploads (batch, userid, collection) "\
 VALID_BATCH = "SELECT batch FROM batch_uploads WHERE batch = :batch " \
                     "AND userid = :userid AND collection = :collection"
 
+ADD_TO_BATCH_TOTALS = "UPDATE batch_uploads "\
+                      "SET total_records = total_records + :records, "\
+                      "total_bytes = total_bytes + :bytes "\
+                      "WHERE batch = :batch AND userid = :userid "\
+                      "AND collection = :collection"
+
+BATCH_TOTALS = "SELECT total_records, total_bytes FROM batch_uploads "\
+               "WHERE batch = :batch AND userid = :userid "\
+               "AND collection = :collection"
+
 # The semantics we want for applying a batch are roughly
 # those of an UPSERT, but there's no good generic way
 # to do that.  This is a best-effort, inefficient fallback
@@ -183,6 +289,73 @@ APPLY_BATCH_INSERT = """
         )
 """
 
+# Large batches can instead be applied a chunk of items at a time, so that
+# no single statement has to work through the whole batch.  The chunks are
+# taken in order of id, and each is applied with the same logic as above.
+
+BATCH_CHUNK_IDS = "SELECT id FROM %(bui)s WHERE batch = :batch "\
+                  "AND id > :after ORDER BY id LIMIT :maxitems"
+
+APPLY_BATCH_CHUNK_UPDATE = """
+    UPDATE %(bso)s
+    SET
+        sortindex = COALESCE(
+            (SELECT sortindex FROM %(bui)s WHERE
+                batch = :batch AND id = %(bso)s.id),
+            %(bso)s.sortindex
+        ),
+        payload = COALESCE(
+            (SELECT payload FROM %(bui)s WHERE
+                batch = :batch AND id = %(bso)s.id),
+            %(bso)s.payload,
+            ''
+        ),
+        payload_size = COALESCE(
+            (SELECT payload_size FROM %(bui)s WHERE
+                batch = :batch AND id = %(bso)s.id),
+            %(bso)s.payload_size,
+            0
+        ),
+        ttl = COALESCE(
+            (SELECT ttl_offset + :ttl_base FROM %(bui)s WHERE
+                batch = :batch AND id = %(bso)s.id),
+            %(bso)s.ttl,
+            :default_ttl
+        ),
+        modified = :modified
+    WHERE
+        userid = :userid AND
+        collection = :collection AND
+        id IN %(ids)s
+"""
+
+APPLY_BATCH_CHUNK_INSERT = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, sortindex, payload,
+        payload_size, ttl, modified)
+    SELECT
+       :userid,
+       :collection,
+       id,
+       sortindex,
+       COALESCE(payload, ''),
+       COALESCE(payload_size, 0),
+       COALESCE(ttl_offset + :ttl_base, :default_ttl),
+       :modified
+    FROM %(bui)s
+    WHERE
+        batch = :batch AND
+        id IN %(ids)s AND
+        id NOT IN (
+            SELECT id
+            FROM %(bso)s
+            WHERE
+                userid = :userid AND
+                collection = :collection AND
+                id IN %(ids)s
+        )
+"""
+
 CLOSE_BATCH = "DELETE FROM batch_uploads WHERE batch = :batch " \
               "AND userid = :userid AND collection = :collection"
 
@@ -203,8 +376,15 @@ def FIND_ITEMS(bso, params):
     query = query.where(bso.c.collection == bindparam("collectionid"))
     # Filter by the various query parameters.
     if "ids" in params:
-        # Sadly, we can't use a bindparam in an "IN" expression.
-        query = query.where(bso.c.id.in_(params.get("ids")))
+        ids = pad_ids(params["ids"])
+        if not ids:
+            query = query.where(bso.c.id.in_([]))
+        else:
+            bindparams = []
+            for i, id in enumerate(ids):
+                params["id%d" % (i,)] = id
+                bindparams.append(bindparam("id%d" % (i,)))
+            query = query.where(bso.c.id.in_(bindparams))
     if "newer" in params:
         query = query.where(bso.c.modified > bindparam("newer"))
     if "newer_eq" in params:
@@ -215,19 +395,33 @@ def FIND_ITEMS(bso, params):
         query = query.where(bso.c.modified <= bindparam("older_eq"))
     if "ttl" in params:
         query = query.where(bso.c.ttl > bindparam("ttl"))
+    if params.get("not_tombstoned"):
+        tombstone = select([bso_tombstones.c.modified])
+        tombstone = tombstone.where(bso_tombstones.c.userid == bso.c.userid)
+        tombstone = tombstone.where(
+            bso_tombstones.c.collection == bso.c.collection)
+        tombstone = func.coalesce(tombstone.as_scalar(), 0)
+        query = query.where(bso.c.modified >= tombstone)
     # Sort it in the order requested.
     # We always sort by *something*, so that limit/offset work consistently.
     # The default order is by timestamp, which if efficient due to the index.
     # NOTE: ideally we would sort by "id" here as secondary column, to get a
     # consistent total ordering.  But we don't want to bloat the index, so
     # we just assume that the db gives results in a consistent order.
+    # Callers that merge several result sets can ask for the "id" tiebreak.
     sort = params.get("sort", None)
     if sort == 'index':
         query = query.order_by(bso.c.sortindex.desc())
+        if params.get("order_by_id"):
+            query = query.order_by(bso.c.id.desc())
     elif sort == 'oldest':
         query = query.order_by(bso.c.modified.asc())
+        if params.get("order_by_id"):
+            query = query.order_by(bso.c.id.asc())
     else:
         query = query.order_by(bso.c.modified.desc())
+        if params.get("order_by_id"):
+            query = query.order_by(bso.c.id.desc())
     # Apply limit and/or offset.
     limit = params.get("limit", None)
     if limit is not None:
@@ -241,15 +435,17 @@ def FIND_ITEMS(bso, params):
 # Queries operating on a particular item.
 
 DELETE_ITEM = "DELETE FROM %(bso)s WHERE userid=:userid AND "\
-              "collection=:collectionid AND id=:item AND ttl>:ttl"\
+              "collection=:collectionid AND id=:item AND "\
+              "ttl>:ttl%(not_tombstoned)s"
 
 ITEM_DETAILS = "SELECT id, sortindex, modified, payload "\
                "FROM %(bso)s WHERE collection=:collectionid "\
-               "AND userid=:userid AND id=:item AND ttl>:ttl"
+               "AND userid=:userid AND id=:item AND "\
+               "ttl>:ttl%(not_tombstoned)s"
 
 ITEM_TIMESTAMP = "SELECT modified FROM %(bso)s "\
                  "WHERE collection=:collectionid AND userid=:userid "\
-                 "AND id=:item AND ttl>:ttl"
+                 "AND id=:item AND ttl>:ttl%(not_tombstoned)s"
 
 # Administrative queries
 
@@ -269,6 +465,20 @@ PURGE_BATCHES = """
     WHERE batch < (UNIX_TIMESTAMP() - :lifetime - :grace) * 1000
 """
 
+# Likewise this nominally deletes *some* items of a tombstoned collection,
+# but the generic version deletes all of them in one go.
+
+FIND_TOMBSTONES = "SELECT userid, collection, modified FROM bso_tombstones"
+
+PURGE_SOME_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid AND
+          modified < :modified
+"""
+
+DELETE_TOMBSTONE = "DELETE FROM bso_tombstones WHERE userid=:userid "\
+                   "AND collection=:collectionid AND modified=:modified"
+
 PURGE_BATCH_CONTENTS = """
     DELETE FROM %(bui)s
     WHERE batch < (UNIX_TIMESTAMP() - :lifetime - :grace) * 1000
@@ -16,6 +16,13 @@ PURGE_SOME_EXPIRED_ITEMS = """
     ORDER BY ttl LIMIT :maxitems
 """
 
+PURGE_SOME_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid AND
+          modified < :modified
+    ORDER BY modified LIMIT :maxitems
+"""
+
 PURGE_BATCHES = """
     DELETE FROM batch_uploads
     WHERE batch < (UNIX_TIMESTAMP() - :lifetime - :grace) * 1000
@@ -28,6 +35,14 @@ PURGE_BATCH_CONTENTS = """
     ORDER BY batch LIMIT :maxitems
 """
 
+# Touch a collection with a single statement, whether or not it exists.
+
+UPSERT_COLLECTION = "INSERT INTO user_collections "\
+                    "(userid, collection, last_modified) "\
+                    "VALUES (:userid, :collectionid, :modified) "\
+                    "ON DUPLICATE KEY UPDATE "\
+                    "last_modified = VALUES(last_modified)"
+
 # MySQL's non-standard ON DUPLICATE KEY UPDATE means we can
 # apply a batch efficiently with a single query.
 
@@ -55,3 +70,28 @@ APPLY_BATCH_INSERT = """
         payload_size = COALESCE(%(bui)s.payload_size,
                                 %(bso)s.payload_size)
 """
+
+APPLY_BATCH_CHUNK_UPDATE = None
+
+APPLY_BATCH_CHUNK_INSERT = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, modified, sortindex,
+        ttl, payload, payload_size)
+    SELECT
+        :userid, :collection, id, :modified, sortindex,
+        COALESCE(ttl_offset + :ttl_base, :default_ttl),
+        COALESCE(payload, ''),
+        COALESCE(payload_size, 0)
+    FROM %(bui)s
+    WHERE batch = :batch AND id IN %(ids)s
+    ON DUPLICATE KEY UPDATE
+        modified = :modified,
+        sortindex = COALESCE(%(bui)s.sortindex,
+                             %(bso)s.sortindex),
+        ttl = COALESCE(%(bui)s.ttl_offset + :ttl_base,
+                       %(bso)s.ttl),
+        payload = COALESCE(%(bui)s.payload,
+                           %(bso)s.payload),
+        payload_size = COALESCE(%(bui)s.payload_size,
+                                %(bso)s.payload_size)
+"""
@@ -35,6 +35,14 @@ INIT_COLLECTION = "INSERT INTO user_collections "\
                   "    (SELECT 1 FROM user_collections "\
                   "     WHERE userid=:userid AND collection=:collectionid)"
 
+# Postgres 9.5 and later can touch a collection with a single statement.
+
+UPSERT_COLLECTION = "INSERT INTO user_collections "\
+                    "(userid, collection, last_modified) "\
+                    "VALUES (:userid, :collectionid, :modified) "\
+                    "ON CONFLICT (userid, collection) DO UPDATE "\
+                    "SET last_modified = EXCLUDED.last_modified"
+
 # Postgres uses a special sequence thingamabob to handle auto-increment
 # columns, so we need a special way to pin its minimum value.
 
@@ -62,6 +70,16 @@ PURGE_SOME_EXPIRED_ITEMS = """
     WHERE ttl < (EXTRACT(EPOCH FROM CURRENT_TIMESTAMP) - :grace)
 """
 
+PURGE_SOME_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE (userid, collection, id) IN (
+        SELECT userid, collection, id FROM %(bso)s
+        WHERE userid = :userid AND collection = :collectionid AND
+              modified < :modified
+        LIMIT :maxitems
+    )
+"""
+
 PURGE_BATCHES = """
     DELETE FROM batch_uploads
     WHERE batch < (
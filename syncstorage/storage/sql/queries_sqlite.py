@@ -20,6 +20,22 @@ LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
 LOCK_COLLECTION_WRITE = "SELECT last_modified FROM user_collections "\
                         "WHERE userid=:userid AND collection=:collectionid"
 
+# Python 2's sqlite3 module commits the open transaction before running a
+# SAVEPOINT statement, so the members of a group commit can't be isolated.
+
+SAVEPOINT_GROUP_MEMBER = None
+
+RELEASE_GROUP_MEMBER = None
+
+ROLLBACK_GROUP_MEMBER = None
+
+# The user_collections table has no columns other than the key and the
+# timestamp, so it's safe to replace the whole row.
+
+UPSERT_COLLECTION = "INSERT OR REPLACE INTO user_collections "\
+                    "(userid, collection, last_modified) "\
+                    "VALUES (:userid, :collectionid, :modified)"
+
 # Use the correct timestamp-handling functions for sqlite.
 
 PURGE_SOME_EXPIRED_ITEMS = """
@@ -27,6 +43,16 @@ PURGE_SOME_EXPIRED_ITEMS = """
     WHERE ttl < (strftime('%%s', 'now') - :grace)
 """
 
+PURGE_SOME_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE rowid IN (
+        SELECT rowid FROM %(bso)s
+        WHERE userid = :userid AND collection = :collectionid AND
+              modified < :modified
+        LIMIT :maxitems
+    )
+"""
+
 PURGE_BATCHES = """
     DELETE FROM batch_uploads
     WHERE batch < (strftime('%s', 'now') - :lifetime - :grace) * 1000
@@ -69,3 +95,29 @@ APPLY_BATCH_INSERT = """
     WHERE
         batch_uploads.batch = :batch
 """
+
+APPLY_BATCH_CHUNK_UPDATE = None
+
+APPLY_BATCH_CHUNK_INSERT = """
+    INSERT OR REPLACE INTO %(bso)s
+        (userid, collection, id, sortindex, payload,
+        payload_size, ttl, modified)
+    SELECT
+       :userid,
+       :collection,
+       %(bui)s.id,
+       COALESCE(%(bui)s.sortindex, existing.sortindex),
+       COALESCE(%(bui)s.payload, existing.payload, ''),
+       COALESCE(%(bui)s.payload_size, existing.payload_size, 0),
+       COALESCE(%(bui)s.ttl_offset + :ttl_base, existing.ttl, :default_ttl),
+       :modified
+    FROM %(bui)s
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = :userid AND
+        existing.collection = :collection AND
+        existing.id = %(bui)s.id
+    WHERE
+        %(bui)s.batch = :batch AND
+        %(bui)s.id IN %(ids)s
+"""
@@ -1516,6 +1516,41 @@ class TestStorage(StorageFunctionalTestCase):
         }, status=400)
         self.assertEquals(res.json, WEAVE_SIZE_LIMIT_EXCEEDED)
 
+    def test_batch_size_limits_are_counted_by_server(self):
+        if self.distant:
+            raise unittest.SkipTest
+
+        settings = self.config.registry.settings
+        settings["storage.max_total_records"] = 3
+        settings["storage.max_total_bytes"] = 12
+        endpoint = self.root + '/storage/col2'
+
+        # The running totals are reported back after each POST.
+        bsos = [{'id': 'a', 'payload': 'aaaa'}, {'id': 'b', 'payload': 'bb'}]
+        res = self.app.post_json(endpoint + '?batch=true', bsos)
+        self.assertEquals(res.json['total_records'], 2)
+        self.assertEquals(res.json['total_bytes'], 6)
+        batch = res.json['batch']
+
+        # Exceeding a limit fails, and doesn't add anything to the batch,
+        # even if the client doesn't declare the totals in its headers.
+        bsos = [{'id': 'c', 'payload': 'c'}, {'id': 'd', 'payload': 'd'}]
+        res = self.app.post_json(endpoint + '?batch=' + batch, bsos,
+                                 status=400)
+        self.assertEquals(res.json, WEAVE_SIZE_LIMIT_EXCEEDED)
+        bsos = [{'id': 'c', 'payload': 'c' * 7}]
+        res = self.app.post_json(endpoint + '?batch=' + batch, bsos,
+                                 status=400)
+        self.assertEquals(res.json, WEAVE_SIZE_LIMIT_EXCEEDED)
+
+        bsos = [{'id': 'c', 'payload': 'c' * 6}]
+        res = self.app.post_json(endpoint + '?batch=' + batch, bsos)
+        self.assertEquals(res.json['total_records'], 3)
+        self.assertEquals(res.json['total_bytes'], 12)
+        self.app.post_json(endpoint + '?commit=true&batch=' + batch, [])
+        res = self.app.get(endpoint)
+        self.assertEquals(sorted(res.json), ['a', 'b', 'c'])
+
     def test_batch_partial_update(self):
         collection = self.root + '/storage/col2'
         bsos = [
@@ -1898,6 +1933,24 @@ class TestStoragePaginated(TestStorage):
     TEST_INI_FILE = "tests-paginated.ini"
 
 
+class TestStorageMemory(TestStorage):
+    """Storage testcases run against the in-memory backend."""
+
+    TEST_INI_FILE = "tests-memory.ini"
+
+
+class TestStorageSegment(TestStorage):
+    """Storage testcases run against the segment file backend."""
+
+    TEST_INI_FILE = "tests-segment.ini"
+
+
+class TestStorageFileSharded(TestStorage):
+    """Storage testcases run against per-user sqlite files."""
+
+    TEST_INI_FILE = "tests-fileshard.ini"
+
+
 class TestStorageWithBatchUploadDisabled(TestStorage):
     """Storage testcases run with batch uploads disabled via feature flag."""
 
@@ -1980,6 +2033,10 @@ class TestStorageWithBatchUploadDisabled(TestStorage):
         self.assertTrue('max_total_bytes' not in limits)
         self.assertTrue('max_record_payload_bytes' in limits)
 
+    def test_batch_size_limits_are_counted_by_server(self):
+        # Without batch uploads, there's nothing for this test to test.
+        pass
+
     def test_batch_with_failing_bsos(self):
         # Without batch uploads, there's nothing for this test to test.
         pass
@@ -4,6 +4,7 @@
 
 import os
 import uuid
+import shutil
 import functools
 
 import sqlalchemy.event
@@ -102,11 +103,17 @@ class StorageTestCase(TestCase):
                 continue
             while hasattr(storage, "storage"):
                 storage = storage.storage
+            # Backends that don't use a db may still have files on disk.
+            if not hasattr(storage, "dbconnector"):
+                if getattr(storage, "path", None):
+                    shutil.rmtree(storage.path, ignore_errors=True)
+                continue
             # For server-based dbs, drop the tables to clear them.
             if storage.dbconnector.driver in ("mysql", "postgres"):
                 with storage.dbconnector.connect() as c:
                     c.execute('DROP TABLE bso')
                     c.execute('DROP TABLE user_collections')
+                    c.execute('DROP TABLE bso_tombstones')
                     c.execute('DROP TABLE collections')
                     c.execute('DROP TABLE batch_uploads')
                     c.execute('DROP TABLE batch_upload_items')
@@ -116,6 +123,11 @@ class StorageTestCase(TestCase):
         for key, value in self.config.registry.settings.items():
             if key.endswith(".sqluri"):
                 sqluri = urllib.parse.urlparse(value)
+                # Sharded sqlite files live together in a directory.
+                if sqluri.scheme == 'sqlite' and "{shard}" in value:
+                    dirname = os.path.dirname(sqluri.path)
+                    shutil.rmtree(dirname, ignore_errors=True)
+                    continue
                 if sqluri.scheme == 'sqlite' and ":memory:" not in value:
                     if os.path.isfile(sqluri.path):
                         os.remove(sqluri.path)
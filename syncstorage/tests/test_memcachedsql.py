@@ -15,6 +15,8 @@ try:
 except ImportError:
     MEMCACHED = False
 
+from testfixtures import Replacer
+
 from mozsvc.exceptions import BackendError
 
 from syncstorage.tests.support import StorageTestCase
@@ -22,12 +24,101 @@ from syncstorage.tests.test_storage import StorageTestsMixin
 
 from syncstorage.storage import (load_storage_from_settings,
                                  CollectionNotFoundError,
-                                 ItemNotFoundError)
+                                 ItemNotFoundError,
+                                 InvalidBatch)
 
 _UID = 1
 _PLD = '*' * 500
 
 
+class FakeMemcacheClient(object):
+    """In-process stand-in for umemcache.Client, backed by a dict.
+
+    It gives the same responses as umemcache does for a real server, so
+    that the memcached tests can run without one.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.next_casid = 1
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def _lookup(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[3] and entry[3] < time.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def _store(self, key, value, expiry, flags):
+        if expiry and expiry <= 60 * 60 * 24 * 30:
+            expiry += time.time()
+        self.next_casid += 1
+        self.data[key] = (value, flags, self.next_casid, expiry)
+        return "STORED"
+
+    def get(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        return entry[:2]
+
+    def gets(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        return entry[:3]
+
+    def get_multi(self, keys):
+        return dict((key, self.get(key)) for key in keys
+                    if self._lookup(key) is not None)
+
+    def set(self, key, value, expiry=0, flags=0):
+        return self._store(key, value, expiry, flags)
+
+    def add(self, key, value, expiry=0, flags=0):
+        if self._lookup(key) is not None:
+            return "NOT_STORED"
+        return self._store(key, value, expiry, flags)
+
+    def replace(self, key, value, expiry=0, flags=0):
+        if self._lookup(key) is None:
+            return "NOT_STORED"
+        return self._store(key, value, expiry, flags)
+
+    def cas(self, key, value, casid, expiry=0, flags=0):
+        entry = self._lookup(key)
+        if entry is None:
+            return "NOT_FOUND"
+        if entry[2] != casid:
+            return "EXISTS"
+        return self._store(key, value, expiry, flags)
+
+    def incr(self, key, delta=1):
+        entry = self._lookup(key)
+        if entry is None:
+            return "NOT_FOUND"
+        value = str(int(entry[0]) + delta)
+        self.data[key] = (value,) + entry[1:]
+        return value
+
+    def delete(self, key):
+        if self._lookup(key) is None:
+            return "NOT_FOUND"
+        del self.data[key]
+        return "DELETED"
+
+
 class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
 
     TEST_INI_FILE = "tests-memcached.ini"
@@ -150,6 +241,120 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         collection = self.storage.cache.get('1:c:tabs')
         self.assertEquals(collection, None)
 
+    def test_expired_items_are_swept_from_cache(self):
+        self.storage.set_items(_UID, 'tabs', [
+            {'id': '1', 'payload': _PLD, 'ttl': 100},
+            {'id': '2', 'payload': _PLD},
+        ])
+        collection = self.storage.cache.get('1:c:tabs')
+        ttl = collection['items']['1']['ttl']
+        self.assertEquals(collection['expiry'], [[ttl, '1']])
+
+        # Changing or removing the ttl keeps the index in sync.
+        time.sleep(0.01)
+        self.storage.set_item(_UID, 'tabs', '2', {'ttl': 200})
+        self.storage.set_item(_UID, 'tabs', '1', {'ttl': None})
+        collection = self.storage.cache.get('1:c:tabs')
+        ttl = collection['items']['2']['ttl']
+        self.assertEquals(collection['expiry'], [[ttl, '2']])
+
+        # Pretend the item expired long ago; the next write purges it.
+        collection['items']['2']['ttl'] = 1
+        collection['expiry'] = [[1, '2']]
+        self.storage.cache.set('1:c:tabs', collection)
+        self.assertEquals(self.storage.get_item_ids(_UID, 'tabs')['items'],
+                          ['1'])
+        time.sleep(0.01)
+        self.storage.set_item(_UID, 'tabs', '3', {'payload': _PLD})
+        collection = self.storage.cache.get('1:c:tabs')
+        self.assertEquals(sorted(collection['items']), ['1', '3'])
+        self.assertEquals(collection['expiry'], [])
+
+    def test_tabs_batches_are_append_only(self):
+        batch = self.storage.create_batch(_UID, 'tabs')
+        header = '1:c:tabs:batch:%s' % (batch,)
+        self.assertEquals(self.storage.cache.get(header), 0)
+
+        # Each append gets its own key, leaving earlier ones untouched.
+        self.storage.append_items_to_batch(_UID, 'tabs', batch,
+                                           [{'id': '1', 'payload': _PLD}])
+        self.storage.append_items_to_batch(_UID, 'tabs', batch,
+                                           [{'id': '2', 'payload': _PLD},
+                                            {'id': '1', 'payload': 'x'}])
+        self.assertEquals(self.storage.cache.get(header), 2)
+        self.assertEquals(len(self.storage.cache.get(header + ':1')), 1)
+        self.assertEquals(len(self.storage.cache.get(header + ':2')), 2)
+        self.assertRaises(CollectionNotFoundError,
+                          self.storage.get_items, _UID, 'tabs')
+        self.assertEquals(self.storage.get_batch_totals(_UID, 'tabs', batch),
+                          (3, 2 * len(_PLD) + 1))
+
+        # Later appends win when the batch is applied.
+        self.storage.apply_batch(_UID, 'tabs', batch)
+        self.assertEquals(self.storage.get_item(_UID, 'tabs', '1')['payload'],
+                          'x')
+        self.assertEquals(self.storage.get_item(_UID, 'tabs', '2')['payload'],
+                          _PLD)
+
+        self.storage.close_batch(_UID, 'tabs', batch)
+        self.assertEquals(self.storage.cache.get(header), None)
+        self.assertEquals(self.storage.cache.get(header + ':1'), None)
+        self.assertEquals(self.storage.cache.get(header + ':2'), None)
+        self.assertFalse(self.storage.valid_batch(_UID, 'tabs', batch))
+        self.assertEquals(self.storage.cache.get('1:c:tabs:batchids'), [])
+
+    def test_tabs_batches_with_missing_appends_are_invalid(self):
+        batch = self.storage.create_batch(_UID, 'tabs')
+        header = '1:c:tabs:batch:%s' % (batch,)
+        for id in ('1', '2'):
+            self.storage.append_items_to_batch(_UID, 'tabs', batch,
+                                               [{'id': id, 'payload': _PLD}])
+        # Simulate memcached evicting one of the appends.
+        self.storage.cache.delete(header + ':1')
+        self.assertRaises(InvalidBatch, self.storage.apply_batch,
+                          _UID, 'tabs', batch)
+        self.assertRaises(CollectionNotFoundError,
+                          self.storage.get_items, _UID, 'tabs')
+
+    def test_delete_storage_clears_tabs_batches(self):
+        batch = self.storage.create_batch(_UID, 'tabs')
+        header = '1:c:tabs:batch:%s' % (batch,)
+        self.storage.append_items_to_batch(_UID, 'tabs', batch,
+                                           [{'id': '1', 'payload': _PLD}])
+        self.assertEquals(self.storage.cache.get('1:c:tabs:batchids'),
+                          [batch])
+        self.storage.delete_storage(_UID)
+        for suffix in ('', ':1', ':records', ':bytes'):
+            self.assertEquals(self.storage.cache.get(header + suffix), None)
+        self.assertEquals(self.storage.cache.get('1:c:tabs:batchids'), None)
+        self.assertFalse(self.storage.valid_batch(_UID, 'tabs', batch))
+        self.assertRaises(InvalidBatch, self.storage.append_items_to_batch,
+                          _UID, 'tabs', batch, [{'id': '2', 'payload': _PLD}])
+
+    def test_absent_collections_are_answered_from_metadata(self):
+        self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
+        self.storage.get_collection_timestamps(_UID)
+
+        # The backing store isn't consulted for a collection that the
+        # cached metadata says doesn't exist.
+        sqlstorage = self.storage.storage
+        self.storage.storage = None
+        try:
+            with self.storage.lock_for_read(_UID, 'col2'):
+                self.assertRaises(CollectionNotFoundError,
+                                  self.storage.get_items, _UID, 'col2')
+                self.assertRaises(ItemNotFoundError,
+                                  self.storage.get_item, _UID, 'col2', '1')
+        finally:
+            self.storage.storage = sqlstorage
+
+        # Writing to the collection makes it visible straight away.
+        time.sleep(0.01)
+        self.storage.set_item(_UID, 'col2', '1', {'payload': _PLD})
+        with self.storage.lock_for_read(_UID, 'col2'):
+            res = self.storage.get_item(_UID, 'col2', '1')
+            self.assertEquals(res['payload'], _PLD)
+
     def test_size(self):
         # storing 2 BSOs
         self.storage.set_item(_UID, 'foo', '1', {'payload': _PLD})
@@ -296,10 +501,65 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(storage.get_total_size(_UID, True), 0)
 
 
+class TestMemcachedSQLStorageWithFakeClient(TestMemcachedSQLStorage):
+    """Run the memcached tests against FakeMemcacheClient."""
+
+    def setUp(self):
+        if not MEMCACHED:
+            raise unittest.SkipTest
+        data = {}
+        replacer = Replacer()
+        replacer.replace("mozsvc.storage.mcclient.MCClientPool._create_client",
+                         lambda pool: FakeMemcacheClient(data))
+        self.addCleanup(replacer.restore)
+        super(TestMemcachedSQLStorageWithFakeClient, self).setUp()
+
+    def test_closed_tabs_batches_are_invalid(self):
+        batch = self.storage.create_batch(_UID, 'tabs')
+        self.storage.close_batch(_UID, 'tabs', batch)
+        # The sequence counter is gone, so claiming a seq fails cleanly.
+        self.assertEquals(self.storage.cache.incr('1:c:tabs:batch:%s'
+                                                  % (batch,)), None)
+        self.assertRaises(InvalidBatch, self.storage.append_items_to_batch,
+                          _UID, 'tabs', batch, [{'id': '1', 'payload': _PLD}])
+
+    def test_tabs_batches_skip_failed_appends(self):
+        batch = self.storage.create_batch(_UID, 'tabs')
+        header = '1:c:tabs:batch:%s' % (batch,)
+        self.storage.append_items_to_batch(_UID, 'tabs', batch,
+                                           [{'id': '1', 'payload': _PLD}])
+
+        # An append that fails after claiming its seq leaves an empty slot.
+        def fail_add(self, key, value, time=0):
+            raise BackendError("add failed")
+        with Replacer() as r:
+            r.replace("syncstorage.storage.memcached.MemcachedClient.add",
+                      fail_add)
+            self.assertRaises(BackendError,
+                              self.storage.append_items_to_batch,
+                              _UID, 'tabs', batch, [{'id': '2'}])
+        self.assertEquals(self.storage.cache.get(header + ':2'), [])
+
+        # One that never got to write its items, e.g. because it crashed
+        # or hasn't finished yet, leaves a gap.
+        self.storage.cache.incr(header)
+        self.storage.append_items_to_batch(_UID, 'tabs', batch,
+                                           [{'id': '3', 'payload': _PLD}])
+        self.assertEquals(self.storage.cache.get(header), 4)
+        self.assertEquals(self.storage.cache.get(header + ':3'), None)
+
+        # Neither stops the batch being applied.
+        self.storage.apply_batch(_UID, 'tabs', batch)
+        ids = self.storage.get_item_ids(_UID, 'tabs')['items']
+        self.assertEquals(sorted(ids), ['1', '3'])
+
+
 def test_suite():
     suite = unittest.TestSuite()
     if MEMCACHED:
         suite.addTest(unittest.makeSuite(TestMemcachedSQLStorage))
+        suite.addTest(unittest.makeSuite(
+            TestMemcachedSQLStorageWithFakeClient))
     return suite
 
 
@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+
+from syncstorage.tests.support import StorageTestCase
+from syncstorage.tests.test_storage import StorageTestsMixin
+from syncstorage.storage import load_storage_from_settings, InvalidBatch
+from syncstorage.storage.memory import MemoryStorage
+
+_UID = 1
+_PLD = '*' * 500
+
+
+class TestMemoryStorage(StorageTestCase, StorageTestsMixin):
+
+    TEST_INI_FILE = "tests-memory.ini"
+
+    def setUp(self):
+        super(TestMemoryStorage, self).setUp()
+        settings = self.config.registry.settings
+        self.storage = load_storage_from_settings("storage", settings)
+        self.assertTrue(isinstance(self.storage, MemoryStorage))
+
+    def test_indexes_are_kept_in_order(self):
+        storage = self.storage
+        storage.set_items(_UID, "col", [
+            {"id": "a", "payload": _PLD, "sortindex": 2},
+            {"id": "b", "payload": _PLD},
+            {"id": "c", "payload": _PLD, "sortindex": 3},
+        ])
+        storage.set_item(_UID, "col", "b", {"sortindex": 1})
+        time.sleep(0.01)
+        storage.set_item(_UID, "col", "a", {"payload": "updated"})
+        col = storage._users[_UID].collections["col"]
+        self.assertEquals(col.by_modified, sorted(col.by_modified))
+        self.assertEquals(col.by_sortindex, sorted(col.by_sortindex))
+        self.assertEquals(len(col.by_modified), 3)
+        self.assertEquals(len(col.by_sortindex), 3)
+
+        res = storage.get_item_ids(_UID, "col", sort="index")
+        self.assertEquals(res["items"], ["c", "a", "b"])
+        res = storage.get_item_ids(_UID, "col", sort="newest")
+        self.assertEquals(res["items"][0], "a")
+        res = storage.get_item_ids(_UID, "col", sort="oldest")
+        self.assertEquals(res["items"][-1], "a")
+
+        storage.delete_items(_UID, "col", ["a", "c"])
+        self.assertEquals(col.by_modified, [col.by_modified[0]])
+        self.assertEquals(len(col.by_sortindex), 1)
+
+    def test_pagination(self):
+        storage = self.storage
+        # Several items per timestamp, so pages split them up.
+        for i in range(4):
+            storage.set_items(_UID, "col", [
+                {"id": "%d%d" % (i, j), "payload": _PLD, "sortindex": j}
+                for j in range(3)
+            ])
+        for sort in ("newest", "oldest", "index"):
+            seen = []
+            offset = None
+            while True:
+                res = storage.get_item_ids(_UID, "col", limit=2,
+                                           offset=offset, sort=sort)
+                seen.extend(res["items"])
+                offset = res["next_offset"]
+                if offset is None:
+                    break
+            self.assertEquals(seen,
+                              storage.get_item_ids(_UID, "col",
+                                                   sort=sort)["items"])
+            self.assertEquals(len(set(seen)), 12)
+
+    def test_batches_are_checked(self):
+        storage = self.storage
+        batch = storage.create_batch(_UID, "col")
+        storage.append_items_to_batch(_UID, "col", batch, [
+            {"id": "a", "payload": _PLD},
+            {"id": "b", "payload": _PLD},
+        ])
+        self.assertEquals(storage.get_batch_totals(_UID, "col", batch),
+                          (2, 2 * len(_PLD)))
+        self.assertFalse(storage.valid_batch(_UID, "other", batch))
+        storage.apply_batch(_UID, "col", batch)
+        storage.close_batch(_UID, "col", batch)
+        self.assertFalse(storage.valid_batch(_UID, "col", batch))
+        self.assertRaises(InvalidBatch, storage.apply_batch,
+                          _UID, "col", batch)
+        self.assertEquals(len(storage.get_items(_UID, "col")["items"]), 2)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMemoryStorage))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -6,7 +6,9 @@
 
 import os
 import sys
+import json
 import time
+import tempfile
 import unittest
 import subprocess
 
@@ -14,6 +16,7 @@ from six.moves import range
 
 from mozsvc.exceptions import BackendError
 
+from syncstorage.scripts import benchmark, microbench
 from syncstorage.tests.support import StorageTestCase
 from syncstorage.storage import (load_storage_from_settings,
                                  NotFoundError,
@@ -197,3 +200,58 @@ class TestPurgeTTLScript(StorageTestCase):
         self.assertEquals(count_bso_items(), 1)
         self.assertEquals(count_bui_items(), 3)
         self.assertEquals(count_batches(), 1)
+
+
+class TestBenchmarkScript(unittest.TestCase):
+
+    def test_benchmark_script(self):
+        fd, output_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            self.assertEquals(benchmark.main([
+                "--sessions=20", "--users=3", "--seed=42",
+                "--output=" + output_file,
+            ]), 0)
+            with open(output_file) as f:
+                results = json.load(f)
+        finally:
+            os.unlink(output_file)
+        self.assertEquals(results["seed"], 42)
+        self.assertEquals(len(results["backends"]), 1)
+        result = results["backends"][0]
+        self.assertTrue(result["sqluri"].startswith("sqlite:///"))
+        self.assertEquals(result["sessions"], 20)
+        # Every session starts by reading info/collections.
+        endpoint = result["endpoints"]["GET info/collections"]
+        self.assertEquals(endpoint["count"], 20)
+        self.assertTrue(endpoint["p50"] <= endpoint["p95"] <= endpoint["p99"])
+        self.assertEquals(result["count"], sum(
+            e["count"] for e in result["endpoints"].values()))
+
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        self.assertEquals(benchmark.get_percentile(values, 50), 50)
+        self.assertEquals(benchmark.get_percentile(values, 99), 99)
+        self.assertEquals(benchmark.get_percentile([7], 95), 7)
+        self.assertEquals(benchmark.get_percentile([], 95), None)
+
+
+class TestMicrobenchScript(unittest.TestCase):
+
+    def test_all_microbenchmarks_run(self):
+        results = microbench.run_microbenchmarks(rounds=1, min_round_time=0)
+        names = [name for name, _ in microbench.BENCHMARKS]
+        self.assertEquals(sorted(results), sorted(names))
+        for name in names:
+            # Only benchmarks with optional dependencies may be skipped.
+            if results[name] is None:
+                self.assertEquals(name, "memcached_encode_decode")
+                continue
+            self.assertEquals(results[name]["rounds"], 1)
+            self.assertTrue(results[name]["per_record"] > 0)
+
+    def test_running_named_microbenchmarks(self):
+        results = microbench.run_microbenchmarks(["row_to_bso"], rounds=1,
+                                                 min_round_time=0)
+        self.assertEquals(list(results), ["row_to_bso"])
+        self.assertEquals(results["row_to_bso"]["records"], 100)
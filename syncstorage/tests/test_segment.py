@@ -0,0 +1,259 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import errno
+import shutil
+import unittest
+
+from testfixtures import Replacer
+
+from syncstorage.tests.support import StorageTestCase
+from syncstorage.tests.test_storage import StorageTestsMixin
+from syncstorage.storage import (load_storage_from_settings,
+                                 ConflictError,
+                                 ItemNotFoundError)
+from syncstorage.storage.segment import SegmentStorage, _Payload
+
+_UID = 1
+_PLD = '*' * 500
+
+
+class TestSegmentStorage(StorageTestCase, StorageTestsMixin):
+
+    TEST_INI_FILE = "tests-segment.ini"
+
+    def setUp(self):
+        super(TestSegmentStorage, self).setUp()
+        settings = self.config.registry.settings
+        self.storage = load_storage_from_settings("storage", settings)
+        self.assertTrue(isinstance(self.storage, SegmentStorage))
+
+    def _reopen(self):
+        """Simulate a restart, loading all the data back from disk."""
+        return SegmentStorage(self.storage.path)
+
+    def _get_segment_files(self, userid=_UID):
+        dirname = os.path.join(self.storage.path, str(userid))
+        return [os.path.join(dirname, name)
+                for name in sorted(os.listdir(dirname))]
+
+    def test_data_survives_reopen(self):
+        storage = self.storage
+        storage.set_items(_UID, "col", [
+            {"id": "a", "payload": _PLD, "sortindex": 2, "ttl": 3600},
+            {"id": "b", "payload": u"\N{SNOWMAN}"},
+        ])
+        storage.set_item(_UID, "col", "a", {"sortindex": 5})
+        storage.delete_item(_UID, "col", "b")
+        storage.set_item(_UID, "other", "c", {"payload": _PLD})
+        storage.delete_collection(_UID, "other")
+        batch = storage.create_batch(_UID, "col")
+        storage.append_items_to_batch(_UID, "col", batch, [
+            {"id": "d", "payload": _PLD},
+        ])
+
+        storage2 = self._reopen()
+        self.assertEquals(storage2.get_collection_timestamps(_UID),
+                          storage.get_collection_timestamps(_UID))
+        item = storage2.get_item(_UID, "col", "a")
+        self.assertEquals(item["payload"], _PLD)
+        self.assertEquals(item["sortindex"], 5)
+        self.assertTrue(0 < item["ttl"] <= 3600)
+        self.assertRaises(ItemNotFoundError, storage2.get_item,
+                          _UID, "col", "b")
+        self.assertEquals(storage2.get_batch_totals(_UID, "col", batch),
+                          (1, len(_PLD)))
+        storage2.apply_batch(_UID, "col", batch)
+        storage2.close_batch(_UID, "col", batch)
+
+        storage3 = self._reopen()
+        res = storage3.get_item_ids(_UID, "col", sort="index")
+        self.assertEquals(res["items"], ["a", "d"])
+        self.assertFalse(storage3.valid_batch(_UID, "col", batch))
+
+    def test_payloads_are_read_from_segments(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": u"\N{SNOWMAN}"})
+        item = storage._users[_UID].collections["col"].items["a"]
+        self.assertTrue(isinstance(item["payload"], _Payload))
+        self.assertEquals(storage.get_collection_sizes(_UID), {"col": 1})
+        self.assertEquals(storage.get_item(_UID, "col", "a")["payload"],
+                          u"\N{SNOWMAN}")
+
+    def test_incomplete_records_are_truncated(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        filename, = self._get_segment_files()
+        good_size = os.path.getsize(filename)
+        storage.set_item(_UID, "col", "b", {"payload": _PLD})
+        # Simulate a crash in the middle of writing the second record.
+        with open(filename, "r+b") as f:
+            f.truncate(good_size + 20)
+
+        storage2 = self._reopen()
+        res = storage2.get_item_ids(_UID, "col")
+        self.assertEquals(res["items"], ["a"])
+        self.assertEquals(os.path.getsize(filename), good_size)
+        # New records are written after the last complete one.
+        storage2.set_item(_UID, "col", "c", {"payload": _PLD})
+        storage3 = self._reopen()
+        res = storage3.get_item_ids(_UID, "col", sort="oldest")
+        self.assertEquals(res["items"], ["a", "c"])
+
+    def test_corrupted_records_are_truncated(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        filename, = self._get_segment_files()
+        good_size = os.path.getsize(filename)
+        storage.set_item(_UID, "col", "b", {"payload": _PLD})
+        # Simulate a torn write that left garbage in the payload data.
+        with open(filename, "r+b") as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b"X" * 10)
+
+        storage2 = self._reopen()
+        res = storage2.get_item_ids(_UID, "col")
+        self.assertEquals(res["items"], ["a"])
+        self.assertEquals(os.path.getsize(filename), good_size)
+
+    def test_failed_writes_are_not_persisted(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        time.sleep(0.02)
+        try:
+            with storage.lock_for_write(_UID, "col"):
+                storage.set_item(_UID, "col", "b", {"payload": _PLD})
+                storage.delete_item(_UID, "col", "a")
+                res = storage.get_item_ids(_UID, "col")
+                self.assertEquals(res["items"], ["b"])
+                raise ConflictError
+        except ConflictError:
+            pass
+        # The changes are undone in memory as well as on disk.
+        res = storage.get_item_ids(_UID, "col")
+        self.assertEquals(res["items"], ["a"])
+        storage2 = self._reopen()
+        res = storage2.get_item_ids(_UID, "col")
+        self.assertEquals(res["items"], ["a"])
+
+    def test_failed_appends_are_removed(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        filename, = self._get_segment_files()
+        good_size = os.path.getsize(filename)
+
+        def fail(*args):
+            raise OSError(errno.EIO, "I/O error")
+
+        # The record is written, but can't be synced to disk.
+        with Replacer() as r:
+            r.replace("syncstorage.storage.segment.os.fsync", fail)
+            self.assertRaises(OSError, storage.set_item,
+                              _UID, "col", "b", {"payload": _PLD})
+        self.assertEquals(os.path.getsize(filename), good_size)
+        self.assertEquals(storage.get_item_ids(_UID, "col")["items"], ["a"])
+        storage.set_item(_UID, "col", "c", {"payload": _PLD})
+
+        # If the record can't be removed, the segment is retired and the
+        # next record goes in a new one.  This record was complete, so the
+        # data is reloaded with it.
+        with Replacer() as r:
+            r.replace("syncstorage.storage.segment.os.fsync", fail)
+            r.replace("syncstorage.storage.segment._Segment.truncate", fail)
+            self.assertRaises(OSError, storage.set_item,
+                              _UID, "col", "d", {"payload": _PLD})
+        storage.set_item(_UID, "col", "e", {"payload": _PLD})
+        self.assertEquals(len(self._get_segment_files()), 2)
+        for storage in (storage, self._reopen()):
+            res = storage.get_item_ids(_UID, "col", sort="oldest")
+            self.assertEquals(res["items"], ["a", "c", "d", "e"])
+            self.assertEquals(storage.get_item(_UID, "col", "e")["payload"],
+                              _PLD)
+
+    def test_purge_compacts_segments(self):
+        storage = SegmentStorage(self.storage.path, segment_size=1024)
+        for i in range(5):
+            storage.set_item(_UID, "col", str(i), {"payload": _PLD})
+        storage.set_item(_UID, "col", "gone", {"payload": _PLD, "ttl": 0})
+        old_files = self._get_segment_files()
+        self.assertTrue(len(old_files) > 1)
+        old_data = {}
+        for filename in old_files:
+            with open(filename, "rb") as f:
+                old_data[filename] = f.read()
+
+        res = storage.purge_expired_items()
+        self.assertEquals(res["num_purged"], 1)
+        new_file, = self._get_segment_files()
+        self.assertTrue(new_file not in old_files)
+        self.assertEquals(storage.get_item(_UID, "col", "0")["payload"],
+                          _PLD)
+        expected = sorted(storage.get_item_ids(_UID, "col")["items"])
+        self.assertEquals(len(expected), 5)
+        self.assertEquals(sorted(self._reopen().get_item_ids(
+            _UID, "col")["items"]), expected)
+
+        # Simulate a crash before the old segments were removed; the
+        # snapshot in the new segment still wins.
+        for filename, data in old_data.items():
+            with open(filename, "wb") as f:
+                f.write(data)
+        self.assertEquals(sorted(self._reopen().get_item_ids(
+            _UID, "col")["items"]), expected)
+
+    def test_delete_storage_removes_files(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        dirname = os.path.join(storage.path, str(_UID))
+        self.assertTrue(os.path.isdir(dirname))
+        storage.delete_storage(_UID)
+        self.assertFalse(os.path.exists(dirname))
+        self.assertEquals(self._reopen().get_collection_timestamps(_UID), {})
+        storage.set_item(_UID, "col", "b", {"payload": _PLD})
+        res = self._reopen().get_item_ids(_UID, "col")
+        self.assertEquals(res["items"], ["b"])
+
+    def test_writers_for_different_users_use_separate_files(self):
+        storage = self.storage
+        storage.set_item(1, "col", "a", {"payload": _PLD})
+        storage.set_item(2, "col", "a", {"payload": _PLD})
+        self.assertEquals(sorted(os.listdir(storage.path)), ["1", "2"])
+        shutil.rmtree(os.path.join(storage.path, "2"))
+        storage2 = self._reopen()
+        self.assertEquals(storage2.get_item_ids(1, "col")["items"], ["a"])
+        self.assertEquals(storage2.get_collection_timestamps(2), {})
+
+    def test_segments_are_unmapped_when_unlocked(self):
+        num_users = 100
+        for userid in range(1, num_users + 1):
+            self.storage.set_item(userid, "col", "a", {"payload": _PLD})
+        storage = self._reopen()
+
+        def count_open_files():
+            return len(os.listdir("/proc/self/fd"))
+
+        if os.path.isdir("/proc/self/fd"):
+            num_open_files = count_open_files()
+        # Reading every user's data keeps none of their segments mapped.
+        for userid in range(1, num_users + 1):
+            self.assertEquals(storage.get_item(userid, "col", "a")["payload"],
+                              _PLD)
+        storage.purge_expired_items()
+        for user in storage._users.itervalues():
+            for segment in user.segments:
+                self.assertEquals(segment._mmap, None)
+        if os.path.isdir("/proc/self/fd"):
+            self.assertTrue(count_open_files() < num_open_files + 10)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSegmentStorage))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -4,20 +4,28 @@
 #
 # pylint: disable=W1505, C0103
 
+import os
 import time
+import unittest
 import threading
 
+import testfixtures
+
 from mozsvc.plugin import load_and_register
 from mozsvc.tests.support import get_test_configurator
 
 from syncstorage.tests.support import StorageTestCase
-from syncstorage.storage import load_storage_from_settings
+from syncstorage.storage import (load_storage_from_settings, deadline,
+                                 ConflictError, CollectionNotFoundError,
+                                 ItemNotFoundError, InvalidBatch)
+from syncstorage.storage.sql import SQLStorage
 from syncstorage.storage.sql.dbconnect import (create_engine,
+                                               DBConnector,
                                                QueuePoolWithMaxBacklog)
 
 from syncstorage.tests.test_storage import StorageTestsMixin
 
-from mozsvc.exceptions import BackendError
+from mozsvc.exceptions import BackendError, BackendTimeoutError
 
 from six.moves import range
 
@@ -25,6 +33,18 @@ _UID = 1
 _PLD = '*' * 500
 
 
+class TestSQLStorageWithAsyncDeletes(StorageTestCase, StorageTestsMixin):
+
+    TEST_INI_FILE = "tests-filedb.ini"
+
+    def setUp(self):
+        super(TestSQLStorageWithAsyncDeletes, self).setUp()
+        settings = self.config.registry.settings.copy()
+        settings["storage.async_deletes"] = True
+        settings["storage.async_delete_worker"] = False
+        self.storage = load_storage_from_settings("storage", settings)
+
+
 class TestSQLStorage(StorageTestCase, StorageTestsMixin):
 
     # These tests need to be run with a real, file-backed sqlite database.
@@ -157,6 +177,576 @@ class TestSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(len(connections), 3)
         self.assertEquals(len(errors), 3)
 
+    def test_pool_status_and_adaptive_sizing(self):
+        sqluri = "sqlite:////tmp/tests-sync-pool-%s.db"
+        sqluri %= (os.environ["MOZSVC_UUID"],)
+        dbconnector = DBConnector(sqluri, pool_size=4, pool_min_size=2,
+                                  pool_max_overflow=0, pool_max_backlog=0,
+                                  pool_timeout=1)
+        engine = dbconnector.engine
+        pool = engine.pool
+        self.assertEquals(pool.size(), 2)
+
+        # Take all the connections, so that another caller is rejected.
+        connections = [engine.connect(), engine.connect()]
+        self.assertRaises(Exception, engine.connect)
+        status = pool.get_status()
+        self.assertEquals(status["size"], 2)
+        self.assertEquals(status["max_size"], 4)
+        self.assertEquals(status["checkedout"], 2)
+        self.assertEquals(status["num_checkouts"], 3)
+        self.assertEquals(status["num_failed_checkouts"], 1)
+        self.assertEquals(status["num_rejected_checkouts"], 1)
+
+        # Slow checkouts make the pool grow, up to its maximum size.
+        pool._checkout_latency = 1
+        pool._last_resize_time = 0
+        for c in connections:
+            c.close()
+        connections = [engine.connect() for _ in range(3)]
+        self.assertEquals(pool.size(), 3)
+        self.assertEquals(pool.get_status()["checkedout"], 3)
+
+        # Fast checkouts with idle connections make it shrink again,
+        # closing a connection and recording its lifetime.
+        for c in connections:
+            c.close()
+        pool._checkout_latency = 0
+        pool._last_resize_time = 0
+        engine.connect().close()
+        status = pool.get_status()
+        self.assertEquals(status["size"], 2)
+        self.assertEquals(status["checkedout"], 0)
+        self.assertEquals(status["num_connections_closed"], 1)
+        self.assertTrue(status["avg_connection_lifetime"] >= 0)
+        self.assertEquals(dbconnector.get_pool_status()["num_checkouts"],
+                          status["num_checkouts"])
+        engine.dispose()
+        os.unlink(sqluri[len("sqlite:///"):])
+
+    def test_query_deadlines(self):
+        self.storage.set_items(_UID, "col", [{"id": "a", "payload": _PLD}])
+
+        # A query that would run for a long time gets cut off by sqlite.
+        SLOW_QUERY = "WITH RECURSIVE cnt(x) AS (SELECT 1 UNION ALL" \
+                     " SELECT x + 1 FROM cnt LIMIT 100000000)" \
+                     " SELECT COUNT(*) FROM cnt /* queryName=SLOW_QUERY */"
+        t1 = time.time()
+        with deadline(0.1):
+            with self.storage.dbconnector.connect() as c:
+                self.assertRaises(BackendTimeoutError, c.execute, SLOW_QUERY)
+        self.assertTrue(time.time() - t1 < 5)
+
+        # Once the deadline has passed, queries fail straight away.
+        with deadline(0):
+            self.assertRaises(BackendTimeoutError,
+                              self.storage.get_items, _UID, "col")
+
+        # And the connections are usable again with no deadline.
+        self.assertEquals(len(self.storage.get_items(_UID, "col")["items"]), 1)
+
+    def test_query_stats_and_slow_query_log(self):
+        dbconnector = self.storage.dbconnector
+        bsos = [{"id": str(i), "payload": _PLD} for i in range(3)]
+        self.storage.set_items(_UID, "col", bsos)
+        dbconnector.slow_query_threshold = 0
+        try:
+            with testfixtures.LogCapture() as logs:
+                items = self.storage.get_items(_UID, "col", ids=["0", "1"])
+        finally:
+            dbconnector.slow_query_threshold = None
+        self.assertEquals(len(items["items"]), 2)
+
+        # Each query is counted under its own name, with its rows.
+        stats = dbconnector.query_stats.get_stats()
+        self.assertEquals(stats["FIND_ITEMS"]["count"], 1)
+        self.assertEquals(stats["FIND_ITEMS"]["rows"], 2)
+        self.assertEquals(sum(stats["FIND_ITEMS"]["histogram"]), 1)
+        self.assertEquals(stats["UPSERT_bso"]["rows"], 3)
+
+        # With a zero threshold, every query goes in the slow-query log,
+        # with its shape but without any of the actual data.
+        for r in logs.records:
+            if getattr(r, "query_name", None) == "FIND_ITEMS":
+                break
+        else:
+            assert False, "slow query was not logged"
+        self.assertEquals(r.name, "syncstorage.storage.sql.slow_queries")
+        self.assertTrue(r.query_shape.startswith("SELECT"))
+        self.assertTrue("IN (...)" in r.query_shape)
+        self.assertEquals(r.query_tables, "bso")
+        self.assertNotEquals(r.userid_hash, str(_UID))
+        self.assertTrue(r.duration >= 0)
+
+    def test_group_commit_needs_savepoints(self):
+        if self.storage.dbconnector.driver != "sqlite":
+            raise unittest.SkipTest
+        self.assertRaises(ValueError, SQLStorage, self.storage.sqluri,
+                          group_commit_window=0.5)
+
+    def test_group_commit(self):
+        if self.storage.dbconnector.driver == "sqlite":
+            raise unittest.SkipTest
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             group_commit_window=0.5)
+        committer = storage.group_committer
+        query_stats = storage.dbconnector.query_stats
+        results = {}
+
+        def write(userid, delay, fail=None):
+            time.sleep(delay)
+            try:
+                with storage.lock_for_write(userid, "col"):
+                    if fail is ConflictError:
+                        raise ConflictError
+                    ts = storage.set_item(userid, "col", "a",
+                                          {"payload": _PLD})["modified"]
+                    if fail is not None:
+                        raise fail()
+            except Exception as e:
+                results[userid] = e
+            else:
+                results[userid] = ts
+
+        def run_writers(*writers):
+            threads = [threading.Thread(target=write, args=args)
+                       for args in writers]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        # Writes arriving within the window share a single commit,
+        # but each one keeps its own timestamp.
+        run_writers((1, 0), (2, 0.05), (3, 0.1), (4, 0.15))
+        self.assertEquals(committer.num_groups, 1)
+        self.assertEquals(committer.num_sessions, 4)
+        self.assertEquals(len(set(results.values())), 4)
+        for userid in range(1, 5):
+            self.assertEquals(storage.get_collection_timestamp(userid, "col"),
+                              results[userid])
+        self.assertEquals(storage.get_pool_status()["group_commit"],
+                          {"num_groups": 1, "num_sessions": 4})
+        # Only the first member may wait for its lock.
+        stats = query_stats.get_stats()
+        self.assertEquals(stats["LOCK_COLLECTION_WRITE"]["count"], 1)
+        self.assertEquals(stats["LOCK_COLLECTION_WRITE_NOWAIT"]["count"], 3)
+        self.assertEquals(stats["SAVEPOINT_GROUP_MEMBER"]["count"], 4)
+
+        # A member that fails before writing doesn't affect the others.
+        run_writers((5, 0), (6, 0.05, ConflictError), (7, 0.1))
+        self.assertEquals(committer.num_groups, 2)
+        self.assertTrue(isinstance(results[6], ConflictError))
+        self.assertEquals(storage.get_collection_timestamp(5, "col"),
+                          results[5])
+        self.assertEquals(storage.get_collection_timestamp(7, "col"),
+                          results[7])
+
+        # A member that fails after writing is rolled back on its own.
+        run_writers((8, 0), (9, 0.05, ValueError), (10, 0.1))
+        self.assertEquals(committer.num_groups, 3)
+        self.assertTrue(isinstance(results[9], ValueError))
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_collection_timestamp, 9, "col")
+        for userid in (8, 10):
+            self.assertEquals(storage.get_collection_timestamp(userid, "col"),
+                              results[userid])
+            self.assertEquals(storage.get_item(userid, "col", "a")["payload"],
+                              _PLD)
+
+        # Reads and unlocked writes don't wait for a group.
+        t1 = time.time()
+        storage.set_item(11, "col", "a", {"payload": _PLD})
+        storage.get_item(11, "col", "a")
+        self.assertTrue(time.time() - t1 < 0.5)
+        self.assertEquals(committer.num_groups, 3)
+
+        for userid in range(1, 12):
+            storage.delete_storage(userid)
+        storage.dbconnector.engine.dispose()
+
+    def test_touch_collection_reuses_lock_information(self):
+        query_stats = self.storage.dbconnector.query_stats
+
+        def count_queries(*names):
+            stats = query_stats.get_stats()
+            return [stats.get(name, {}).get("count", 0) for name in names]
+
+        QUERIES = ("UPSERT_COLLECTION", "TOUCH_COLLECTION",
+                   "INIT_COLLECTION", "DELETE_COLLECTION")
+        bso = {"payload": _PLD}
+
+        # Without a lock, the collection is touched with a single upsert.
+        ts = self.storage.set_item(_UID, "col1", "a", bso)["modified"]
+        self.assertEquals(count_queries(*QUERIES), [1, 0, 0, 0])
+        self.assertEquals(self.storage.get_collection_timestamp(_UID, "col1"),
+                          ts)
+
+        # Under a write lock we already know whether the row exists,
+        # and the session sees its own new timestamp.
+        with self.storage.lock_for_write(_UID, "col2"):
+            ts = self.storage.set_item(_UID, "col2", "a", bso)["modified"]
+            self.assertEquals(
+                self.storage.get_collection_timestamp(_UID, "col2"), ts)
+        self.assertEquals(count_queries(*QUERIES), [1, 0, 1, 0])
+        time.sleep(0.01)
+        with self.storage.lock_for_write(_UID, "col2"):
+            self.storage.set_item(_UID, "col2", "b", bso)
+        self.assertEquals(count_queries(*QUERIES), [1, 1, 1, 0])
+
+        # Deleting a collection that the lock found missing does not
+        # need to touch the user_collections table.
+        with self.storage.lock_for_write(_UID, "col3"):
+            self.assertRaises(CollectionNotFoundError,
+                              self.storage.delete_collection, _UID, "col3")
+        self.assertEquals(count_queries(*QUERIES), [1, 1, 1, 0])
+        time.sleep(0.01)
+        with self.storage.lock_for_write(_UID, "col2"):
+            self.assertEquals(self.storage.delete_collection(_UID, "col2"),
+                              self.storage.get_collection_timestamp(_UID,
+                                                                    "col1"))
+            self.assertRaises(CollectionNotFoundError,
+                              self.storage.get_collection_timestamp,
+                              _UID, "col2")
+        self.assertEquals(count_queries(*QUERIES), [1, 1, 1, 1])
+
+    def test_long_lists_of_ids_are_chunked_and_padded(self):
+        query_stats = self.storage.dbconnector.query_stats
+        # Lists of ids are padded to a power-of-two length.
+        params = {"userid": _UID, "ids": ["a", "b", "c"]}
+        query = self.storage.dbconnector.get_query("DELETE_ITEMS", params)
+        self.assertTrue(query.endswith("(:id0,:id1,:id2,:id3)"))
+        self.assertEquals(params["id3"], "c")
+        # Each chunk is sorted by id as well, to match the merged order.
+        params = {"userid": _UID, "ids": ["a"], "sort": "oldest"}
+        query = self.storage.dbconnector.get_query("FIND_ITEMS", params)
+        self.assertFalse("bso.id ASC" in str(query))
+        params["order_by_id"] = True
+        query = self.storage.dbconnector.get_query("FIND_ITEMS", params)
+        self.assertTrue("bso.id ASC" in str(query))
+
+        # Write the items in a few batches, so that they have a mix
+        # of timestamps that doesn't follow the order of the ids.
+        ids = ["%03d" % (i,) for i in range(300)]
+        for batch in range(3):
+            bsos = [{"id": id, "payload": _PLD, "sortindex": i % 7}
+                    for i, id in enumerate(ids) if i % 3 == batch]
+            self.storage.set_items(_UID, "col", bsos)
+            time.sleep(0.01)
+        wanted = ids[::-1] + ["missing"]
+
+        def get_all_pages(**kwds):
+            items = []
+            offset = None
+            while True:
+                res = self.storage.get_items(_UID, "col", ids=wanted,
+                                             offset=offset, **kwds)
+                items.extend(res["items"])
+                offset = res["next_offset"]
+                if offset is None:
+                    return items
+
+        for sort in ("newest", "oldest", "index"):
+            items = get_all_pages(sort=sort, limit=70)
+            self.assertEquals(sorted(item["id"] for item in items), ids)
+            if sort == "index":
+                keys = [item["sortindex"] for item in items]
+                self.assertEquals(keys, sorted(keys, reverse=True))
+            else:
+                keys = [item["modified"] for item in items]
+                self.assertEquals(keys, sorted(keys,
+                                               reverse=(sort == "newest")))
+        res = self.storage.get_item_ids(_UID, "col", ids=wanted)
+        self.assertEquals(sorted(res["items"]), ids)
+
+        # Deletes are chunked in the same way.
+        self.storage.delete_items(_UID, "col", wanted)
+        stats = query_stats.get_stats()
+        self.assertEquals(stats["DELETE_ITEMS"]["count"], 3)
+        self.assertEquals(stats["DELETE_ITEMS"]["rows"], 300)
+        self.assertEquals(self.storage.get_items(_UID, "col")["items"], [])
+
+    def test_async_deletes(self):
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             async_deletes=True)
+        self.assertEquals(storage.tombstone_reaper, None)
+
+        def count_items():
+            COUNT_ITEMS = "select count(*) from bso "\
+                          "/* queryName=COUNT_ITEMS */"
+            with storage.dbconnector.connect() as c:
+                return c.execute(COUNT_ITEMS).fetchall()[0][0]
+
+        storage.set_items(_UID, "col1", [{"id": str(i), "payload": _PLD,
+                                          "sortindex": i} for i in range(3)])
+        storage.set_items(_UID, "col2", [{"id": str(i), "payload": _PLD}
+                                         for i in range(2)])
+        time.sleep(0.01)
+
+        # Deleting the storage leaves the items in the db, but hides them.
+        storage.delete_storage(_UID)
+        self.assertEquals(count_items(), 5)
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _UID, "col1")
+        self.assertRaises(ItemNotFoundError, storage.get_item, _UID, "col1", "0")
+        self.assertEquals(storage.get_collection_counts(_UID), {})
+        self.assertEquals(storage.get_total_size(_UID), 0)
+
+        # New writes start afresh, rather than updating the deleted items.
+        time.sleep(0.01)
+        res = storage.set_item(_UID, "col1", "0", {"sortindex": 7})
+        self.assertTrue(res["created"])
+        items = storage.get_items(_UID, "col1")["items"]
+        self.assertEquals(len(items), 1)
+        self.assertEquals(items[0]["payload"], "")
+        self.assertEquals(storage.get_collection_counts(_UID), {"col1": 1})
+        self.assertEquals(count_items(), 5)
+
+        # Purging removes the deleted items, a chunk at a time,
+        # and then removes the tombstones.
+        res = storage.purge_expired_items(max_per_loop=1)
+        self.assertEquals(res["num_tombstoned_rows_purged"], 4)
+        self.assertTrue(res["is_complete"])
+        self.assertEquals(count_items(), 1)
+        res = storage.purge_tombstoned_items()
+        self.assertEquals(res["num_purged"], 0)
+        self.assertEquals(len(storage.get_items(_UID, "col1")["items"]), 1)
+
+        # Collections are deleted in the same way.
+        storage.set_items(_UID, "col2", [{"id": str(i), "payload": _PLD}
+                                         for i in range(10)])
+        time.sleep(0.01)
+        with storage.lock_for_write(_UID, "col2"):
+            storage.delete_collection(_UID, "col2")
+            storage.set_item(_UID, "col2", "0", {"sortindex": 1})
+        self.assertEquals(count_items(), 11)
+        self.assertEquals(storage.get_collection_counts(_UID),
+                          {"col1": 1, "col2": 1})
+        self.assertEquals(storage.get_item(_UID, "col2", "0")["payload"], "")
+        res = storage.purge_tombstoned_items(max_per_loop=3)
+        self.assertEquals(res["num_purged"], 9)
+        self.assertEquals(count_items(), 2)
+
+        # A background thread can do the purging instead.
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             async_deletes=True, async_delete_worker=True)
+        storage.delete_storage(_UID)
+        for _ in range(100):
+            if count_items() == 0:
+                break
+            time.sleep(0.05)
+        self.assertEquals(count_items(), 0)
+
+    def test_batches_committed_in_chunks(self):
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             batch_commit_chunk_size=4)
+        storage.set_items(_UID, "col", [
+            {"id": "%02d" % (i,), "payload": "old", "sortindex": i}
+            for i in range(0, 10, 2)
+        ])
+        batch = storage.create_batch(_UID, "col")
+        storage.append_items_to_batch(_UID, "col", batch, [
+            {"id": "%02d" % (i,), "payload": "new"} for i in range(10)
+        ])
+        time.sleep(0.01)
+        ts = storage.apply_batch(_UID, "col", batch)
+        storage.close_batch(_UID, "col", batch)
+
+        # Ten items take three chunks, all applied with the same timestamp.
+        stats = storage.dbconnector.query_stats.get_stats()
+        self.assertEquals(stats["BATCH_CHUNK_IDS"]["count"], 3)
+        self.assertEquals(stats["APPLY_BATCH_CHUNK_INSERT"]["count"], 3)
+        items = storage.get_items(_UID, "col", sort="oldest")["items"]
+        self.assertEquals(len(items), 10)
+        for item in items:
+            self.assertEquals(item["payload"], "new")
+            self.assertEquals(item["modified"], ts)
+            i = int(item["id"])
+            self.assertEquals(item.get("sortindex"), i if i % 2 == 0 else None)
+        self.assertEquals(storage.get_collection_timestamp(_UID, "col"), ts)
+
+    def test_batch_totals(self):
+        tracked = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             track_batch_totals=True)
+        self.storage.set_item(_UID, "col", "x", {"payload": _PLD})
+        for storage in (self.storage, tracked):
+            batch = storage.create_batch(_UID, "col")
+            if storage is tracked:
+                self.assertEquals(
+                    storage.get_batch_totals(_UID, "col", batch), (0, 0))
+            storage.append_items_to_batch(_UID, "col", batch, [
+                {"id": "a", "payload": "aaaa"},
+                {"id": "b", "sortindex": 1},
+            ])
+            storage.append_items_to_batch(_UID, "col", batch, [
+                {"id": "a", "payload": "aa"},
+            ])
+            totals = storage.get_batch_totals(_UID, "col", batch)
+            if storage is tracked:
+                # Running totals count every item appended.
+                self.assertEquals(totals, (3, 6))
+            else:
+                # Otherwise they're not known, and the items aren't counted.
+                self.assertEquals(totals, None)
+            storage.close_batch(_UID, "col", batch)
+            self.assertEquals(storage.get_batch_totals(_UID, "col", batch),
+                              None)
+
+        # Without running totals, the totals columns are never used, so
+        # databases that don't have them yet keep working.
+        stats = self.storage.dbconnector.query_stats.get_stats()
+        self.assertFalse("ADD_TO_BATCH_TOTALS" in stats)
+        self.assertFalse("BATCH_TOTALS" in stats)
+
+    def test_batch_posts_query_counts(self):
+        tracked = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             track_batch_totals=True)
+        self.storage.set_item(_UID, "col", "x", {"payload": _PLD})
+        for storage in (self.storage, tracked):
+            batch = storage.create_batch(_UID, "col")
+            stats = storage.dbconnector.query_stats.get_stats()
+            before = dict((name, s["count"]) for name, s in stats.items())
+
+            # Each POST checks the batch, its totals, and appends to it,
+            # as the view does.
+            for i in range(5):
+                self.assertTrue(storage.valid_batch(_UID, "col", batch))
+                totals = storage.get_batch_totals(_UID, "col", batch)
+                if storage is tracked:
+                    self.assertEquals(totals, (i, i * len(_PLD)))
+                storage.append_items_to_batch(_UID, "col", batch, [
+                    {"id": str(i), "payload": _PLD},
+                ])
+
+            stats = storage.dbconnector.query_stats.get_stats()
+            counts = dict((name, s["count"] - before.get(name, 0))
+                          for name, s in stats.items())
+            counts = dict((name, n) for name, n in counts.items() if n)
+            # The batch is never looked up, since it's known to be open
+            # and the statements that write to it check that it still is.
+            # Upserting a new item takes an UPDATE and an INSERT, except on
+            # MySQL where it's a single statement.
+            upserts = counts.pop("UPSERT_batch_upload_items")
+            if storage.dbconnector.driver == "mysql":
+                self.assertEquals(upserts, 5)
+            else:
+                self.assertEquals(upserts, 10)
+            if storage is tracked:
+                self.assertEquals(counts, {
+                    "BATCH_TOTALS": 5,
+                    "ADD_TO_BATCH_TOTALS": 5,
+                })
+            else:
+                self.assertEquals(counts, {})
+            storage.close_batch(_UID, "col", batch)
+
+    def test_open_batches_are_cached(self):
+        storage = self.storage
+        other_storage = SQLStorage(storage.sqluri, standard_collections=True)
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+
+        def count_valid_batch_queries():
+            stats = storage.dbconnector.query_stats.get_stats()
+            return stats.get("VALID_BATCH", {}).get("count", 0)
+
+        # The process that created a batch doesn't need to look it up.
+        batch = storage.create_batch(_UID, "col")
+        self.assertTrue(storage.valid_batch(_UID, "col", batch))
+        self.assertEquals(count_valid_batch_queries(), 0)
+
+        # Other processes look it up once, then remember it.
+        self.assertTrue(other_storage.valid_batch(_UID, "col", batch))
+        self.assertTrue(other_storage.valid_batch(_UID, "col", batch))
+        stats = other_storage.dbconnector.query_stats.get_stats()
+        self.assertEquals(stats["VALID_BATCH"]["count"], 1)
+        third_storage = SQLStorage(storage.sqluri, standard_collections=True)
+        self.assertTrue(third_storage.valid_batch(_UID, "col", batch))
+
+        # Closing the batch forgets it, in the process that closed it.
+        other_storage.append_items_to_batch(_UID, "col", batch, [
+            {"id": "b", "payload": _PLD},
+        ])
+        other_storage.apply_batch(_UID, "col", batch)
+        other_storage.close_batch(_UID, "col", batch)
+        self.assertFalse(other_storage.valid_batch(_UID, "col", batch))
+
+        # A stale entry elsewhere can't be used to add to the batch, or to
+        # apply it again.
+        self.assertTrue(storage.valid_batch(_UID, "col", batch))
+        self.assertRaises(InvalidBatch, storage.append_items_to_batch,
+                          _UID, "col", batch, [{"id": "c", "payload": _PLD}])
+        self.assertFalse(storage.valid_batch(_UID, "col", batch))
+        self.assertTrue(third_storage.valid_batch(_UID, "col", batch))
+        self.assertRaises(InvalidBatch, third_storage.apply_batch,
+                          _UID, "col", batch)
+        self.assertFalse(third_storage.valid_batch(_UID, "col", batch))
+        self.assertEquals(len(storage.get_items(_UID, "col")["items"]), 2)
+        with storage.dbconnector.connect() as c:
+            num_items = c.execute("select count(*) from batch_upload_items "
+                                  "where id = 'c' "
+                                  "/* queryName=COUNT_BATCH_ITEMS */")
+            self.assertEquals(num_items.fetchall()[0][0], 0)
+
+    def test_absent_collections_are_cached(self):
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             absent_collections_ttl=60)
+        other_storage = self.storage
+        other_storage.set_item(_UID, "col", "a", {"payload": _PLD})
+
+        def count_queries():
+            stats = storage.dbconnector.query_stats.get_stats()
+            return sum(stat["count"] for stat in stats.values())
+
+        # Once a collection is found to be missing, reads are answered
+        # without going to the db.
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _UID, "bookmarks")
+        num_queries = count_queries()
+        with storage.lock_for_read(_UID, "bookmarks"):
+            self.assertRaises(CollectionNotFoundError,
+                              storage.get_collection_timestamp,
+                              _UID, "bookmarks")
+            self.assertRaises(CollectionNotFoundError,
+                              storage.get_items, _UID, "bookmarks")
+            self.assertRaises(ItemNotFoundError,
+                              storage.get_item, _UID, "bookmarks", "a")
+        self.assertEquals(count_queries(), num_queries)
+        self.assertEquals(len(storage.get_items(_UID, "col")["items"]), 1)
+
+        # Writing to the collection in this process forgets its absence.
+        storage.set_item(_UID, "bookmarks", "a", {"payload": _PLD})
+        self.assertEquals(storage.get_item(_UID, "bookmarks", "a")["id"], "a")
+
+        # Writes from other processes are only seen once the entry expires.
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _UID, "history")
+        other_storage.set_item(_UID, "history", "a", {"payload": _PLD})
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _UID, "history")
+        storage.absent_collections_ttl = 0
+        storage.absent_collections.clear()
+        self.assertEquals(len(storage.get_items(_UID, "history")["items"]), 1)
+
+    def test_collection_names_can_be_preloaded(self):
+        self.storage.set_item(_UID, "col1", "a", {"payload": _PLD})
+        self.storage.set_item(_UID, "col2", "a", {"payload": _PLD})
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             preload_collections=True)
+        stats = storage.dbconnector.query_stats.get_stats()
+        self.assertEquals(stats["ALL_COLLECTIONS"]["count"], 1)
+        # No connection is kept open for forked workers to share.
+        if storage.sqluri.startswith("sqlite:////"):
+            self.assertEquals(storage.dbconnector.engine.pool.checkedin(), 0)
+
+        # Names and ids are known without any further lookups.
+        self.assertEquals(storage.get_collection_timestamps(_UID).keys(),
+                          self.storage.get_collection_timestamps(_UID).keys())
+        self.assertEquals(len(storage.get_items(_UID, "col2")["items"]), 1)
+        stats = storage.dbconnector.query_stats.get_stats()
+        self.assertFalse("COLLECTION_ID" in stats)
+        self.assertFalse("COLLECTION_NAMES" in stats)
+        self.assertFalse("" in storage._collections_by_name)
+
     def test_purging_of_expired_items(self):
 
         def count_items():
@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# pylint: disable=C0103
+
+import threading
+import timeit
+import unittest
+
+from syncstorage.util import (LRUCache, SingleFlight, RequestProfile,
+                              profiling, profile_phase)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction_of_least_recently_used_keys(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEquals(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 1)
+        self.assertEquals(cache.hit_rate, 0.5)
+
+    def test_evicted_keys_are_reported(self):
+        evicted = []
+        cache = LRUCache(1, on_evict=lambda k, v: evicted.append((k, v)))
+        cache.set("a", 1)
+        cache.set("a", 2)
+        self.assertEquals(evicted, [])
+        cache.set("b", 3)
+        self.assertEquals(evicted, [("a", 2)])
+        self.assertEquals(cache.delete("b"), 3)
+        self.assertEquals(evicted, [("a", 2)])
+
+    def test_zero_size_disables_the_cache(self):
+        cache = LRUCache(0)
+        cache.set("a", 1)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get("a", "default"), "default")
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def _start_blocked_call(self, flight, key, result, not_before=None):
+        """Start a call in a background thread that waits to be released."""
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def blocked_func():
+            started.set()
+            release.wait()
+            return result
+
+        def run():
+            results.append(flight.do(key, blocked_func, not_before))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        started.wait()
+        return thread, release, results
+
+    def test_concurrent_calls_share_a_single_result(self):
+        flight = SingleFlight()
+        thread, release, results = self._start_blocked_call(
+            flight, "key", {"items": [1, 2]})
+        calls = []
+
+        def func():
+            calls.append(True)
+            return {"items": []}
+
+        joiners = []
+        for _ in range(3):
+            t = threading.Thread(target=lambda: results.append(
+                flight.do("key", func)))
+            t.start()
+            joiners.append(t)
+        # Wait until all three have joined the in-progress call.
+        while flight.num_joined < 3:
+            threading.Event().wait(0.001)
+        release.set()
+        thread.join()
+        for t in joiners:
+            t.join()
+        self.assertEquals(calls, [])
+        self.assertEquals(len(results), 4)
+        for result in results:
+            self.assertEquals(result, {"items": [1, 2]})
+        # Each caller got its own copy of the result.
+        self.assertEquals(len(set(id(r) for r in results)), 4)
+        # The key is forgotten once the call completes.
+        self.assertEquals(flight.do("key", func), {"items": []})
+        self.assertEquals(calls, [True])
+
+    def test_exceptions_are_shared_with_joined_callers(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing_func():
+            started.set()
+            release.wait()
+            raise KeyError("oops")
+
+        errors = []
+
+        def run():
+            try:
+                flight.do("key", failing_func)
+            except KeyError as e:
+                errors.append(e)
+
+        t1 = threading.Thread(target=run)
+        t1.start()
+        started.wait()
+        t2 = threading.Thread(target=run)
+        t2.start()
+        while flight.num_joined < 1:
+            threading.Event().wait(0.001)
+        release.set()
+        t1.join()
+        t2.join()
+        self.assertEquals(len(errors), 2)
+
+    def test_calls_started_too_early_are_not_joined(self):
+        flight = SingleFlight()
+        thread, release, results = self._start_blocked_call(
+            flight, "key", "stale")
+        now = timeit.default_timer() + 1
+        self.assertEquals(flight.do("key", lambda: "fresh", now), "fresh")
+        self.assertEquals(flight.num_joined, 0)
+        release.set()
+        thread.join()
+        self.assertEquals(results, ["stale"])
+
+
+class TestRequestProfile(unittest.TestCase):
+
+    def test_outermost_phase_claims_nested_time(self):
+        profile = RequestProfile()
+
+        @profile_phase("sql")
+        def query():
+            pass
+
+        with profiling(profile):
+            with profile_phase("lock"):
+                query()
+            query()
+            query()
+        # Nothing is recorded when no profile is active.
+        query()
+        breakdown = profile.get_breakdown()
+        self.assertEquals(sorted(breakdown),
+                          ["lock", "other", "sql", "total"])
+        self.assertAlmostEqual(breakdown["lock"] + breakdown["sql"] +
+                               breakdown["other"], breakdown["total"])
+        self.assertEquals(len(profile.phases), 2)
@@ -4,14 +4,19 @@
 #
 # pylint: disable=W0621, W1505, C0103
 
+import time
+
 from pyramid.request import Request
 from pyramid.security import IAuthenticationPolicy
 import hawkauthlib
+import tokenlib
 
 from webtest import TestApp
 import testfixtures
 
+from syncstorage.util import SingleFlight
 from syncstorage.storage import get_storage
+from syncstorage.views import util as views_util
 from syncstorage.tests.support import StorageTestCase
 
 
@@ -95,6 +100,263 @@ class TestWSGIApp(StorageTestCase):
         else:
             assert False, "log was not generated"
 
+    def test_token_cache(self):
+        auth_policy = self.config.registry.getUtility(IAuthenticationPolicy)
+        auth_policy.token_cache.clear()
+        req = Request.blank("http://localhost/")
+        req.metrics = {}
+        node_name = auth_policy._get_node_name(req)
+        secret = auth_policy._get_token_secrets(node_name)[-1]
+        tm = tokenlib.TokenManager(secret=secret)
+        data = {"uid": 42, "node": node_name, "expires": time.time() + 60}
+        tokenid = tm.make_token(data)
+        key = tm.get_derived_secret(tokenid)
+
+        # The first decode is a miss, the second is served from cache.
+        self.assertEquals(auth_policy.decode_hawk_id(req, tokenid),
+                          (42, key))
+        self.assertEquals(req.metrics["syncstorage.auth.token_cache_hit"], 0)
+        req.metrics = {}
+        self.assertEquals(auth_policy.decode_hawk_id(req, tokenid),
+                          (42, key))
+        self.assertEquals(req.metrics["syncstorage.auth.token_cache_hit"], 1)
+        self.assertEquals(auth_policy.token_cache.hit_rate, 0.5)
+
+        # Cached tokens still honour expiry and the expired-token window.
+        orig_time = time.time
+        try:
+            time.time = lambda: orig_time() + 120
+            self.assertEquals(auth_policy.decode_hawk_id(req, tokenid),
+                              ("expired:42", key))
+            timeout = auth_policy.expired_token_timeout
+            time.time = lambda: orig_time() + 120 + timeout
+            with self.assertRaises(ValueError):
+                auth_policy.decode_hawk_id(req, tokenid)
+        finally:
+            time.time = orig_time
+        self.assertEquals(len(auth_policy.token_cache), 0)
+
+        # Tokens for a different node are never served from the cache.
+        other_req = Request.blank("http://otherhost/")
+        other_req.metrics = {}
+        with self.assertRaises(ValueError):
+            auth_policy.decode_hawk_id(other_req, tokenid)
+
+    def test_read_coalescing_is_enabled_per_endpoint(self):
+        app = self._make_test_app()
+        app.post_json("/1.5/42/storage/col1", [{"id": "a", "payload": "x"}])
+
+        keys = []
+
+        class RecordingSingleFlight(SingleFlight):
+            def do(self, key, func, not_before=None):
+                keys.append(key)
+                return super(RecordingSingleFlight, self).do(key, func,
+                                                             not_before)
+
+        settings = self.config.registry.settings
+        orig_inflight_reads = views_util._inflight_reads
+        views_util._inflight_reads = RecordingSingleFlight()
+        try:
+            # With no setting, nothing is coalesced.
+            app.get("/1.5/42/info/collections")
+            self.assertEquals(keys, [])
+            # Enable it for only some endpoints.
+            settings["storage.coalesce_reads"] = "info_timestamps item"
+            r = app.get("/1.5/42/info/collections")
+            self.assertEquals(r.json.keys(), ["col1"])
+            self.assertEquals(len(keys), 1)
+            self.assertEquals(keys[0][1], "get_collection_timestamps")
+            app.get("/1.5/42/storage/col1?full=1")
+            self.assertEquals(len(keys), 1)
+            r = app.get("/1.5/42/storage/col1/a")
+            self.assertEquals(r.json["payload"], "x")
+            self.assertEquals(len(keys), 2)
+            self.assertEquals(keys[1][1], "get_item")
+            # Reads within a collection are keyed by its locked timestamp.
+            ts = float(r.headers["X-Last-Modified"])
+            self.assertEquals(float(keys[1][-1]), ts)
+        finally:
+            settings.pop("storage.coalesce_reads", None)
+            views_util._inflight_reads = orig_inflight_reads
+
+    def test_not_modified_responses_do_not_take_the_collection_lock(self):
+        app = self._make_test_app()
+        bsos = [{"id": "a", "payload": "x"}]
+        r = app.post_json("/1.5/42/storage/col1", bsos)
+        ts = r.headers["X-Last-Modified"]
+
+        storage = get_storage(self.make_request())
+        orig_lock_for_read = storage.lock_for_read
+        locks_taken = []
+
+        def lock_for_read(*args, **kwds):
+            locks_taken.append(args)
+            return orig_lock_for_read(*args, **kwds)
+
+        storage.lock_for_read = lock_for_read
+        try:
+            headers = {"X-If-Modified-Since": ts}
+            r = app.get("/1.5/42/storage/col1", headers=headers, status=304)
+            self.assertEquals(r.headers["X-Last-Modified"], ts)
+            r = app.get("/1.5/42/storage/col1/a", headers=headers, status=304)
+            self.assertEquals(r.headers["X-Last-Modified"], ts)
+            app.get("/1.5/42/storage/col2", headers=headers, status=304)
+            self.assertEquals(locks_taken, [])
+            # If it may have changed, we fall back to the locked path.
+            headers = {"X-If-Modified-Since": str(float(ts) - 1)}
+            r = app.get("/1.5/42/storage/col1", headers=headers)
+            self.assertEquals(r.json, ["a"])
+            self.assertEquals(len(locks_taken), 1)
+        finally:
+            del storage.lock_for_read
+
+    def test_admission_control_sheds_load_by_priority(self):
+        settings = self.config.registry.settings
+        settings["storage.admission_max_backlog"] = "10"
+        try:
+            app = self._make_test_app()
+        finally:
+            del settings["storage.admission_max_backlog"]
+        app.post_json("/1.5/42/storage/col1", [{"id": "a", "payload": "x"}])
+
+        storage = get_storage(self.make_request())
+        status = storage.get_pool_status()
+        self.assertEquals(status["backlog"], 0)
+        self.assertEquals(status["checkedout"], 0)
+        storage.get_pool_status = lambda: dict(status, backlog=6)
+        try:
+            # New batches are shed first, while other requests get through.
+            # Like other 503s, these pass through mozsvc's fuzzing of
+            # backoff headers, so turn that off to check the exact value.
+            with testfixtures.LogCapture() as logs:
+                with testfixtures.Replacer() as replacer:
+                    replacer.replace("mozsvc.tweens.random.randint",
+                                     lambda a, b: 0)
+                    r = app.post_json("/1.5/42/storage/col1?batch=true", [],
+                                      status=503)
+            self.assertEquals(r.headers["Retry-After"], "10")
+            self.assertEquals(r.content_type, "application/json")
+            self.assertEquals(r.json, 0)
+            self.assertTrue("X-Weave-Timestamp" in r.headers)
+            for r in logs.records:
+                if "syncstorage.admission.collection.shed" in r.__dict__:
+                    break
+            else:
+                assert False, "shed requests were not counted"
+            with testfixtures.LogCapture() as logs:
+                app.get("/1.5/42/storage/col1")
+            for r in logs.records:
+                if "syncstorage.admission.collection.admitted" in r.__dict__:
+                    break
+            else:
+                assert False, "admitted requests were not counted"
+            app.post_json("/1.5/42/storage/col1", [])
+            # Then everything but cheap reads and batch commits.
+            storage.get_pool_status = lambda: dict(status, backlog=10)
+            app.get("/1.5/42/storage/col1", status=503)
+            app.post_json("/1.5/42/storage/col1", [], status=503)
+            app.get("/1.5/42/info/collections")
+            app.get("/1.5/42/storage/col1/a")
+            app.post_json("/1.5/42/storage/col1?batch=MTI=&commit=true", [],
+                          status=400)
+        finally:
+            del storage.get_pool_status
+
+    def test_requests_that_exceed_their_deadline_are_retryable(self):
+        settings = self.config.registry.settings
+        app = self._make_test_app()
+        app.post_json("/1.5/42/storage/col1", [{"id": "a", "payload": "x"}])
+        settings["storage.request_deadline.collection"] = "0"
+        try:
+            # This 503 passes through mozsvc's fuzzing of backoff headers,
+            # so turn that off to check the exact value.
+            with testfixtures.Replacer() as replacer:
+                replacer.replace("mozsvc.tweens.random.randint",
+                                 lambda a, b: 0)
+                r = app.get("/1.5/42/storage/col1", status=503)
+            self.assertEquals(r.headers["Retry-After"], "10")
+            # Other endpoints are not affected by that deadline.
+            app.get("/1.5/42/storage/col1/a")
+        finally:
+            del settings["storage.request_deadline.collection"]
+        app.get("/1.5/42/storage/col1")
+
+    def test_pool_status_dump(self):
+        settings = self.config.registry.settings
+        app = self._make_test_app()
+        app.get("/__pool_status__", status=404)
+        app.post_json("/1.5/42/storage/col1", [{"id": "a", "payload": "x"}])
+        settings["storage.pool_status_enabled"] = True
+        try:
+            with testfixtures.LogCapture() as logs:
+                r = app.get("/__pool_status__")
+            self.assertTrue("default" in r.json)
+            status = r.json["default"]
+            if "num_checkouts" in status:
+                self.assertTrue("checkout_latency" in status)
+            # The app has queried the db, so there are query stats.
+            self.assertTrue(status["queries"])
+            entry = status["queries"].values()[0]
+            self.assertTrue(entry["count"] > 0)
+            self.assertTrue("histogram" in entry)
+            for r in logs.records:
+                if r.getMessage().startswith("Connection pool status"):
+                    break
+            else:
+                assert False, "pool status was not logged"
+        finally:
+            del settings["storage.pool_status_enabled"]
+        app.get("/__pool_status__", status=404)
+
+    def test_request_profiling(self):
+        settings = self.config.registry.settings
+        settings["storage.profile_secret"] = "letmein"
+        try:
+            app = self._make_test_app()
+        finally:
+            del settings["storage.profile_secret"]
+        app.post_json("/1.5/42/storage/col1", [{"id": "a", "payload": "x"}])
+        # Requests without the right secret are not profiled.
+        r = app.get("/1.5/42/storage/col1")
+        self.assertFalse("X-SyncStorage-Profile" in r.headers)
+        r = app.get("/1.5/42/storage/col1",
+                    headers={"X-SyncStorage-Profile": "guess"})
+        self.assertFalse("X-SyncStorage-Profile" in r.headers)
+        # Operators who know the secret get a breakdown of the time taken.
+        with testfixtures.LogCapture() as logs:
+            r = app.get("/1.5/42/storage/col1",
+                        headers={"X-SyncStorage-Profile": "letmein"})
+        profile = dict(item.split("=") for item in
+                       r.headers["X-SyncStorage-Profile"].split(", "))
+        for phase in ("auth", "validators", "lock", "sql", "render",
+                      "other", "total"):
+            self.assertTrue(float(profile[phase]) >= 0, phase)
+        total = sum(float(v) for k, v in profile.items() if k != "total")
+        self.assertAlmostEqual(total, float(profile["total"]), places=4)
+        for r in logs.records:
+            if "syncstorage.profile.sql" in r.__dict__:
+                break
+        else:
+            assert False, "profile was not included in the metrics"
+
+    def test_request_profiling_by_sampling(self):
+        settings = self.config.registry.settings
+        settings["storage.profile_sample_rate"] = "1.0"
+        try:
+            app = self._make_test_app()
+        finally:
+            del settings["storage.profile_sample_rate"]
+        with testfixtures.LogCapture() as logs:
+            r = app.get("/1.5/42/info/collections")
+        self.assertFalse("X-SyncStorage-Profile" in r.headers)
+        for r in logs.records:
+            if r.name == "syncstorage.profile":
+                self.assertTrue("/1.5/42/info/collections" in r.getMessage())
+                break
+        else:
+            assert False, "profile was not logged"
+
     def test_metrics_capture_for_batch_uploads(self):
         app = TestApp(self.config.make_wsgi_app())
 
@@ -4,11 +4,22 @@
 #
 # pylint: disable=C0103
 
+import re
+import hmac
 import json
+import random
+import logging
 
-from pyramid.httpexceptions import HTTPException
+from pyramid.httpexceptions import HTTPException, HTTPServiceUnavailable
+from pyramid.tweens import EXCVIEW
 
-from syncstorage.util import get_timestamp
+from mozsvc.metrics import annotate_request, initialize_request_metrics
+
+from syncstorage.util import get_timestamp, RequestProfile, profiling
+from syncstorage.storage import get_storage
+from syncstorage.views.decorators import RETRY_AFTER
+
+logger = logging.getLogger("syncstorage.profile")
 
 WEAVE_UNKNOWN_ERROR = 0
 WEAVE_ILLEGAL_METH = 1              # Illegal method/protocol
@@ -17,6 +28,32 @@ WEAVE_INVALID_WBO = 8               # Invalid Weave Basic Object
 WEAVE_OVER_QUOTA = 14               # User over quota
 WEAVE_SIZE_LIMIT_EXCEEDED = 17      # Size limit exceeded
 
+# Regex for picking the endpoint out of a request path, for use in deciding
+# how important a request is before it has been routed to a view.
+ENDPOINT_PATH_REGEX = re.compile(
+    r"^/1\.5/[0-9]{1,10}"
+    r"(?:/(?P<kind>info|storage)"
+    r"(?:/(?P<collection>[^/]+)"
+    r"(?:/(?P<item>[^/]+))?)?)?"
+    r"/?$"
+)
+
+# Priorities assigned to requests by the admission-control tween.
+# Low-priority requests are shed first, high-priority ones never.
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+# Fraction of the configured load limits at which to shed each priority.
+SHED_LOAD_FRACTION = {
+    PRIORITY_LOW: 0.5,
+    PRIORITY_NORMAL: 1.0,
+}
+
+# Header with which trusted operators can ask for a request to be profiled,
+# and in which the resulting profile is sent back to them.
+PROFILE_HEADER = "X-SyncStorage-Profile"
+
 
 def set_x_timestamp_header(handler, registry): # pylint: disable=W0613
     """Tween to set the X-Weave-Timestamp header on all responses."""
@@ -134,8 +171,167 @@ def convert_non_json_responses(handler, registry):  # pylint: disable=W0613
     return convert_non_json_responses_tween
 
 
+def classify_request(request):
+    """Get the endpoint name and admission priority for a request.
+
+    Cheap reads (info documents, single items, conditional GETs) and commits
+    of in-progress batches are given high priority.  Starting a new batch is
+    given low priority, since it commits the client to making several more
+    requests.  Everything else has normal priority.
+    """
+    match = ENDPOINT_PATH_REGEX.match(request.path_info)
+    if match is None:
+        return "other", PRIORITY_NORMAL
+    if match.group("kind") is None:
+        endpoint = "root"
+    elif match.group("kind") == "info":
+        endpoint = "info"
+    elif match.group("collection") is None:
+        endpoint = "storage"
+    elif match.group("item") is None:
+        endpoint = "collection"
+    else:
+        endpoint = "item"
+    if request.method in ("GET", "HEAD"):
+        if endpoint in ("info", "item"):
+            return endpoint, PRIORITY_HIGH
+        if "X-If-Modified-Since" in request.headers:
+            return endpoint, PRIORITY_HIGH
+        return endpoint, PRIORITY_NORMAL
+    if request.method == "POST" and endpoint == "collection":
+        batch = request.GET.get("batch")
+        if batch is not None:
+            if batch.lower() == "true":
+                return endpoint, PRIORITY_LOW
+            if "commit" in request.GET:
+                return endpoint, PRIORITY_HIGH
+    return endpoint, PRIORITY_NORMAL
+
+
+def admission_control(handler, registry):
+    """Tween to shed load early when the database is struggling.
+
+    The connection pool will reject requests once too many of them are
+    waiting for a db connection, but only after they have been parsed,
+    authenticated and validated.  This tween checks the state of the pool
+    before doing any of that work and sheds some requests straight away,
+    with the same 503 and Retry-After response as for a storage conflict.
+
+    The load is measured by the number of threads waiting for a connection
+    and by the recent average time taken to get one, compared against the
+    "storage.admission_max_backlog" and "storage.admission_max_latency"
+    settings respectively.  Low-priority requests are shed at half of those
+    limits, normal-priority requests once they are reached, and high-priority
+    requests are always let through.
+
+    Counts of admitted and shed requests are reported in the request metrics
+    under "syncstorage.admission.<endpoint>.admitted" and "...shed".
+
+    This runs inside all the other tweens, so that shed responses get the
+    usual json body, X-Weave-Timestamp header and fuzzing of Retry-After.
+    """
+    settings = registry.settings
+    max_backlog = settings.get("storage.admission_max_backlog")
+    max_latency = settings.get("storage.admission_max_latency")
+    # If no limits are configured then there's no need for this tween.
+    if max_backlog is None and max_latency is None:
+        return handler
+    if max_backlog is not None:
+        max_backlog = int(max_backlog)
+    if max_latency is not None:
+        max_latency = float(max_latency)
+
+    def get_load(request):
+        """Get current load as a fraction of the configured limits."""
+        storage = get_storage(request)
+        try:
+            status = storage.get_pool_status()
+        except AttributeError:
+            return 0
+        if status is None:
+            return 0
+        load = 0
+        if max_backlog:
+            load = max(load, float(status["backlog"]) / max_backlog)
+        if max_latency:
+            load = max(load, status["checkout_latency"] / max_latency)
+        return load
+
+    def admission_control_tween(request):
+        endpoint, priority = classify_request(request)
+        metric = "syncstorage.admission." + endpoint
+        if priority in SHED_LOAD_FRACTION:
+            if get_load(request) >= SHED_LOAD_FRACTION[priority]:
+                # The request never gets far enough for the metrics dict
+                # to be created, so set it up here to log the shed request.
+                initialize_request_metrics(request)
+                annotate_request(request, metric + ".shed", 1)
+                headers = {"Retry-After": str(RETRY_AFTER)}
+                return HTTPServiceUnavailable(headers=headers)
+        # This callback runs before the metrics dict is logged.
+        request.add_finished_callback(
+            lambda request: annotate_request(request, metric + ".admitted", 1)
+        )
+        return handler(request)
+
+    return admission_control_tween
+
+
+def profile_requests(handler, registry):
+    """Tween to profile where the time goes when handling a request.
+
+    This profiles a random sample of requests, given as a fraction by the
+    "storage.profile_sample_rate" setting, breaking down the time spent in
+    each into auth, validators, lock acquisition, sql, memcache, rendering
+    and everything else.  The breakdown is written to the log and added to
+    the request metrics as "syncstorage.profile.<phase>".
+
+    If the "storage.profile_secret" setting is given then any request with
+    that value in its X-SyncStorage-Profile header will also be profiled,
+    and will get the breakdown back in the same header of the response.
+    Since it may reveal details of server load, this should only be shared
+    with trusted operators.
+    """
+    settings = registry.settings
+    sample_rate = float(settings.get("storage.profile_sample_rate", 0))
+    secret = settings.get("storage.profile_secret")
+    # If nothing can be profiled then there's no need for this tween.
+    if not sample_rate and not secret:
+        return handler
+
+    def profile_requests_tween(request):
+        requested = False
+        if secret:
+            header = request.headers.get(PROFILE_HEADER)
+            if header is not None:
+                requested = hmac.compare_digest(str(header), str(secret))
+        if not requested and random.random() >= sample_rate:
+            return handler(request)
+        profile = RequestProfile()
+        try:
+            with profiling(profile):
+                response = handler(request)
+        finally:
+            breakdown = profile.get_breakdown()
+            for phase, duration in breakdown.items():
+                annotate_request(request, "syncstorage.profile." + phase,
+                                 duration)
+            logger.info("Profile of %s %s: %s", request.method, request.path,
+                        json.dumps(breakdown, sort_keys=True))
+        if requested:
+            response.headers[PROFILE_HEADER] = ", ".join(
+                "%s=%.6f" % item for item in sorted(breakdown.items()))
+        return response
+
+    return profile_requests_tween
+
+
 def includeme(config):
     """Include all the SyncServer tweens into the given config."""
+    config.add_tween("syncstorage.tweens.profile_requests")
+    # Shed requests must get the same json body and headers as any other
+    # 503, so this goes inside all the other tweens, including mozsvc's.
+    config.add_tween("syncstorage.tweens.admission_control", over=EXCVIEW)
     config.add_tween("syncstorage.tweens.set_x_timestamp_header")
     config.add_tween("syncstorage.tweens.set_default_accept_header")
     config.add_tween("syncstorage.tweens.convert_cornice_errors_to_respcodes")
@@ -2,8 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import sys
+import copy
 import time
+import timeit
 import decimal
+import functools
+import threading
+import contextlib
+from collections import OrderedDict
+
 import simplejson
 
 
@@ -30,3 +38,224 @@ def json_dumps(value):
 def json_loads(value):
     """Decimal-aware version of json.loads()."""
     return simplejson.loads(value, use_decimal=True)
+
+
+class LRUCache(object):
+    """A small thread-safe mapping that evicts its least-recently-used keys.
+
+    This is a simple bounded cache for memoizing expensive lookups within
+    a single process.  It keeps count of hits and misses so that callers
+    can report how effective the cache is.  A maxsize of zero disables the
+    cache entirely, making every lookup a miss.
+
+    If given, on_evict(key, value) is called for each key that is evicted
+    to make room for new ones, outside of the cache's lock.
+    """
+
+    def __init__(self, maxsize=1000, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups that were answered from the cache."""
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def get(self, key, default=None):
+        """Get the value for the given key, marking it as recently used."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store a value for the given key, evicting old keys if necessary."""
+        if self.maxsize <= 0:
+            return
+        evicted = []
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                evicted.append(self._items.popitem(last=False))
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def delete(self, key):
+        """Remove the given key from the cache, returning its value if any."""
+        with self._lock:
+            return self._items.pop(key, None)
+
+    def clear(self):
+        """Remove all keys from the cache."""
+        with self._lock:
+            self._items.clear()
+
+
+class _Flight(object):
+    """Book-keeping for a single in-progress call in a SingleFlight."""
+
+    def __init__(self):
+        self.started = timeit.default_timer()
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.num_joined = 0
+
+
+class SingleFlight(object):
+    """Helper to share the result of identical concurrent calls.
+
+    When several threads call do() with the same key at the same time,
+    only the first one actually invokes the function; the others wait for
+    it to finish and then receive a copy of its result (or its exception).
+    Once the call completes the key is forgotten, so this is a coalescing
+    mechanism rather than a cache.
+
+    Callers may pass a "not_before" time to avoid joining a call that was
+    started before that point, e.g. to ensure that they will see any writes
+    which completed before their request was received.  Such callers will
+    simply run the function themselves.
+
+    Since callers are free to modify what they get back, shared results are
+    deep-copied so that every caller receives an independent object.
+    """
+
+    def __init__(self):
+        self.num_calls = 0
+        self.num_joined = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, not_before=None):
+        """Call func() or wait for an identical call that's in progress."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                if not_before is None or flight.started >= not_before:
+                    flight.num_joined += 1
+                    self.num_joined += 1
+                    is_leader = False
+                else:
+                    # Too old to join, and too busy to replace.
+                    flight = None
+                    is_leader = False
+            else:
+                flight = self._flights[key] = _Flight()
+                is_leader = True
+            self.num_calls += 1
+        if flight is None:
+            return func()
+        if not is_leader:
+            flight.done.wait()
+            if flight.exc_info is not None:
+                exc, val, tb = flight.exc_info
+                raise exc, val, tb
+            return copy.deepcopy(flight.result)
+        try:
+            flight.result = func()
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        # Anyone who joined is now copying the result, so we must hand
+        # back a separate copy of our own in case the caller modifies it.
+        if flight.num_joined:
+            return copy.deepcopy(flight.result)
+        return flight.result
+
+
+_profile_data = threading.local()
+
+
+class RequestProfile(object):
+    """Breakdown of where the time went while handling a single request.
+
+    Time is attributed to named phases by code running inside profile_phase()
+    blocks, while this profile is active for the current thread.  If phases
+    are nested then the outermost one claims all of the time, so that e.g.
+    the queries made while acquiring a lock are counted towards "lock".
+    Anything not claimed by a phase is reported as "other".
+    """
+
+    def __init__(self):
+        self.start = timeit.default_timer()
+        self.phases = {}
+        self._depth = 0
+        self._phase_start = None
+
+    def get_breakdown(self):
+        """Get a dict giving the time spent in each phase, plus the total."""
+        breakdown = dict(self.phases)
+        breakdown["total"] = timeit.default_timer() - self.start
+        breakdown["other"] = breakdown["total"] - sum(self.phases.values())
+        return breakdown
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    """Context manager making the given profile active for this thread."""
+    previous = getattr(_profile_data, "profile", None)
+    _profile_data.profile = profile
+    try:
+        yield profile
+    finally:
+        _profile_data.profile = previous
+
+
+class profile_phase(object):  # pylint: disable=C0103
+    """Decorator/context-manager to attribute time to a phase of a request.
+
+    This records time against the named phase in any RequestProfile that is
+    active for the current thread, and does nothing otherwise.  Like the
+    mozsvc metrics_timer, it can be used either as a context manager or as
+    a function decorator.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        profile = getattr(_profile_data, "profile", None)
+        if profile is not None:
+            profile._depth += 1
+            if profile._depth == 1:
+                profile._phase_start = timeit.default_timer()
+
+    def __exit__(self, exc_typ=None, exc_val=None, exc_tb=None):
+        profile = getattr(_profile_data, "profile", None)
+        if profile is not None:
+            if profile._depth == 1:
+                duration = timeit.default_timer() - profile._phase_start
+                profile.phases[self.name] = \
+                    profile.phases.get(self.name, 0) + duration
+            profile._depth -= 1
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            with self:
+                return func(*args, **kwds)
+        return wrapper
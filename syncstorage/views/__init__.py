@@ -7,14 +7,16 @@ import logging
 from base64 import b64encode
 
 from pyramid.security import Allow
+from pyramid.httpexceptions import HTTPNotFound
 
 from cornice import Service
 
 from syncstorage.bso import VALID_ID_REGEX, MAX_PAYLOAD_SIZE
-from syncstorage.util import get_timestamp
+from syncstorage.util import get_timestamp, json_dumps
 from syncstorage.storage import (ConflictError,
                                  NotFoundError,
-                                 InvalidBatch)
+                                 InvalidBatch,
+                                 get_all_storages)
 
 from syncstorage.views.validators import (extract_target_resource,
                                           extract_precondition_headers,
@@ -23,11 +25,16 @@ from syncstorage.views.validators import (extract_target_resource,
                                           parse_multiple_bsos,
                                           parse_single_bso)
 from syncstorage.views.decorators import (convert_storage_errors,
+                                          with_request_deadline,
                                           sleep_and_retry_on_conflict,
                                           with_collection_lock,
+                                          check_not_modified_without_lock,
                                           check_precondition_headers,
                                           check_storage_quota)
-from syncstorage.views.util import get_resource_timestamp, get_limit_config
+from syncstorage.views.util import (json_error,
+                                    get_resource_timestamp,
+                                    get_limit_config,
+                                    coalesced_read)
 
 
 logger = logging.getLogger("syncstorage")  # pylint: disable=C0103
@@ -43,7 +50,9 @@ def default_decorators(func):
     func = check_storage_quota(func)
     func = check_precondition_headers(func)
     func = with_collection_lock(func)
+    func = check_not_modified_without_lock(func)
     func = sleep_and_retry_on_conflict(func)
+    func = with_request_deadline(func)
     func = convert_storage_errors(func)
     return func
 
@@ -122,6 +131,36 @@ def get_site_root(request):  # pylint: disable=W0613
     return "It Works!  SyncStorage is successfully running on this host."
 
 
+# An optional view for dumping the state of the db connection pools,
+# to help with diagnosing problems during an incident.  It's disabled
+# unless the "storage.pool_status_enabled" setting is true.
+pool_status = Service(name="pool_status", path="/__pool_status__")
+
+
+@pool_status.get(renderer="json")
+def get_pool_status(request):
+    if not request.registry.settings.get("storage.pool_status_enabled"):
+        raise HTTPNotFound()
+    status = {}
+    for hostname, storage in get_all_storages(request):
+        try:
+            status[hostname] = storage.get_pool_status()
+        except AttributeError:
+            status[hostname] = None
+        # The per-query statistics are too big to gather on every request
+        # for admission control, so they're only reported here.
+        try:
+            query_stats = storage.get_query_stats()
+        except AttributeError:
+            query_stats = None
+        if query_stats is not None:
+            if status[hostname] is None:
+                status[hostname] = {}
+            status[hostname]["queries"] = query_stats
+    logger.info("Connection pool status: %s", json_dumps(status))
+    return status
+
+
 service_root = SyncStorageService(name="service_root",
                                   path="")
 
@@ -150,8 +189,8 @@ item = SyncStorageService(name="item",
                      acl=expired_token_acl)
 @default_decorators
 def get_info_timestamps(request):
-    storage = request.validated["storage"]
-    timestamps = storage.get_collection_timestamps(request.validated["userid"])
+    timestamps = coalesced_read(request, "get_collection_timestamps",
+                                request.validated["userid"])
     request.response.headers["X-Weave-Records"] = str(len(timestamps))
     return timestamps
 
@@ -229,6 +268,7 @@ def delete_all(request):
 @collection.get(accept="application/json", renderer="sync-json")
 @collection.get(accept="application/newlines", renderer="sync-newlines")
 @convert_storage_errors
+@with_request_deadline
 def get_collection_with_internal_pagination(request):
     """Get the contents of a collection, in a respectful manner.
 
@@ -286,11 +326,11 @@ def get_collection_with_internal_pagination(request):
 
 
 @sleep_and_retry_on_conflict
+@check_not_modified_without_lock
 @with_collection_lock
 @check_precondition_headers
 @check_storage_quota
 def get_collection(request):
-    storage = request.validated["storage"]
     userid = request.validated["userid"]
     collection = request.validated["collection"]
 
@@ -301,11 +341,13 @@ def get_collection(request):
             filters[name] = request.validated[name]
 
     if request.validated.get("full", False):
-        res = storage.get_items(userid, collection, **filters)
+        res = coalesced_read(request, "get_items",
+                             userid, collection, **filters)
         for bso in res["items"]:
             bso.pop("ttl", None)
     else:
-        res = storage.get_item_ids(userid, collection, **filters)
+        res = coalesced_read(request, "get_item_ids",
+                             userid, collection, **filters)
     next_offset = res.get("next_offset")
     if next_offset is not None:
         request.response.headers["X-Weave-Next-Offset"] = str(next_offset)
@@ -389,9 +431,10 @@ def post_collection_batch(request):
                 raise InvalidBatch
 
         if bsos:
+            totals = check_batch_totals(request, batch, bsos)
             try:
                 storage.append_items_to_batch(userid, collection, batch, bsos)
-            except ConflictError:
+            except (ConflictError, InvalidBatch):
                 raise
             except Exception as e:
                 logger.error('Could not append to batch("{0}")'.format(batch))
@@ -400,6 +443,8 @@ def post_collection_batch(request):
                     res["failed"][bso["id"]] = "db error"
             else:
                 res["success"].extend([bso["id"] for bso in bsos])
+                if totals is not None:
+                    res["total_records"], res["total_bytes"] = totals
 
         if commit:
             try:
@@ -425,6 +470,31 @@ def post_collection_batch(request):
     return res
 
 
+def check_batch_totals(request, batch, bsos):
+    """Enforce the total size limits of a batch, as counted by the server.
+
+    The client-supplied X-Weave-Total-* headers are checked up front, but
+    a client could still grow a batch without bound by misreporting them.
+    This checks the totals that the batch would have with the given items
+    appended, before anything is written, since not every backend can roll
+    back an append.  Returns those totals, or None if the storage doesn't
+    keep track of them.
+    """
+    storage = request.validated["storage"]
+    userid = request.validated["userid"]
+    collection = request.validated["collection"]
+    totals = storage.get_batch_totals(userid, collection, batch)
+    if totals is None:
+        return None
+    num_records = totals[0] + len(bsos)
+    num_bytes = totals[1] + sum(len(bso.get("payload", "")) for bso in bsos)
+    if num_records > get_limit_config(request, "max_total_records"):
+        raise json_error(400, "size-limit-exceeded")
+    if num_bytes > get_limit_config(request, "max_total_bytes"):
+        raise json_error(400, "size-limit-exceeded")
+    return num_records, num_bytes
+
+
 @collection.delete(renderer="sync-json")
 @default_decorators
 def delete_collection(request):
@@ -448,11 +518,10 @@ def delete_collection(request):
 @item.get(accept="application/json", renderer="sync-json")
 @default_decorators
 def get_item(request):
-    storage = request.validated["storage"]
     userid = request.validated["userid"]
     collection = request.validated["collection"]
     item = request.validated["item"]
-    bso = storage.get_item(userid, collection, item)
+    bso = coalesced_read(request, "get_item", userid, collection, item)
     bso.pop("ttl", None)
     return bso
 
@@ -11,6 +11,9 @@ import tokenlib.errors
 from zope.interface import implementer
 from pyramid.interfaces import IAuthenticationPolicy
 from mozsvc.user import TokenServerAuthenticationPolicy
+from mozsvc.metrics import annotate_request
+
+from syncstorage.util import LRUCache, profile_phase
 
 
 logger = logging.getLogger("syncstorage")  # pylint: disable=C0103
@@ -18,6 +21,8 @@ logger = logging.getLogger("syncstorage")  # pylint: disable=C0103
 
 DEFAULT_EXPIRED_TOKEN_TIMEOUT = 60 * 60 * 2  # 2 hours, in seconds
 
+DEFAULT_TOKEN_CACHE_SIZE = 10000
+
 
 @implementer(IAuthenticationPolicy)
 class SyncStorageAuthenticationPolicy(TokenServerAuthenticationPolicy):
@@ -28,12 +33,21 @@ class SyncStorageAuthenticationPolicy(TokenServerAuthenticationPolicy):
     an expired token will result in a principal of "expired:<uid>" rather than
     just "<uid>", allowing this case to be specially detected and handled for
     some resources without interfering with the usual authentication rules.
+
+    Since clients re-use the same token for many requests, successfully
+    decoded tokens are kept in a bounded in-memory cache so that repeat
+    requests can skip the signature checks.  The size of this cache can be
+    set with the "token_cache_size" setting; zero disables it.
     """
 
     def __init__(self, secrets=None, **kwds):
         self.expired_token_timeout = kwds.pop("expired_token_timeout", None)
         if self.expired_token_timeout is None:
             self.expired_token_timeout = DEFAULT_EXPIRED_TOKEN_TIMEOUT
+        token_cache_size = kwds.pop("token_cache_size", None)
+        if token_cache_size is None:
+            token_cache_size = DEFAULT_TOKEN_CACHE_SIZE
+        self.token_cache = LRUCache(token_cache_size)
         super(SyncStorageAuthenticationPolicy, self).__init__(secrets, **kwds)
 
     @classmethod
@@ -44,8 +58,21 @@ class SyncStorageAuthenticationPolicy(TokenServerAuthenticationPolicy):
         expired_token_timeout = settings.pop("expired_token_timeout", None)
         if expired_token_timeout is not None:
             kwds["expired_token_timeout"] = int(expired_token_timeout)
+        token_cache_size = settings.pop("token_cache_size", None)
+        if token_cache_size is not None:
+            kwds["token_cache_size"] = int(token_cache_size)
         return kwds
 
+    @profile_phase("auth")
+    def _get_credentials(self, request):
+        supercls = super(SyncStorageAuthenticationPolicy, self)
+        return supercls._get_credentials(request)
+
+    @profile_phase("auth")
+    def _check_signature(self, request, key):
+        supercls = super(SyncStorageAuthenticationPolicy, self)
+        return supercls._check_signature(request, key)
+
     def decode_hawk_id(self, request, tokenid):
         """Decode a Hawk token id into its userid and secret key.
 
@@ -59,6 +86,19 @@ class SyncStorageAuthenticationPolicy(TokenServerAuthenticationPolicy):
         """
         now = time.time()
         node_name = self._get_node_name(request)
+        # Try to find a previously-decoded copy of this token in the cache.
+        cache_key = (node_name, tokenid)
+        cached = self.token_cache.get(cache_key)
+        if cached is not None:
+            userid = self._get_effective_userid(cached, now)
+            if userid is not None:
+                annotate_request(request, "syncstorage.auth.token_cache_hit", 1)
+                request.metrics["fxa_uid"] = cached["fxa_uid"]
+                request.metrics["device_id"] = cached["device_id"]
+                return userid, cached["key"]
+            # It has aged out of the expired-token window, so forget it
+            # and let the full check below produce the appropriate error.
+            self.token_cache.delete(cache_key)
         # There might be multiple secrets in use,
         # so try each until we find one that works.
         secrets = self._get_token_secrets(node_name)
@@ -70,10 +110,11 @@ class SyncStorageAuthenticationPolicy(TokenServerAuthenticationPolicy):
                 # it falls within the allowable expired-token window.
                 try:
                     data = tm.parse_token(tokenid, now=now)
+                    expired = False
                 except tokenlib.errors.ExpiredTokenError:
                     recently = now - self.expired_token_timeout
                     data = tm.parse_token(tokenid, now=recently)
-                    data["uid"] = "expired:%d" % (data["uid"],)
+                    expired = True
             except ValueError:
                 # Token validation failed, move on to the next secret.
                 continue
@@ -97,12 +138,37 @@ class SyncStorageAuthenticationPolicy(TokenServerAuthenticationPolicy):
             raise ValueError(msg % (token_node_name,))
         # Calculate the matching request-signing secret.
         key = tokenlib.get_derived_secret(tokenid, secret=secret)
+        # Remember the verified token, so we can skip these checks next time.
+        self.token_cache.set(cache_key, {
+            "uid": userid,
+            "expires": data["expires"],
+            "key": key,
+            "fxa_uid": data.get("fxa_uid"),
+            "device_id": data.get("device_id"),
+        })
+        annotate_request(request, "syncstorage.auth.token_cache_hit", 0)
+        if expired:
+            userid = "expired:%d" % (userid,)
 
         request.metrics["fxa_uid"] = data.get("fxa_uid")
         request.metrics["device_id"] = data.get("device_id")
 
         return userid, key
 
+    def _get_effective_userid(self, token_info, now):
+        """Get the userid to use for a cached token, given the current time.
+
+        This applies the same rules as decode_hawk_id() to the expiry time
+        of a previously-verified token.  It returns the plain userid for a
+        live token, "expired:<uid>" for a token within the expired-token
+        window, or None if the token is too old to be used at all.
+        """
+        if token_info["expires"] > now:
+            return token_info["uid"]
+        if token_info["expires"] > now - self.expired_token_timeout:
+            return "expired:%d" % (token_info["uid"],)
+        return None
+
 
 def includeme(config):
     """Include syncstorage-specific authentication into a pyramid config."""
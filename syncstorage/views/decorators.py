@@ -13,10 +13,13 @@ from pyramid.httpexceptions import (HTTPNotFound,
                                     HTTPPreconditionFailed,
                                     HTTPBadRequest)
 
+from mozsvc.exceptions import BackendTimeoutError
+
 from syncstorage.storage import (ConflictError,
                                  NotFoundError,
                                  InvalidOffsetError,
-                                 InvalidBatch)
+                                 InvalidBatch,
+                                 deadline)
 
 from syncstorage.views.util import (make_decorator,
                                     json_error,
@@ -48,6 +51,11 @@ def convert_storage_errors(viewfunc, request):
         #   * android bug: https://bugzilla.mozilla.org/show_bug.cgi?id=959032
         headers = {"Retry-After": str(RETRY_AFTER)}
         raise HTTPServiceUnavailable(headers=headers)
+    except BackendTimeoutError:
+        # The request ran out of time, most likely due to load on the db.
+        # It's safe for the client to retry it after a short delay.
+        headers = {"Retry-After": str(RETRY_AFTER)}
+        raise HTTPServiceUnavailable(headers=headers)
     except NotFoundError:
         raise HTTPNotFound
     except InvalidOffsetError:
@@ -60,6 +68,33 @@ def convert_storage_errors(viewfunc, request):
         raise HTTPBadRequest("Invalid batch: %s" % e)
 
 
+@make_decorator
+def with_request_deadline(viewfunc, request):
+    """View decorator to limit the time spent in storage operations.
+
+    This decorator sets a deadline for all the storage operations performed
+    while handling the request, which the storage backend can propagate into
+    the database as a per-query timeout.  It's taken from the setting
+    "storage.request_deadline.<endpoint>" if present, falling back to the
+    "storage.request_deadline" setting, in seconds.  If neither is set then
+    no deadline is applied.
+
+    Requests that run out of time will fail with BackendTimeoutError, which
+    is converted into a retryable 503 response by convert_storage_errors.
+    """
+    settings = request.registry.settings
+    timeout = None
+    if request.matched_route is not None:
+        endpoint = request.matched_route.name
+        timeout = settings.get("storage.request_deadline." + endpoint)
+    if timeout is None:
+        timeout = settings.get("storage.request_deadline")
+    if timeout is None:
+        return viewfunc(request)
+    with deadline(float(timeout)):
+        return viewfunc(request)
+
+
 @make_decorator
 def sleep_and_retry_on_conflict(viewfunc, request):
     """View decorator to perform one automatic retry on ConflictError.
@@ -166,6 +201,36 @@ def check_precondition_headers(viewfunc, request):
     return viewfunc(request)
 
 
+@make_decorator
+def check_not_modified_without_lock(viewfunc, request):
+    """View decorator to answer unchanged conditional GETs without locking.
+
+    This decorator gives read requests with an X-If-Modified-Since header a
+    cheap early check of the target resource's last-modified time, read
+    without taking the collection lock (e.g. from memcache metadata, or from
+    a single lightweight query).  If it has not changed then this immediately
+    returns a "304 Not Modified" response.
+
+    Otherwise, the data may have changed and the request proceeds as normal,
+    with check_precondition_headers re-checking the timestamp under the lock.
+    """
+    if request.method not in ("GET", "HEAD",):
+        return viewfunc(request)
+    if "if_modified_since" not in request.validated:
+        return viewfunc(request)
+    # Requests that don't target a collection don't take a lock anyway.
+    if request.validated.get("collection") is None:
+        return viewfunc(request)
+
+    ts = get_resource_timestamp(request)
+    if ts <= request.validated["if_modified_since"]:
+        raise HTTPNotModified(headers={
+            "X-Last-Modified": str(ts),
+        })
+
+    return viewfunc(request)
+
+
 @make_decorator
 def with_collection_lock(viewfunc, request):
     """View decorator to take a collection-level lock during request handling.
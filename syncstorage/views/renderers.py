@@ -3,7 +3,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-from syncstorage.util import json_dumps
+from syncstorage.util import json_dumps, profile_phase
 from syncstorage.views.util import get_resource_timestamp
 
 
@@ -15,6 +15,7 @@ class SyncStorageRenderer(object):
         # so we need to provide a stub __init__ method.
         pass
 
+    @profile_phase("render")
     def __call__(self, value, system):
         request = system.get('request')
         if request is not None:
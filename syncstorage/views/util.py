@@ -5,8 +5,11 @@
 import simplejson as json
 import functools
 
+import six
+
 from pyramid.httpexceptions import HTTPError
 
+from syncstorage.util import SingleFlight
 from syncstorage.storage import NotFoundError
 
 
@@ -88,6 +91,57 @@ def get_resource_timestamp(request):
         return 0
 
 
+# Identical read requests that arrive concurrently in this process
+# can share a single call into the storage backend.
+_inflight_reads = SingleFlight()
+
+
+def coalesced_read(request, method_name, *args, **kwds):
+    """Call a read-only storage method, sharing identical concurrent calls.
+
+    If read coalescing is enabled for the endpoint targeted by this request,
+    via the "storage.coalesce_reads" setting, then concurrent requests making
+    the same storage call will share a single trip to the database.  Each
+    caller receives its own copy of the result.
+
+    A request will only share a call that was started after it was received,
+    so it still sees any writes that completed before it arrived.  If the
+    request targets a collection then its timestamp, as read under the
+    collection lock, is also included in the key so that callers only share
+    results that are consistent with the lock they are holding.
+    """
+    storage = request.validated["storage"]
+    method = getattr(storage, method_name)
+    if not _is_coalescing_enabled(request):
+        return method(*args, **kwds)
+    key = [storage, method_name, args]
+    for name, value in sorted(kwds.items()):
+        if isinstance(value, list):
+            value = tuple(value)
+        key.append((name, value))
+    collection = request.validated.get("collection")
+    if collection is not None:
+        userid = request.validated["userid"]
+        try:
+            key.append(storage.get_collection_timestamp(userid, collection))
+        except NotFoundError:
+            key.append(None)
+    metrics = getattr(request, "metrics", {})
+    not_before = metrics.get("request_start_time")
+    return _inflight_reads.do(tuple(key), lambda: method(*args, **kwds),
+                              not_before=not_before)
+
+
+def _is_coalescing_enabled(request):
+    """Check whether read coalescing is enabled for the target endpoint."""
+    endpoints = request.registry.settings.get("storage.coalesce_reads")
+    if not endpoints or request.matched_route is None:
+        return False
+    if isinstance(endpoints, six.string_types):
+        endpoints = endpoints.replace(",", " ").split()
+    return request.matched_route.name in endpoints
+
+
 DEFAULT_LIMITS = {}
 DEFAULT_LIMITS["max_request_bytes"] = 1024 * 1024
 DEFAULT_LIMITS["max_post_records"] = 100
@@ -7,7 +7,7 @@ import re
 from base64 import b64decode
 
 from syncstorage.bso import BSO, VALID_ID_REGEX
-from syncstorage.util import get_timestamp, json_loads
+from syncstorage.util import get_timestamp, json_loads, profile_phase
 from syncstorage.storage import get_storage
 from syncstorage.views.util import json_error, get_limit_config
 
@@ -19,6 +19,7 @@ BATCH_MAX_IDS = 100
 TRUE_REGEX = re.compile("^true$", re.I)
 
 
+@profile_phase("validators")
 def extract_target_resource(request):
     """Validator to extract the target resource of a request.
 
@@ -41,6 +42,7 @@ def extract_target_resource(request):
         request.validated["item"] = request.matchdict["item"]
 
 
+@profile_phase("validators")
 def extract_precondition_headers(request):
     """Validator to extract the X-If-[Unm|M]odified-Since headers.
 
@@ -83,6 +85,7 @@ def extract_precondition_headers(request):
                 request.validated["if_unmodified_since"] = if_unmodified_since
 
 
+@profile_phase("validators")
 def extract_query_params(request):
     """Validator to extract BSO search parameters from the query string.
 
@@ -166,6 +169,7 @@ def extract_query_params(request):
         request.validated["full"] = True
 
 
+@profile_phase("validators")
 def extract_batch_state(request):
     """Validator to extract the batch state of a request for slightly
     tidier code in the views.
@@ -228,6 +232,7 @@ def extract_batch_state(request):
             raise json_error(400, "size-limit-exceeded")
 
 
+@profile_phase("validators")
 def parse_multiple_bsos(request):
     """Validator to parse a list of BSOs from the request body.
 
@@ -306,6 +311,7 @@ def parse_multiple_bsos(request):
     request.validated["invalid_bsos"] = invalid_bsos
 
 
+@profile_phase("validators")
 def parse_single_bso(request):
     """Validator to parse a single BSO from the request body.
 